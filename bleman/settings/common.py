@@ -22,6 +22,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mill.middleware.QueryInstrumentationMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -29,6 +30,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'mill.middleware.PrimaryPinMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -53,6 +55,10 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'bleman.wsgi.application'
 
+# Reads of the opted-in views go to a ``replica`` database when the
+# settings define one.
+DATABASE_ROUTERS = ['mill.routers.ReplicaRouter']
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -88,6 +94,13 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'bleman',
+    }
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
@@ -115,6 +128,11 @@ INTERNAL_IPS = [
 
 DJANGO_LOG_LEVEL = 'INFO'
 
+# Requests logged at WARNING by mill.middleware; set MILL_QUERY_LOG_LEVEL to
+# DEBUG to log every request.
+SLOW_REQUEST_QUERIES = int(os.environ.get('SLOW_REQUEST_QUERIES', 50))
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 500))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -131,6 +149,9 @@ LOGGING = {
         '': {
             'handlers': ['console', 'file'],
             'level': os.environ.get('DJANGO_LOG_LEVEL', 'INFO')
+        },
+        'mill.middleware': {
+            'level': os.environ.get('MILL_QUERY_LOG_LEVEL', 'INFO')
         }
     },
     'formatters': {
@@ -1,4 +1,5 @@
 from .common import *
+import os
 
 SECRET_KEY = 'django-insecure-8lk0c_(m(kwygwalgfnw^b8*9!-u^etgk%2&=4c%&ih(xmwb7n'
 DEBUG = True
@@ -7,5 +8,24 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'OPTIONS': {
+            # As in the sqlite production profile: concurrent writers queue
+            # instead of one failing to upgrade its lock.
+            'transaction_mode': 'IMMEDIATE',
+        },
+        # A file rather than in-memory test database lets the concurrency
+        # tests open one connection per thread.
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
+    },
+    # A second connection standing in for a read replica. Point
+    # SQLITE_REPLICA_NAME at a copy of db.sqlite3 to read from another file.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('SQLITE_REPLICA_NAME', BASE_DIR / 'db.sqlite3'),
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
 }
@@ -1,13 +1,85 @@
 from .common import *
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 SECRET_KEY = os.environ['SECRET_KEY']
 DEBUG = False
 
-DATABASES = {
+# ``sqlite`` (the default) or ``postgresql``.
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+
+if DATABASE_PROFILE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'bleman'),
+            'USER': os.environ.get('POSTGRES_USER', 'bleman'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Check a reused connection before handing it to a request, so a
+            # database restart costs one reconnect rather than an error.
+            'CONN_HEALTH_CHECKS': True,
+        }
+    }
+    if os.environ.get('POSTGRES_POOL_MAX_SIZE'):
+        # One psycopg pool per worker process; the pool, not Django, keeps
+        # the connections open.
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS'] = {'pool': {
+            'min_size': int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 1)),
+            'max_size': int(os.environ['POSTGRES_POOL_MAX_SIZE']),
+            'timeout': float(os.environ.get('POSTGRES_POOL_TIMEOUT', 10)),
+        }}
+    else:
+        DATABASES['default']['CONN_MAX_AGE'] = int(
+            os.environ.get('CONN_MAX_AGE', 600))
+    if os.environ.get('POSTGRES_REPLICA_HOST'):
+        # A streaming replica of the primary, read by the opted-in views.
+        DATABASES['replica'] = {
+            **DATABASES['default'],
+            'HOST': os.environ['POSTGRES_REPLICA_HOST'],
+            'PORT': os.environ.get(
+                'POSTGRES_REPLICA_PORT', DATABASES['default']['PORT']),
+        }
+elif DATABASE_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 600)),
+            'OPTIONS': {
+                # Take the write lock when a transaction starts, so two
+                # transactions that read then write queue on busy_timeout
+                # instead of one failing to upgrade its lock.
+                'transaction_mode': 'IMMEDIATE',
+            },
+        }
+    }
+    # Applied to every new connection by mill.database.configure_sqlite.
+    # WAL lets readers run alongside the writer; NORMAL sync is durable
+    # across application crashes, only a power loss may drop the last
+    # commits.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+        'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 2 ** 20)),
+        'cache_size': -int(os.environ.get('SQLITE_CACHE_KIB', 20000)),
+        'temp_store': 'MEMORY',
+    }
+else:
+    raise ImproperlyConfigured(
+        f'Unknown DATABASE_PROFILE {DATABASE_PROFILE!r}, use sqlite or '
+        f'postgresql.')
+
+# Shared by the gunicorn workers, so a write in one worker invalidates the
+# cached product responses of the others.
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_LOCATION', '/tmp/bleman-cache'),
     }
 }
 
@@ -1,7 +1,10 @@
 from django.contrib import admin
-from django.forms import ModelForm
+from django.core.exceptions import ValidationError
+from django.forms import BaseInlineFormSet, ModelForm
 from django.http import HttpRequest
-from .models import Product, Customer, Production, Purchase, Order, Item
+from django.utils.translation import gettext_lazy as _
+from .models import (Product, Customer, Production, Purchase, Order, Item,
+                     ReorderSuggestion, Stock)
 
 # Register your models here.
 
@@ -14,6 +17,25 @@ class ProductAdmin(admin.ModelAdmin):
     search_fields = ['name']
 
 
+@admin.register(Stock)
+class StockAdmin(admin.ModelAdmin):
+    list_display = ['product', 'quantity', 'updated_at']
+    search_fields = ['product__name']
+    readonly_fields = ['product', 'quantity', 'updated_at']
+
+
+@admin.register(ReorderSuggestion)
+class ReorderSuggestionAdmin(admin.ModelAdmin):
+    list_display = ['product', 'quantity_in_stock', 'forecast_demand',
+                    'days_of_cover', 'reorder_quantity', 'stockout_risk',
+                    'computed_at']
+    search_fields = ['product__name']
+    readonly_fields = ['product', 'quantity_in_stock', 'average_demand_7',
+                       'average_demand_28', 'seasonality', 'forecast_demand',
+                       'days_of_cover', 'reorder_quantity', 'stockout_risk',
+                       'computed_at']
+
+
 @admin.register(Customer)
 class CustomerAdmin(admin.ModelAdmin):
     list_display = ['given_name', 'surname', 'is_supplier']
@@ -37,24 +59,163 @@ class PurchaseAdmin(admin.ModelAdmin):
     list_filter = ['created_at']
 
 
+def get_requested_quantities(forms):
+    """Return the extra ``{product_id: quantity}`` the item forms need and
+    the forms asking for each product."""
+    requested = {}
+    forms_by_product = {}
+    for form in forms:
+        if not form.has_changed() or not hasattr(form, 'cleaned_data'):
+            continue
+        if form.cleaned_data.get('DELETE'):
+            continue
+        product = form.cleaned_data.get('product')
+        quantity = form.cleaned_data.get('quantity')
+        if product is None or quantity is None:
+            continue
+        saved_quantity = 0
+        if form.initial.get('product') == product.id:
+            saved_quantity = form.initial.get('quantity') or 0
+        requested[product.id] = requested.get(product.id, 0) \
+            + quantity - saved_quantity
+        forms_by_product.setdefault(product.id, []).append(form)
+    return requested, forms_by_product
+
+
+def validate_item_forms_stock(forms, error=None):
+    """Add to the quantity of the item ``forms`` the shortfall of their
+    products, or ``error``, the reservation that failed when saving them."""
+    requested, forms_by_product = get_requested_quantities(forms)
+    if error is None:
+        try:
+            Product.objects.validate_stock_availability(requested)
+            return
+        except ValidationError as e:
+            error = e
+    if not hasattr(error, 'error_dict'):
+        # "Stock changed, please retry.": not tied to one product.
+        error = ValidationError(
+            {product_id: error.error_list for product_id in forms_by_product})
+    for product_id, errors in error.error_dict.items():
+        for form in forms_by_product.get(product_id, []):
+            form.add_error('quantity', errors)
+
+
+def validate_item_product(form):
+    # update_quantity() only reserves more of the line's own product.
+    if form.instance.pk and 'product' in form.changed_data:
+        form.add_error('product', _(
+            'Delete the line and add one for the other product.'))
+
+
+def save_item(item):
+    """Save ``item`` through ItemManager.add_item() or update_quantity(),
+    reserving its stock as the API does.
+
+    Raise the ``out_of_stock`` ValidationError when there is not enough.
+    """
+    if item.pk is None:
+        saved = Item.objects.add_item(
+            order=item.order,
+            product=item.product,
+            quantity=item.quantity,
+            price=item.price
+        )
+        # The admin logs and redirects to the form's instance, which may
+        # have been added to an existing line.
+        item.pk = saved.pk
+        item._state.adding = False
+        item.refresh_from_db()
+        return item
+    item.update_quantity(item.quantity)
+    return item
+
+
+class ItemInlineFormSet(BaseInlineFormSet):
+    stock_error = None
+
+    def clean(self):
+        super().clean()
+        for form in self.forms:
+            if form.has_changed() and hasattr(form, 'cleaned_data'):
+                validate_item_product(form)
+        validate_item_forms_stock(self.forms, self.stock_error)
+
+
+class ItemForm(ModelForm):
+    stock_error = None
+
+    def clean(self):
+        cleaned_data = super().clean()
+        validate_item_product(self)
+        validate_item_forms_stock([self], self.stock_error)
+        return cleaned_data
+
+
+class StockReservationAdminMixin:
+    """Show the stock reservation failing on save as errors of the item
+    forms.
+
+    The pre-check of the forms can pass and the reservation still fail
+    when another sale takes the stock in between. The admin's transaction
+    is then rolled back and the page rendered again, the failed
+    reservation added to the forms of its products.
+    """
+
+    def changeform_view(self, request, object_id=None, form_url='',
+                        extra_context=None):
+        try:
+            return super().changeform_view(
+                request, object_id, form_url, extra_context)
+        except ValidationError as e:
+            if getattr(request, 'stock_error', None) is not None:
+                raise
+            request.stock_error = e
+            return super().changeform_view(
+                request, object_id, form_url, extra_context)
+
+
 class ItemInline(admin.TabularInline):
     model = Item
+    formset = ItemInlineFormSet
     extra = 0
     autocomplete_fields = ['product']
 
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.stock_error = getattr(request, 'stock_error', None)
+        return formset
+
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
-    list_display = ['id', 'customer', 'status', 'created_at']
+class OrderAdmin(StockReservationAdminMixin, admin.ModelAdmin):
+    list_display = ['id', 'customer', 'status', 'total_amount',
+                    'paid_amount', 'created_at']
     list_filter = ['status', 'created_at']
+    readonly_fields = ['status', 'total_amount', 'paid_amount',
+                       'returned_amount']
     inlines = [ItemInline]
     autocomplete_fields = ['customer']
 
+    def save_formset(self, request, form, formset, change):
+        if formset.model is not Item:
+            return super().save_formset(request, form, formset, change)
+        items = formset.save(commit=False)
+        for item in formset.deleted_objects:
+            item.delete()
+        for item in items:
+            save_item(item)
+
 
 @admin.register(Item)
-class ItemAdmin(admin.ModelAdmin):
+class ItemAdmin(StockReservationAdminMixin, admin.ModelAdmin):
+    form = ItemForm
     list_display = ['product', 'price', 'quantity', 'order']
 
+    def get_form(self, request, obj=None, **kwargs):
+        form = super().get_form(request, obj, **kwargs)
+        form.stock_error = getattr(request, 'stock_error', None)
+        return form
+
     def save_model(self, request, obj, form, change):
-        obj.update_quantity(form.cleaned_data['quantity'])
-        return super().save_model(request, obj, form, change)
+        save_item(obj)
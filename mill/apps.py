@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class MillConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mill'
+
+    def ready(self):
+        from mill import database
+        from mill.signals import handlers  # noqa: F401
+
+        database.configure_connections()
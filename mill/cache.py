@@ -0,0 +1,100 @@
+import hashlib
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+CATALOGUE_VERSION_KEY = 'mill:products:version'
+PRODUCT_VERSION_KEY = 'mill:product:{}:version'
+HITS_KEY = 'mill:products:hits'
+MISSES_KEY = 'mill:products:misses'
+TIMEOUT = 60 * 60
+
+
+def _get_version(key):
+    return cache.get_or_set(key, lambda: uuid4().hex, None)
+
+
+def invalidate_products(product_ids):
+    """Expire cached responses for these products and every list page,
+    once the current transaction commits."""
+    keys = [CATALOGUE_VERSION_KEY] + [
+        PRODUCT_VERSION_KEY.format(product_id) for product_id in product_ids
+    ]
+
+    def bump():
+        cache.set_many({key: uuid4().hex for key in keys}, None)
+
+    transaction.on_commit(bump)
+
+
+def _count(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+
+
+def get_stats():
+    stats = cache.get_many([HITS_KEY, MISSES_KEY])
+    return {
+        'hits': stats.get(HITS_KEY, 0),
+        'misses': stats.get(MISSES_KEY, 0),
+    }
+
+
+class CachedProductResponseMixin:
+    """Serve product list and detail responses from Django's cache.
+
+    Entries are keyed by a version token per product (detail) or for the
+    whole catalogue (list); writes replace the token, so stale entries are
+    never read again. The token also yields the ``ETag``.
+    """
+
+    def list(self, request, *args, **kwargs):
+        return self._get_cached_response(
+            _get_version(CATALOGUE_VERSION_KEY),
+            lambda: super(CachedProductResponseMixin, self)
+            .list(request, *args, **kwargs)
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        key = PRODUCT_VERSION_KEY.format(kwargs[self.lookup_field])
+        return self._get_cached_response(
+            _get_version(key),
+            lambda: super(CachedProductResponseMixin, self)
+            .retrieve(request, *args, **kwargs)
+        )
+
+    def _get_cached_response(self, version, get_response):
+        request = self.request
+        # as_of responses also depend on the catalogue as a whole.
+        if 'as_of' in request.query_params:
+            version += _get_version(CATALOGUE_VERSION_KEY)
+        etag = '"{}"'.format(hashlib.md5(
+            f'{version}:{request.build_absolute_uri()}'.encode()
+        ).hexdigest())
+
+        if etag in request.headers.get('If-None-Match', ''):
+            _count(HITS_KEY)
+            return Response(status=status.HTTP_304_NOT_MODIFIED,
+                            headers={'ETag': etag})
+
+        key = f'mill:products:response:{etag}'
+        data = cache.get(key)
+        if data is not None:
+            _count(HITS_KEY)
+            cache_status = 'HIT'
+            response = Response(data)
+        else:
+            _count(MISSES_KEY)
+            cache_status = 'MISS'
+            response = get_response()
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(key, response.data, TIMEOUT)
+
+        response['ETag'] = etag
+        response['X-Cache'] = cache_status
+        return response
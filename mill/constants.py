@@ -27,3 +27,21 @@ PAYMENT_METHOD_CHOICES = [
     (PAYMENT_METHOD_CREDIT_CARD, 'credit Card'),
     (PAYMENT_METHOD_BANK_TRANSFER, 'bank Transfer'),
 ]
+
+SNAPSHOT_PERIOD_DAY = 'DAY'
+SNAPSHOT_PERIOD_MONTH = 'MONTH'
+
+SNAPSHOT_PERIOD_CHOICES = [
+    (SNAPSHOT_PERIOD_DAY, 'day'),
+    (SNAPSHOT_PERIOD_MONTH, 'month'),
+]
+
+REPORT_PERIOD_DAY = 'DAY'
+REPORT_PERIOD_WEEK = 'WEEK'
+REPORT_PERIOD_MONTH = 'MONTH'
+
+REPORT_PERIOD_CHOICES = [
+    (REPORT_PERIOD_DAY, 'day'),
+    (REPORT_PERIOD_WEEK, 'week'),
+    (REPORT_PERIOD_MONTH, 'month'),
+]
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """Apply ``settings.SQLITE_PRAGMAS`` to a new SQLite connection."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def configure_connections():
+    """Configure every connection opened from now on as the settings of
+    the ``DATABASE_PROFILE`` ask."""
+    if getattr(settings, 'SQLITE_PRAGMAS', None):
+        connection_created.connect(
+            configure_sqlite, dispatch_uid='mill.database.configure_sqlite')
@@ -0,0 +1,266 @@
+import asyncio
+import json
+import operator
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import timedelta
+from functools import reduce
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from mill import models
+
+EVENT_STOCK = 'stock'
+EVENT_ORDER = 'order'
+EVENT_RESET = 'reset'
+EVENT_CHOICES = [EVENT_STOCK, EVENT_ORDER]
+# Events kept for replay to reconnecting clients.
+HISTORY_SIZE = 10000
+# Events a slow subscriber may fall behind before it is disconnected; it
+# reconnects and replays from its last event id.
+QUEUE_SIZE = 1000
+KEEPALIVE_SECONDS = 15
+RETRY_MILLISECONDS = 3000
+# Interval at which every serving process reads the new events.
+POLL_SECONDS = 0.5
+# A transaction may commit its event after a later one has: the poller
+# waits this long for a gap in the ids to fill before skipping it.
+GAP_SECONDS = 2
+# Age after which prune_events deletes events.
+RETENTION = timedelta(days=1)
+
+
+def _get_sources():
+    """Return ``{event: (queryset, key_field, fields)}`` read to publish
+    the current state of the changed rows."""
+    return {
+        EVENT_STOCK: (models.Stock.objects.all(), 'product_id',
+                      ['product_id', 'quantity', 'updated_at']),
+        EVENT_ORDER: (models.Order.objects.all(), 'id', [
+            'id', 'customer_id', 'status', 'total_amount', 'paid_amount',
+            'returned_amount', 'updated_at',
+        ]),
+    }
+
+
+class Subscription:
+    """Queue of the events published to one client, fed from any thread
+    and read on the client's event loop."""
+
+    def __init__(self, loop, size):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=size)
+        self.closed = False
+
+    def put(self, message):
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # The loop is gone with its client.
+            self.closed = True
+
+    def _put(self, message):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Too far behind: end the stream, the client replays on
+            # reconnect.
+            self.closed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class Broker:
+    """Fan the events of the ``Event`` table out to the subscribers of
+    this process.
+
+    Events are written by whichever process commits the change. A thread,
+    started with the first subscription, polls the table for new rows and
+    keeps the last ``history_size``, so a client reconnecting with its
+    ``Last-Event-ID`` replays what it missed. When they are no longer all
+    there the client gets a ``reset`` event and reloads.
+    """
+
+    def __init__(self, history_size=HISTORY_SIZE, queue_size=QUEUE_SIZE,
+                 poll_seconds=POLL_SECONDS):
+        self.number = 0
+        self.history = deque(maxlen=history_size)
+        self.subscriptions = set()
+        self.queue_size = queue_size
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.poller = None
+
+    def start(self):
+        """Start polling, once, and wait for the history to be loaded."""
+        with self.lock:
+            if self.poller is None:
+                self.poller = threading.Thread(
+                    target=self._poll, name='mill-events', daemon=True)
+                self.poller.start()
+        self.ready.wait()
+
+    def publish(self, event_id, event, data):
+        with self.lock:
+            self.number = event_id
+            message = (event_id, event, data)
+            self.history.append(message)
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.put(message)
+            if subscription.closed:
+                self.unsubscribe(subscription)
+
+    def subscribe(self, last_event_id=None):
+        """Subscribe the running event loop.
+
+        Return the subscription, the events after ``last_event_id`` to
+        replay first, and the id of the latest event. The replay is None
+        when it is incomplete.
+        """
+        subscription = Subscription(
+            asyncio.get_running_loop(), self.queue_size)
+        with self.lock:
+            replay = self._get_replay(last_event_id)
+            self.subscriptions.add(subscription)
+            return subscription, replay, self.number
+
+    def unsubscribe(self, subscription):
+        subscription.closed = True
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def _get_replay(self, last_event_id):
+        if last_event_id is None:
+            return []
+        if not last_event_id.isdigit():
+            return None
+        number = int(last_event_id)
+        oldest = self.history[0][0] if self.history else self.number + 1
+        if number > self.number or number < oldest - 1:
+            return None
+        return [message for message in self.history if message[0] > number]
+
+    def _poll(self):
+        try:
+            last = self._load_history()
+        finally:
+            self.ready.set()
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                last = self._publish_new(last)
+            except DatabaseError:
+                # Retry at the next poll, on a new connection.
+                connection.close()
+
+    def _load_history(self):
+        rows = models.Event.objects.order_by('-id')\
+            .values_list('id', 'event', 'data')[:self.history.maxlen]
+        rows = list(rows)[::-1]
+        with self.lock:
+            self.history.extend(rows)
+            if rows:
+                self.number = rows[-1][0]
+            return self.number
+
+    def _publish_new(self, last):
+        """Publish the events after ``last`` and return the last one
+        published."""
+        settled = timezone.now() - timedelta(seconds=GAP_SECONDS)
+        rows = models.Event.objects.filter(id__gt=last).order_by('id')\
+            .values_list('id', 'event', 'data', 'created_at')
+        for event_id, event, data, created_at in rows:
+            if event_id != last + 1 and created_at > settled:
+                # An earlier event may not be committed yet.
+                break
+            self.publish(event_id, event, data)
+            last = event_id
+        return last
+
+
+broker = Broker()
+
+# Keys queued by publish_on_commit(), per event.
+_pending_events = threading.local()
+
+
+def publish_on_commit(event, keys):
+    """Publish the state of the rows of ``keys`` (ids, or a queryset of
+    them) once the current transaction commits, once per row however many
+    writes of the transaction touched it.
+
+    The events are written to the ``Event`` table, from which every
+    process serving ``/events/`` reads them.
+    """
+    pending = _pending_events.__dict__.setdefault('keys', defaultdict(list))
+    pending[event].append(keys)
+
+    def flush():
+        sources = _get_sources()
+        written = []
+        for queued_event, queued in list(pending.items()):
+            del pending[queued_event]
+            queryset, key_field, fields = sources[queued_event]
+            rows = queryset.filter(reduce(operator.or_, [
+                Q(**{f'{key_field}__in': keys}) for keys in queued
+            ])).order_by().values(*fields)
+            written += [models.Event(event=queued_event, data=row)
+                        for row in rows]
+        models.Event.objects.bulk_create(written)
+
+    transaction.on_commit(flush)
+
+
+def format_event(event_id, event, data):
+    data = json.dumps(data, cls=DjangoJSONEncoder)
+    return f'id: {event_id}\nevent: {event}\ndata: {data}\n\n'
+
+
+async def stream(last_event_id=None, events=None, product_ids=None):
+    """Yield the events after ``last_event_id`` as server-sent events,
+    then every new one as it is published, optionally restricted to some
+    ``events`` and to the stock of some ``product_ids``."""
+    events = set(events or EVENT_CHOICES)
+
+    def wanted(message):
+        _, event, data = message
+        if event not in events:
+            return False
+        return event != EVENT_STOCK or product_ids is None \
+            or data['product_id'] in product_ids
+
+    await asyncio.to_thread(broker.start)
+    subscription, replay, latest_id = broker.subscribe(last_event_id)
+    try:
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'
+        if replay is None:
+            yield format_event(latest_id, EVENT_RESET, {})
+            replay = []
+        for message in replay:
+            if wanted(message):
+                yield format_event(*message)
+        while True:
+            try:
+                message = await asyncio.wait_for(
+                    subscription.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            if message is None:
+                return
+            if wanted(message):
+                yield format_event(*message)
+    finally:
+        broker.unsubscribe(subscription)
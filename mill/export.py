@@ -0,0 +1,170 @@
+import csv
+import heapq
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Concat
+
+from mill.models import Item, Order, Payment
+
+CHUNK_SIZE = 2000
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+FORMAT_CHOICES = [FORMAT_CSV, FORMAT_JSONL]
+CONTENT_TYPES = {
+    FORMAT_CSV: 'text/csv',
+    FORMAT_JSONL: 'application/x-ndjson',
+}
+
+
+def _get_customer_name(prefix=''):
+    return Concat(f'{prefix}customer__given_name', Value(' '),
+                  f'{prefix}customer__surname')
+
+
+def _get_orders():
+    return Order.objects\
+        .annotate_amounts()\
+        .annotate(customer_name=_get_customer_name())
+
+
+def _get_items():
+    return Item.objects\
+        .annotate_line_amount()\
+        .annotate(
+            customer_id=F('order__customer_id'),
+            customer_name=_get_customer_name('order__'),
+            product_name=F('product__name'),
+            returned_quantity=F('quantity') - F('net_quantity'),
+        )
+
+
+def _get_payments():
+    return Payment.objects.annotate(
+        customer_id=F('order__customer_id'),
+        customer_name=_get_customer_name('order__'),
+    )
+
+
+DATASETS = {
+    'orders': (_get_orders, [
+        'id', 'created_at', 'customer_id', 'customer_name', 'status',
+        'total_amount', 'paid_amount', 'returned_amount', 'remain_amount',
+    ]),
+    'items': (_get_items, [
+        'id', 'created_at', 'order_id', 'customer_id', 'customer_name',
+        'product_id', 'product_name', 'price', 'quantity',
+        'returned_quantity', 'net_quantity', 'line_amount',
+    ]),
+    'payments': (_get_payments, [
+        'id', 'created_at', 'order_id', 'customer_id', 'customer_name',
+        'amount', 'method', 'status',
+    ]),
+}
+
+
+def get_rows(dataset, created_after=None, created_before=None, status=None,
+             customer=None):
+    """Return the column names and a lazy iterator over the rows of a
+    dataset.
+
+    Rows are read in chunks from a server-side cursor where the database
+    supports one, so memory use does not grow with the size of the export.
+    Dates filter on each row's own ``created_at``; ``status`` and
+    ``customer`` filter on its order.
+    """
+    get_queryset, columns = DATASETS[dataset]
+    queryset = get_queryset().order_by('id')
+    order_prefix = '' if dataset == 'orders' else 'order__'
+    filters = {
+        'created_at__gte': created_after,
+        'created_at__lt': created_before,
+        f'{order_prefix}status': status,
+        f'{order_prefix}customer_id': customer,
+    }
+    queryset = queryset.filter(**{
+        lookup: value for lookup, value in filters.items() if value is not None
+    })
+    return columns, queryset.values_list(*columns).iterator(
+        chunk_size=CHUNK_SIZE)
+
+
+STATEMENT_COLUMNS = ['date', 'entry', 'reference', 'order_id', 'debit',
+                     'credit', 'balance']
+
+
+def _sum(queryset, field):
+    return queryset.aggregate(total=Sum(field))['total'] or 0
+
+
+def get_statement_rows(customer_id, since=None, until=None):
+    """Return the column names and a lazy iterator over a customer's
+    orders (debits, net of returns) and payments (credits) in date order,
+    with the running balance.
+
+    Orders and payments are read through two chunked cursors and merged,
+    so the statement is never held in memory. The balance opens at what
+    was owed on ``since``.
+    """
+    orders = Order.objects.filter(customer_id=customer_id)
+    payments = Payment.objects.filter(order__customer_id=customer_id)
+    balance = 0
+    if since is not None:
+        balance = _sum(orders.filter(created_at__lt=since), 'total_amount') \
+            - _sum(payments.filter(created_at__lt=since), 'amount')
+        orders = orders.filter(created_at__gte=since)
+        payments = payments.filter(created_at__gte=since)
+    if until is not None:
+        orders = orders.filter(created_at__lt=until)
+        payments = payments.filter(created_at__lt=until)
+
+    entries = heapq.merge(
+        (
+            (created_at, 'order', order_id, order_id, total_amount, 0)
+            for created_at, order_id, total_amount in orders
+            .values_list('created_at', 'id', 'total_amount')
+            .order_by('created_at', 'id')
+            .iterator(chunk_size=CHUNK_SIZE)
+        ),
+        (
+            (created_at, 'payment', payment_id, order_id, 0, amount)
+            for created_at, payment_id, order_id, amount in payments
+            .values_list('created_at', 'id', 'order_id', 'amount')
+            .order_by('created_at', 'id')
+            .iterator(chunk_size=CHUNK_SIZE)
+        ),
+    )
+
+    def iter_rows(balance):
+        yield (since, 'opening_balance', None, None, 0, 0, balance)
+        for entry in entries:
+            balance += entry[4] - entry[5]
+            yield entry + (balance,)
+
+    return STATEMENT_COLUMNS, iter_rows(balance)
+
+
+class _Echo:
+    """File-like object whose ``write`` hands the line back to the caller."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(columns, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_jsonl(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def iter_export(output_format, columns, rows):
+    if output_format == FORMAT_CSV:
+        return iter_csv(columns, rows)
+    return iter_jsonl(columns, rows)
@@ -0,0 +1,175 @@
+import math
+from datetime import timedelta
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from mill.models import Product, ProductRollup, ReorderSuggestion
+
+WINDOW_DAYS = 56
+MIN_WINDOW_DAYS = 28
+LEAD_TIME_DAYS = 7
+REVIEW_PERIOD_DAYS = 7
+# One-sided z-score of a 95% service level.
+SERVICE_LEVEL_Z = 1.645
+# The recent level may move this far from the 28-day mean, either way.
+MAX_TREND = 2.0
+
+
+def get_demand(product_ids, start, days):
+    """Return the daily net sales (sold less returned) of ``product_ids``
+    from ``start`` on as a ``(products, days)`` matrix, read from the
+    daily rollups in a single query."""
+    index = {product_id: row for row, product_id in enumerate(product_ids)}
+    rows = ProductRollup.objects\
+        .filter(day__gte=start, day__lt=start + timedelta(days=days))\
+        .values_list('product_id', 'day',
+                     F('units_sold') - F('units_returned'))\
+        .order_by()
+    product_rows, day_columns, quantities = [], [], []
+    for product_id, day, quantity in rows:
+        if product_id in index:
+            product_rows.append(index[product_id])
+            day_columns.append((day - start).days)
+            quantities.append(quantity)
+
+    demand = np.zeros((len(product_ids), days))
+    np.add.at(demand, (product_rows, day_columns), quantities)
+    # A day with more returns than sales is no demand, not negative demand.
+    return np.maximum(demand, 0)
+
+
+def _normal_sf(z):
+    """Upper tail of the standard normal distribution at ``z``, from the
+    Abramowitz and Stegun 7.1.26 approximation of erf (error below
+    1.5e-7)."""
+    x = np.abs(z) / math.sqrt(2)
+    t = 1 / (1 + 0.3275911 * x)
+    erfc = t * (0.254829592 + t * (-0.284496736 + t * (
+        1.421413741 + t * (-1.453152027 + t * 1.061405429)))) * np.exp(-x * x)
+    return np.where(z >= 0, erfc / 2, 1 - erfc / 2)
+
+
+def _get_days_of_cover(stock, level, factors):
+    """Return the days ``stock`` lasts at the daily ``level`` shaped by the
+    weekday ``factors`` from today on, or NaN without demand.
+
+    The factors average 1 over a week, so whole weeks use up ``7 * level``
+    each and only the last, partial week is walked day by day.
+    """
+    weekly = level * 7
+    has_demand = weekly > 0
+    weekly = np.where(has_demand, weekly, 1)
+    weeks = np.floor(stock / weekly)
+    rest = stock - weeks * weekly
+    used = level[:, None] * np.cumsum(factors, axis=1)
+    # The first day whose demand is not covered, and the part of it that is.
+    day = (used <= rest[:, None]).sum(axis=1)
+    day = np.minimum(day, 6)
+    rows = np.arange(len(day))
+    before = np.where(day > 0, used[rows, day - 1], 0)
+    demand = level * factors[rows, day]
+    part = np.divide(rest - before, demand,
+                     out=np.zeros_like(rest), where=demand > 0)
+    return np.where(has_demand, weeks * 7 + day + part, np.nan)
+
+
+def forecast(stock, demand, lead_time=LEAD_TIME_DAYS,
+             review_period=REVIEW_PERIOD_DAYS):
+    """Forecast every product at once from its ``stock`` vector and the
+    ``demand`` matrix of the days up to yesterday.
+
+    The daily level is the 7-day mean, kept within ``MAX_TREND`` of the
+    28-day mean, scaled by the weekday seasonality of the days ahead.
+    Enough is reordered to cover the lead time and the review period with
+    safety stock for the service level, and the stock-out risk is the
+    chance that lead-time demand exceeds the stock.
+    """
+    days = demand.shape[1]
+    average_7 = demand[:, -7:].mean(axis=1)
+    average_28 = demand[:, -28:].mean(axis=1)
+    level = np.clip(average_7, average_28 / MAX_TREND,
+                    average_28 * MAX_TREND)
+    deviation = demand[:, -28:].std(axis=1)
+
+    # Weekday means over whole weeks only, relative to the overall mean.
+    weeks = demand[:, days - days // 7 * 7:]
+    weekday_means = weeks.reshape(len(weeks), -1, 7).mean(axis=1)
+    overall = weekday_means.mean(axis=1, keepdims=True)
+    factors = np.divide(weekday_means, overall,
+                        out=np.ones_like(weekday_means), where=overall > 0)
+    # ``weeks`` ends yesterday, so column c of ``factors`` falls on the
+    # weekday of today + c days.
+    horizon = lead_time + review_period
+    ahead = np.arange(horizon) % 7
+    seasonality = factors[:, ahead].mean(axis=1)
+    lead_seasonality = factors[:, ahead[:lead_time]].mean(axis=1)
+
+    rate = level * seasonality
+    forecast_demand = rate * horizon
+    target = forecast_demand + SERVICE_LEVEL_Z * deviation * math.sqrt(horizon)
+    reorder_quantity = np.ceil(np.maximum(target - stock, 0)).astype(int)
+
+    lead_demand = level * lead_seasonality * lead_time
+    lead_deviation = deviation * math.sqrt(lead_time)
+    z = np.divide(stock - lead_demand, lead_deviation,
+                  out=np.zeros_like(lead_demand), where=lead_deviation > 0)
+    stockout_risk = np.where(lead_deviation > 0, _normal_sf(z),
+                             (lead_demand > stock).astype(float))
+    days_of_cover = _get_days_of_cover(np.maximum(stock, 0), level, factors)
+
+    return {
+        'average_demand_7': average_7,
+        'average_demand_28': average_28,
+        'seasonality': seasonality,
+        'forecast_demand': forecast_demand,
+        'days_of_cover': days_of_cover,
+        'reorder_quantity': reorder_quantity,
+        'stockout_risk': stockout_risk,
+    }
+
+
+def refresh_suggestions(window=WINDOW_DAYS, lead_time=LEAD_TIME_DAYS,
+                        review_period=REVIEW_PERIOD_DAYS):
+    """Forecast every product from the last ``window`` complete days and
+    store its reorder suggestion. Return the number of products."""
+    if window < MIN_WINDOW_DAYS:
+        raise ValueError(f'The window must be at least {MIN_WINDOW_DAYS} '
+                         f'days.')
+    now = timezone.now()
+    start = timezone.localdate(now) - timedelta(days=window)
+    products = list(Product.objects
+                    .get_product_with_quantity_in_stock()
+                    .values_list('id', 'quantity_in_stock')
+                    .order_by())
+    if not products:
+        return 0
+    product_ids = [product_id for product_id, _ in products]
+    stock = np.array([quantity for _, quantity in products], dtype=float)
+
+    results = forecast(stock, get_demand(product_ids, start, window),
+                       lead_time, review_period)
+    suggestions = [
+        ReorderSuggestion(
+            product_id=product_id,
+            quantity_in_stock=int(stock[row]),
+            computed_at=now,
+            **{
+                field: None if np.isnan(values[row]) else values[row].item()
+                for field, values in results.items()
+            },
+        )
+        for row, product_id in enumerate(product_ids)
+    ]
+
+    with transaction.atomic():
+        ReorderSuggestion.objects.bulk_create(
+            suggestions,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['product'],
+            update_fields=['quantity_in_stock', 'computed_at', *results],
+        )
+    return len(suggestions)
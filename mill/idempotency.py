@@ -0,0 +1,83 @@
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from rest_framework import exceptions, status
+from rest_framework.response import Response
+
+from mill.models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+# Keys older than this are pruned, after which a retry posts again.
+RETENTION = timedelta(days=1)
+
+
+class IdempotencyKeyReused(exceptions.APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'This Idempotency-Key was sent with another request.'
+    default_code = 'idempotency_key_reused'
+
+
+def get_fingerprint(request):
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+    payload = json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.sha256(
+        f'{request.method} {request.path}\n{payload}'.encode()).hexdigest()
+
+
+def _replay(stored, fingerprint):
+    if stored.fingerprint != fingerprint:
+        raise IdempotencyKeyReused()
+    response = Response(stored.response, status=stored.status_code)
+    response[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def idempotent(view_method):
+    """Make a write view safe to retry with an ``Idempotency-Key`` header.
+
+    The first successful response is stored with the key in the same
+    transaction as the write, so it is either recorded with its effects or
+    not at all; a retry with the key replays it without writing again. Of
+    two concurrent requests with one key, the second fails on the unique
+    key once the first commits, rolls back and replays the first.
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            raise exceptions.ValidationError({HEADER: [
+                f'Ensure this value has at most {MAX_KEY_LENGTH} '
+                f'characters.']})
+
+        fingerprint = get_fingerprint(request)
+        keys = IdempotencyKey.objects.filter(user=request.user, key=key)
+        stored = keys.first()
+        if stored is not None:
+            return _replay(stored, fingerprint)
+        try:
+            with transaction.atomic():
+                response = view_method(self, request, *args, **kwargs)
+                if status.is_success(response.status_code):
+                    IdempotencyKey.objects.create(
+                        user=request.user, key=key, fingerprint=fingerprint,
+                        status_code=response.status_code,
+                        response=response.data,
+                    )
+                return response
+        except IntegrityError:
+            stored = keys.first()
+            if stored is None:
+                raise
+        return _replay(stored, fingerprint)
+
+    return wrapper
@@ -0,0 +1,143 @@
+import csv
+import io
+import json
+
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from mill.models import (Product, ProductCost, ProductRollup, Production,
+                         Purchase, Stock, StockSnapshot)
+from mill.serializers import (ProductionImportSerializer,
+                              PurchaseImportSerializer)
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+FORMAT_CHOICES = [FORMAT_CSV, FORMAT_JSONL]
+
+# Model, row serializer and date field of each importable movement.
+MOVEMENTS = {
+    'purchases': (Purchase, PurchaseImportSerializer, 'purchase_date'),
+    'productions': (Production, ProductionImportSerializer, 'production_date'),
+}
+
+
+def get_format(filename, default=FORMAT_CSV):
+    for input_format in FORMAT_CHOICES:
+        if filename and filename.lower().endswith(f'.{input_format}'):
+            return input_format
+    return default
+
+
+def iter_records(file, input_format):
+    """Yield ``(line_number, record)`` from a binary file, one line at a
+    time. Lines that cannot be parsed yield an error string instead."""
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    if input_format == FORMAT_CSV:
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, {
+                key: value for key, value in record.items()
+                if key is not None and value != ''
+            }
+        return
+
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, f'Invalid JSON: {e}.'
+            continue
+        if not isinstance(record, dict):
+            record = 'Expected a JSON object.'
+        yield line_number, record
+
+
+class Import:
+    """Validate and insert purchase or production rows in batches.
+
+    Every batch is one transaction: a bulk_create, then one ledger update
+    and one snapshot shift for all its rows, which also expires the cached
+    products once. Rows failing validation are skipped and reported by
+    line number.
+    """
+
+    def __init__(self, kind, batch_size=BATCH_SIZE):
+        self.model, serializer_class, self.date_field = MOVEMENTS[kind]
+        self.serializer = serializer_class()
+        self.batch_size = batch_size
+        self.product_ids = set(Product.objects.values_list('id', flat=True))
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def run(self, records):
+        batch = []
+        for line_number, record in records:
+            instance = self.validate(line_number, record)
+            if instance is not None:
+                batch.append(instance)
+            if len(batch) >= self.batch_size:
+                self.insert(batch)
+                batch = []
+        self.insert(batch)
+        return self.get_report()
+
+    def validate(self, line_number, record):
+        if isinstance(record, str):
+            return self.add_error(line_number, {'non_field_errors': [record]})
+        try:
+            data = self.serializer.run_validation(record)
+        except serializers.ValidationError as e:
+            return self.add_error(line_number, e.detail)
+
+        product_id = data.pop('product')
+        if product_id not in self.product_ids:
+            return self.add_error(line_number, {
+                'product': [f'Invalid pk "{product_id}" - object does not exist.']
+            })
+        return self.model(product_id=product_id, **data)
+
+    def add_error(self, line_number, errors):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line_number, 'errors': errors})
+
+    def insert(self, batch):
+        if not batch:
+            return
+        deltas = {}
+        for instance in batch:
+            deltas[instance.product_id] = \
+                deltas.get(instance.product_id, 0) + instance.quantity
+
+        with transaction.atomic():
+            self.model.objects.bulk_create(batch)
+            Stock.objects.adjust(deltas)
+            StockSnapshot.objects.shift_many([
+                (instance.product_id, getattr(instance, self.date_field),
+                 instance.quantity)
+                for instance in batch
+            ])
+            ProductCost.objects.receive([
+                (instance.product_id, instance.quantity,
+                 getattr(instance, 'purchase_unit_price', None))
+                for instance in batch
+            ])
+            ProductRollup.objects.refresh_on_commit(
+                {(instance.product_id,
+                  timezone.localdate(getattr(instance, self.date_field)))
+                 for instance in batch},
+                self.model)
+        self.imported += len(batch)
+
+    def get_report(self):
+        return {
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
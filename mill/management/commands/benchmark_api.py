@@ -0,0 +1,134 @@
+import json
+import logging
+import platform
+import time
+
+import django
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from rest_framework.test import APIClient
+
+from core.models import User
+from mill.models import Customer, Item, Order, Payment, Product, Return
+
+USERNAME = 'benchmark'
+
+
+def get_percentile(timings, percentile):
+    ordered = sorted(timings)
+    index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def clean_up(user, customer):
+    """Delete what the benchmark wrote; the signals put the stock back."""
+    with transaction.atomic():
+        orders = Order.objects.filter(customer=customer)
+        Payment.objects.filter(order__in=orders).delete()
+        Item.objects.filter(order__in=orders).delete()
+        orders.delete()
+    # Once the rollups of the customer have been refreshed on commit.
+    customer.delete()
+    user.delete()
+
+
+class Command(BaseCommand):
+    help = 'Time the hot API endpoints and print p50/p95/p99 latency as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50,
+                            help='Requests per endpoint.')
+        parser.add_argument('--cold', action='store_true',
+                            help='Clear the cache before every request.')
+        parser.add_argument('--output', help='Write the JSON report here.')
+
+    def handle(self, *args, **options):
+        order = Order.objects.filter(items__returns__isnull=False).first()
+        if order is None:
+            raise CommandError('No data to benchmark, run generate_data first.')
+
+        # One log line per request would dominate the timings.
+        logging.getLogger('mill.middleware').setLevel(logging.WARNING)
+        dataset = {
+            'products': Product.objects.count(),
+            'orders': Order.objects.count(),
+            'items': Item.objects.count(),
+            'returns': Return.objects.count(),
+        }
+        # The writes commit, with their on-commit work (rollups, events,
+        # cache versions), on an order of the benchmark's own that is
+        # deleted afterwards.
+        user = User.objects.create_superuser(
+            USERNAME, f'{USERNAME}@bleman.local', None)
+        customer = Customer.objects.create(
+            given_name='benchmark', surname='benchmark', phone_number='0')
+        try:
+            report = self.run(user, order, Order.objects.create(
+                customer=customer), options)
+        finally:
+            clean_up(user, customer)
+        report['dataset'] = dataset
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        self.stdout.write(output)
+
+    def run(self, user, order, written_order, options):
+        client = APIClient(HTTP_HOST='localhost')
+        client.force_authenticate(user)
+
+        item = order.items.filter(returns__isnull=False).first()
+        product = Product.objects\
+            .get_product_with_quantity_in_stock()\
+            .order_by('-quantity_in_stock')\
+            .first()
+        endpoints = {
+            'products.list': ('get', '/products/', None),
+            'products.retrieve': ('get', f'/products/{product.id}/', None),
+            'orders.list': ('get', '/orders/', None),
+            'orders.retrieve': ('get', f'/orders/{order.id}/', None),
+            'items.list': ('get', f'/orders/{order.id}/items/', None),
+            'payments.list': ('get', f'/orders/{order.id}/payments/', None),
+            'returns.list': (
+                'get', f'/orders/{order.id}/items/{item.id}/returns/', None),
+            'items.create': ('post', f'/orders/{written_order.id}/items/',
+                             {'product': product.id, 'quantity': 1}),
+            'payments.create': ('post',
+                                f'/orders/{written_order.id}/payments/',
+                                {'amount': 1}),
+        }
+
+        results = {}
+        for name, (method, url, data) in endpoints.items():
+            timings, queries = [], []
+            for _ in range(options['requests']):
+                if options['cold']:
+                    cache.clear()
+                start = time.perf_counter()
+                response = getattr(client, method)(url, data, format='json')
+                timings.append((time.perf_counter() - start) * 1000)
+                if response.status_code >= 400:
+                    raise CommandError(
+                        f'{name} returned {response.status_code}: '
+                        f'{response.content[:200]}')
+                queries.append(int(response['X-Query-Count']))
+            results[name] = {
+                'requests': len(timings),
+                'p50_ms': round(get_percentile(timings, 50), 3),
+                'p95_ms': round(get_percentile(timings, 95), 3),
+                'p99_ms': round(get_percentile(timings, 99), 3),
+                'queries_per_request': sum(queries) / len(queries),
+            }
+
+        return {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'cold_cache': options['cold'],
+            },
+            'endpoints': results,
+        }
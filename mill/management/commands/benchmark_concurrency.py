@@ -0,0 +1,182 @@
+import json
+import logging
+import platform
+import random
+import threading
+import time
+from collections import defaultdict
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework.test import APIClient
+
+from core.models import User
+from mill.management.commands.benchmark_api import clean_up, get_percentile
+from mill.models import Customer, Order, Product
+
+USERNAME = 'benchmark-concurrency'
+
+
+def get_database_profile():
+    """Describe the database settings the benchmark ran with."""
+    database = connection.settings_dict
+    profile = {
+        'vendor': connection.vendor,
+        'profile': getattr(settings, 'DATABASE_PROFILE', None),
+        'conn_max_age': database['CONN_MAX_AGE'],
+        'pool': bool(database.get('OPTIONS', {}).get('pool')),
+    }
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            for pragma in ['journal_mode', 'synchronous', 'busy_timeout']:
+                cursor.execute(f'PRAGMA {pragma}')
+                profile[pragma] = cursor.fetchone()[0]
+    return profile
+
+
+def run_traffic(user, orders, products, threads, requests_per_thread,
+                write_ratio, seed):
+    """Have ``threads`` clients send a mix of reads and writes to the API
+    at once, each on its own connection, and time every request."""
+    timings = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    lock = threading.Lock()
+
+    def client_thread(index):
+        rng = random.Random(seed + index)
+        client = APIClient(HTTP_HOST='localhost',
+                           raise_request_exception=False)
+        client.force_authenticate(user)
+        try:
+            for _ in range(requests_per_thread):
+                order, product = rng.choice(orders), rng.choice(products)
+                if rng.random() < write_ratio:
+                    name, method, url, data = rng.choice([
+                        ('items.create', 'post', f'/orders/{order}/items/',
+                         {'product': product, 'quantity': 1}),
+                        ('payments.create', 'post',
+                         f'/orders/{order}/payments/', {'amount': 1}),
+                    ])
+                else:
+                    name, method, url, data = rng.choice([
+                        ('products.list', 'get', '/products/', None),
+                        ('products.retrieve', 'get', f'/products/{product}/',
+                         None),
+                        ('orders.retrieve', 'get', f'/orders/{order}/', None),
+                        ('items.list', 'get', f'/orders/{order}/items/',
+                         None),
+                    ])
+                start = time.perf_counter()
+                response = getattr(client, method)(url, data, format='json')
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    timings[name].append(elapsed)
+                    statuses[name][response.status_code] += 1
+        finally:
+            connection.close()
+
+    workers = [
+        threading.Thread(target=client_thread, args=(index,))
+        for index in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return timings, statuses, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = ('Send mixed read/write API traffic from concurrent clients and '
+            'print throughput and latency per endpoint as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--requests-per-thread', type=int, default=100)
+        parser.add_argument('--write-ratio', type=float, default=0.2,
+                            help='Share of the requests that write.')
+        parser.add_argument('--orders', type=int, default=20,
+                            help='Orders the writes are spread over.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON report here.')
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the orders written instead of deleting them.')
+
+    def handle(self, *args, **options):
+        products = list(
+            Product.objects
+            .get_product_with_quantity_in_stock()
+            .filter(quantity_in_stock__gt=0)
+            .order_by('-quantity_in_stock')
+            .values_list('id', flat=True)[:50]
+        )
+        if not products:
+            raise CommandError('No stock to sell, run generate_data first.')
+
+        # One log line per request would dominate the timings.
+        logging.getLogger('mill.middleware').setLevel(logging.WARNING)
+        user = User.objects.create_superuser(
+            USERNAME, f'{USERNAME}@bleman.local', None)
+        customer = Customer.objects.create(
+            given_name='benchmark', surname='benchmark', phone_number='0')
+        orders = [
+            Order.objects.create(customer=customer).pk
+            for _ in range(options['orders'])
+        ]
+        try:
+            timings, statuses, seconds = run_traffic(
+                user, orders, products,
+                threads=options['threads'],
+                requests_per_thread=options['requests_per_thread'],
+                write_ratio=options['write_ratio'],
+                seed=options['seed'],
+            )
+        finally:
+            if not options['keep']:
+                clean_up(user, customer)
+
+        report = self.get_report(timings, statuses, seconds, options)
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        self.stdout.write(output)
+
+    def get_report(self, timings, statuses, seconds, options):
+        endpoints = {}
+        for name, values in timings.items():
+            endpoints[name] = {
+                'requests': len(values),
+                'p50_ms': round(get_percentile(values, 50), 3),
+                'p95_ms': round(get_percentile(values, 95), 3),
+                'p99_ms': round(get_percentile(values, 99), 3),
+                'statuses': dict(statuses[name]),
+            }
+        requests = sum(len(values) for values in timings.values())
+        return {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': get_database_profile(),
+            },
+            'traffic': {
+                'threads': options['threads'],
+                'write_ratio': options['write_ratio'],
+                'orders': options['orders'],
+            },
+            'requests': requests,
+            'seconds': round(seconds, 3),
+            'requests_per_second': round(requests / seconds, 1)
+            if seconds else 0,
+            # Server errors, e.g. "database is locked" when a writer waited
+            # longer than the busy timeout.
+            'errors': sum(
+                count for codes in statuses.values()
+                for code, count in codes.items() if code >= 500
+            ),
+            'endpoints': endpoints,
+        }
@@ -0,0 +1,130 @@
+import json
+import time
+
+from django.db import transaction
+from django.db.models import Sum, Value
+from django.db.models.functions import Coalesce
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mill.models import (Customer, Item, Order, Product, Production, Purchase,
+                         Return)
+
+
+class Rollback(Exception):
+    pass
+
+
+def get_joined_queryset():
+    """The original four-way JOIN annotation, kept for comparison."""
+    return Product.objects.annotate(
+        quantity_in_stock=(
+            Coalesce(Sum('purchases__quantity'), Value(0)) +
+            Coalesce(Sum('productions__quantity'), Value(0)) -
+            Coalesce(Sum('items__quantity'), Value(0)) +
+            Coalesce(Sum('items__returns__quantity'), Value(0))
+        )
+    )
+
+
+def get_subquery_queryset():
+    return Product.objects.annotate_quantity_in_stock()
+
+
+def time_queryset(queryset, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = dict(queryset.values_list('id', 'quantity_in_stock'))
+        timings.append(time.perf_counter() - start)
+    return min(timings), rows
+
+
+class Command(BaseCommand):
+    help = 'Compare the JOIN and subquery stock annotations as history grows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10)
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[1, 5, 10, 20],
+            help='Rows per product and per relation at each step.'
+        )
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--json', action='store_true')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                results = self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(
+            f"{'rows':>6} {'join (ms)':>10} {'subquery (ms)':>14} {'join correct':>13}")
+        for result in results:
+            self.stdout.write(
+                f"{result['rows_per_relation']:>6} "
+                f"{result['join_ms']:>10.2f} "
+                f"{result['subquery_ms']:>14.2f} "
+                f"{str(result['join_correct']):>13}"
+            )
+
+    def run(self, options):
+        now = timezone.now()
+        products = Product.objects.bulk_create([
+            Product(name=f'benchmark {i}', purchase_price=1, customer_price=2)
+            for i in range(options['products'])
+        ])
+        customer = Customer.objects.create(
+            given_name='benchmark', surname='benchmark', phone_number='0')
+
+        results = []
+        rows = 0
+        queryset_filter = {'id__in': [product.id for product in products]}
+        for size in sorted(options['sizes']):
+            self.grow_history(products, customer, size - rows, now)
+            rows = size
+
+            join_time, join_rows = time_queryset(
+                get_joined_queryset().filter(**queryset_filter),
+                options['repeat'])
+            subquery_time, subquery_rows = time_queryset(
+                get_subquery_queryset().filter(**queryset_filter),
+                options['repeat'])
+
+            results.append({
+                'products': len(products),
+                'rows_per_relation': size,
+                'join_ms': join_time * 1000,
+                'subquery_ms': subquery_time * 1000,
+                'join_correct': join_rows == subquery_rows,
+            })
+        return results
+
+    def grow_history(self, products, customer, count, now):
+        if count <= 0:
+            return
+        Purchase.objects.bulk_create([
+            Purchase(product=product, purchase_unit_price=1,
+                     quantity=3, purchase_date=now)
+            for product in products for _ in range(count)
+        ])
+        Production.objects.bulk_create([
+            Production(product=product, quantity=2, production_date=now)
+            for product in products for _ in range(count)
+        ])
+        orders = Order.objects.bulk_create([
+            Order(customer=customer) for _ in range(count)
+        ])
+        items = Item.objects.bulk_create([
+            Item(order=order, product=product, price=1, quantity=2)
+            for product in products for order in orders
+        ])
+        Return.objects.bulk_create([
+            Return(item=item, quantity=1) for item in items
+        ])
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+
+from mill.models import Order
+
+
+class Command(BaseCommand):
+    help = ('Detect orders whose stored totals or status drifted and '
+            'optionally repair them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Recompute the stored totals and status of drifted orders.'
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Recompute every order in one UPDATE without looking for '
+                 'drift first.'
+        )
+
+    def handle(self, *args, **options):
+        if options['all']:
+            repaired = Order.objects.refresh_amounts()
+            self.stdout.write(self.style.SUCCESS(
+                f'Recomputed {repaired} order(s).'))
+            return
+
+        drifted = list(
+            Order.objects
+            .annotate_computed_amounts()
+            .exclude(
+                total_amount=F('computed_total_amount'),
+                paid_amount=F('computed_paid_amount'),
+                returned_amount=F('computed_returned_amount'),
+                status=F('computed_status'),
+            )
+            .values_list('id', flat=True)
+        )
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('Order totals are in sync.'))
+            return
+
+        if not options['fix']:
+            for order_id in drifted:
+                self.stdout.write(f'order {order_id} out of sync')
+            raise CommandError(f'{len(drifted)} order(s) out of sync.')
+
+        for start in range(0, len(drifted), 500):
+            Order.objects\
+                .filter(pk__in=drifted[start:start + 500])\
+                .refresh_amounts()
+        self.stdout.write(self.style.SUCCESS(
+            f'Repaired {len(drifted)} order(s).'))
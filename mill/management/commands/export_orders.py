@@ -0,0 +1,49 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mill import export
+from mill.serializers import ExportSerializer
+
+
+class Command(BaseCommand):
+    help = 'Stream orders, items or payments as CSV or JSON lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', choices=list(export.DATASETS),
+                            default='orders')
+        parser.add_argument('--output', choices=export.FORMAT_CHOICES,
+                            default=export.FORMAT_CSV)
+        parser.add_argument('--created-after',
+                            help='Only rows created at or after this date.')
+        parser.add_argument('--created-before',
+                            help='Only rows created before this date.')
+        parser.add_argument('--status', help='Only rows of orders in this status.')
+        parser.add_argument('--customer', type=int,
+                            help='Only rows of this customer.')
+        parser.add_argument('--file', help='Write here instead of stdout.')
+
+    def handle(self, *args, **options):
+        serializer = ExportSerializer(data={
+            key: options[key] for key in [
+                'dataset', 'output', 'created_after', 'created_before',
+                'status', 'customer',
+            ] if options[key] is not None
+        })
+        if not serializer.is_valid():
+            raise CommandError('; '.join(
+                f'{field}: {" ".join(errors)}'
+                for field, errors in serializer.errors.items()
+            ))
+        params = dict(serializer.validated_data)
+        dataset, output = params.pop('dataset'), params.pop('output')
+
+        columns, rows = export.get_rows(dataset, **params)
+        file = open(options['file'], 'w', newline='') \
+            if options['file'] else sys.stdout
+        try:
+            for chunk in export.iter_export(output, columns, rows):
+                file.write(chunk)
+        finally:
+            if options['file']:
+                file.close()
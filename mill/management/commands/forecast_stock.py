@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mill import forecasting
+
+
+class Command(BaseCommand):
+    help = 'Forecast product demand and refresh the reorder suggestions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--window', type=int, default=forecasting.WINDOW_DAYS,
+            help='Days of sales history to forecast from.'
+        )
+        parser.add_argument(
+            '--lead-time', type=int, default=forecasting.LEAD_TIME_DAYS,
+            help='Days between ordering and receiving stock.'
+        )
+        parser.add_argument(
+            '--review-period', type=int,
+            default=forecasting.REVIEW_PERIOD_DAYS,
+            help='Days until the next reorder review.'
+        )
+
+    def handle(self, *args, **options):
+        if options['lead_time'] < 1 or options['review_period'] < 0:
+            raise CommandError(
+                '--lead-time must be positive and --review-period not '
+                'negative.')
+        try:
+            count = forecasting.refresh_suggestions(
+                window=options['window'],
+                lead_time=options['lead_time'],
+                review_period=options['review_period'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f'Forecast {count} product(s).'))
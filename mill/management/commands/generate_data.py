@@ -0,0 +1,220 @@
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from mill import constants, forecasting
+from mill.models import (Customer, CustomerBalance, CustomerRollup, Item,
+                         Order, Payment, Product, ProductCost, ProductRollup,
+                         Production, Purchase, Return, Stock)
+
+TIMESTAMP_FIELDS = ['created_at', 'updated_at', 'return_date']
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Let bulk_create keep the timestamps set on the instances instead of
+    stamping ``auto_now``/``auto_now_add`` fields with the current time."""
+    saved = []
+    for model in models:
+        for field in model._meta.concrete_fields:
+            if field.name in TIMESTAMP_FIELDS:
+                saved.append((field, field.auto_now, field.auto_now_add))
+                field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = 'Generate a reproducible synthetic dataset for benchmarks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--products', type=int, default=100)
+        parser.add_argument('--customers', type=int, default=500)
+        parser.add_argument('--orders', type=int, default=10000)
+        parser.add_argument('--max-items-per-order', type=int, default=8)
+        parser.add_argument('--supplier-ratio', type=float, default=0.1)
+        parser.add_argument('--return-ratio', type=float, default=0.05)
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.now = timezone.now()
+        self.days = options['days']
+        self.batch_size = options['batch_size']
+
+        with explicit_timestamps(Product, Customer, Purchase, Production,
+                                 Order, Item, Return, Payment):
+            with transaction.atomic():
+                products = self.create_products(options['products'])
+                customers = self.create_customers(
+                    options['customers'], options['supplier_ratio'])
+                sold = self.create_orders(
+                    options['orders'], products, customers,
+                    options['max_items_per_order'], options['return_ratio'])
+                self.create_supply(products, sold)
+                Stock.objects.rebuild()
+                CustomerBalance.objects.rebuild()
+                ProductCost.objects.rebuild()
+                ProductRollup.objects.rebuild()
+                CustomerRollup.objects.rebuild()
+                forecasting.refresh_suggestions()
+
+        self.stdout.write(self.style.SUCCESS('Generated {}.'.format(', '.join(
+            f'{model.objects.count()} {model._meta.verbose_name_plural}'
+            for model in [Product, Customer, Purchase, Production, Order,
+                          Item, Return, Payment]
+        ))))
+
+    def random_date(self, after=None):
+        start = after or self.now - timedelta(days=self.days)
+        return start + (self.now - start) * self.rng.random()
+
+    def create_products(self, count):
+        products = []
+        for index in range(count):
+            purchase_price = self.rng.randint(100, 5000)
+            created_at = self.now - timedelta(days=self.days)
+            products.append(Product(
+                name=f'Product {index:05d}',
+                purchase_price=purchase_price,
+                customer_price=int(purchase_price * self.rng.uniform(1.1, 1.6)),
+                created_at=created_at,
+                updated_at=created_at,
+            ))
+        return Product.objects.bulk_create(products, batch_size=self.batch_size)
+
+    def create_customers(self, count, supplier_ratio):
+        customers = []
+        for index in range(count):
+            created_at = self.random_date()
+            customers.append(Customer(
+                given_name=f'Given {index}',
+                surname=f'Surname {index:06d}',
+                phone_number=f'77{self.rng.randint(0, 9999999):07d}',
+                is_supplier=self.rng.random() < supplier_ratio,
+                created_at=created_at,
+                updated_at=created_at,
+            ))
+        return Customer.objects.bulk_create(
+            customers, batch_size=self.batch_size)
+
+    def create_orders(self, count, products, customers, max_items,
+                      return_ratio):
+        sold = {product.id: 0 for product in products}
+        for start in range(0, count, self.batch_size):
+            size = min(self.batch_size, count - start)
+            orders, lines = [], []
+            for _ in range(size):
+                customer = self.rng.choice(customers)
+                created_at = self.random_date(customer.created_at)
+                order = Order(customer=customer, created_at=created_at,
+                              updated_at=created_at)
+                order_lines = []
+                for product in self.rng.sample(
+                        products, self.rng.randint(1, min(max_items, len(products)))):
+                    quantity = self.rng.randint(1, 20)
+                    price = product.purchase_price if customer.is_supplier \
+                        else product.customer_price
+                    returned = self.rng.randint(1, quantity) \
+                        if quantity > 1 and self.rng.random() < return_ratio \
+                        else 0
+                    order_lines.append((product, quantity, price, returned))
+                    sold[product.id] += quantity - returned
+                self.set_amounts(order, order_lines)
+                orders.append(order)
+                lines.append(order_lines)
+
+            orders = Order.objects.bulk_create(orders)
+            self.create_items(orders, lines)
+        return sold
+
+    def set_amounts(self, order, lines):
+        gross_amount = sum(quantity * price for _, quantity, price, _ in lines)
+        order.returned_amount = sum(
+            returned * price for _, _, price, returned in lines)
+        order.total_amount = gross_amount - order.returned_amount
+
+        roll = self.rng.random()
+        if roll < 0.6:
+            order.paid_amount = order.total_amount
+        elif roll < 0.8:
+            order.paid_amount = self.rng.randint(1, max(order.total_amount - 1, 1))
+        else:
+            order.paid_amount = 0
+
+        # The same rule as OrderQuerySet.refresh_amounts().
+        if not order.paid_amount:
+            order.status = constants.ORDER_STATUS_UNPAID
+        elif order.paid_amount >= order.total_amount:
+            order.status = constants.ORDER_STATUS_PAID
+        else:
+            order.status = constants.ORDER_STATUS_REMAIN
+
+    def create_items(self, orders, lines):
+        items, returns, payments = [], [], []
+        for order, order_lines in zip(orders, lines):
+            for product, quantity, price, returned in order_lines:
+                item = Item(order=order, product=product, quantity=quantity,
+                            price=price, created_at=order.created_at,
+                            updated_at=order.created_at)
+                items.append((item, returned))
+            if order.paid_amount:
+                paid_at = self.random_date(order.created_at)
+                payments.append(Payment(
+                    order=order,
+                    amount=order.paid_amount,
+                    method=self.rng.choice(constants.PAYMENT_METHOD_CHOICES)[0],
+                    created_at=paid_at,
+                    updated_at=paid_at,
+                ))
+
+        Item.objects.bulk_create([item for item, _ in items])
+        for item, returned in items:
+            if returned:
+                returned_at = self.random_date(item.created_at)
+                returns.append(Return(
+                    item=item, quantity=returned, return_date=returned_at,
+                    created_at=returned_at, updated_at=returned_at))
+        Return.objects.bulk_create(returns)
+        Payment.objects.bulk_create(payments)
+
+    def create_supply(self, products, sold):
+        """Purchase and produce enough of every product to cover its sales
+        with some stock left over."""
+        purchases, productions = [], []
+        for product in products:
+            supply = sold[product.id] + self.rng.randint(50, 500)
+            batches = self.rng.randint(1, 12)
+            for batch in range(batches):
+                quantity = supply // batches + (batch < supply % batches)
+                if not quantity:
+                    continue
+                moved_at = self.random_date()
+                if self.rng.random() < 0.5:
+                    purchases.append(Purchase(
+                        product=product,
+                        purchase_unit_price=product.purchase_price,
+                        quantity=quantity,
+                        purchase_date=moved_at,
+                        created_at=moved_at,
+                        updated_at=moved_at,
+                    ))
+                else:
+                    productions.append(Production(
+                        product=product,
+                        quantity=quantity,
+                        production_date=moved_at,
+                        created_at=moved_at,
+                        updated_at=moved_at,
+                    ))
+        Purchase.objects.bulk_create(purchases, batch_size=self.batch_size)
+        Production.objects.bulk_create(productions, batch_size=self.batch_size)
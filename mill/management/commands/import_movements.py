@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mill import importer
+
+
+class Command(BaseCommand):
+    help = 'Import purchases or productions from a CSV or JSON-lines file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=list(importer.MOVEMENTS))
+        parser.add_argument('file')
+        parser.add_argument('--input', choices=importer.FORMAT_CHOICES,
+                            help='File format, guessed from the extension '
+                                 'by default.')
+        parser.add_argument('--batch-size', type=int,
+                            default=importer.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        input_format = options['input'] or importer.get_format(options['file'])
+        run = importer.Import(options['kind'], options['batch_size'])
+        with open(options['file'], 'rb') as file:
+            report = run.run(importer.iter_records(file, input_format))
+
+        for error in report['errors']:
+            self.stderr.write(f"line {error['line']}: {json.dumps(error['errors'])}")
+        message = f"Imported {report['imported']} {options['kind']}."
+        if report['failed']:
+            raise CommandError(f"{message} {report['failed']} row(s) failed.")
+        self.stdout.write(self.style.SUCCESS(message))
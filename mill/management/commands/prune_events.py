@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mill import events
+from mill.models import Event
+
+
+class Command(BaseCommand):
+    help = 'Delete the live events older than their retention.'
+
+    def handle(self, *args, **options):
+        deleted, _ = Event.objects\
+            .filter(created_at__lt=timezone.now() - events.RETENTION)\
+            .delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Pruned {deleted} event(s).'))
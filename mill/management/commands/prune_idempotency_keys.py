@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mill import idempotency
+from mill.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Delete the idempotency keys older than their retention.'
+
+    def handle(self, *args, **options):
+        deleted, _ = IdempotencyKey.objects\
+            .filter(created_at__lt=timezone.now() - idempotency.RETENTION)\
+            .delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Pruned {deleted} idempotency key(s).'))
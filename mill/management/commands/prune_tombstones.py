@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mill import sync
+from mill.models import Tombstone
+
+
+class Command(BaseCommand):
+    help = 'Delete the tombstones older than the sync token retention.'
+
+    def handle(self, *args, **options):
+        deleted, _ = Tombstone.objects\
+            .filter(deleted_at__lt=timezone.now() - sync.RETENTION)\
+            .delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Pruned {deleted} tombstone(s).'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from mill.models import CustomerRollup, ProductCost, ProductRollup
+
+
+class Command(BaseCommand):
+    help = 'Replay the stock history to recompute the weighted-average costs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--product',
+            type=int,
+            action='append',
+            dest='product_ids',
+            help='Restrict to this product id (repeatable).'
+        )
+
+    def handle(self, *args, **options):
+        ProductCost.objects.rebuild(product_ids=options['product_ids'])
+        # The rollups hold the cost of the items sold.
+        ProductRollup.objects.rebuild()
+        CustomerRollup.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt the product costs and the rollups.'))
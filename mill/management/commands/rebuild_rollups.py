@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from mill.models import CustomerRollup, ProductRollup
+
+
+class Command(BaseCommand):
+    help = 'Recompute the product and customer rollups from the history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since',
+            help='Only recompute the days from this date (YYYY-MM-DD) on.'
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_date(options['since'])
+            if since is None:
+                raise CommandError('--since must be a YYYY-MM-DD date.')
+
+        for model in [ProductRollup, CustomerRollup]:
+            count = model.objects.rebuild(since=since)
+            self.stdout.write(self.style.SUCCESS(
+                f'Rebuilt {count} {model._meta.verbose_name} row(s).'))
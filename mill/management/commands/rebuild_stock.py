@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mill.models import Stock
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the stock ledger from purchases, productions, items and returns.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Only report products whose ledger drifted from history.'
+        )
+        parser.add_argument(
+            '--product',
+            action='append',
+            type=int,
+            dest='product_ids',
+            help='Restrict to this product id (repeatable).'
+        )
+
+    def handle(self, *args, **options):
+        product_ids = options['product_ids']
+
+        if options['verify']:
+            drifted = Stock.objects.verify(product_ids)
+            for product_id, (ledger, expected) in sorted(drifted.items()):
+                self.stdout.write(
+                    f'product {product_id}: ledger={ledger} expected={expected}')
+            if drifted:
+                raise CommandError(f'{len(drifted)} product(s) out of sync.')
+            self.stdout.write(self.style.SUCCESS('Stock ledger is in sync.'))
+            return
+
+        stock = Stock.objects.rebuild(product_ids)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt stock for {len(stock)} product(s).'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mill import constants
+from mill.models import StockSnapshot
+
+
+class Command(BaseCommand):
+    help = 'Roll stock snapshots forward to the last completed period.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--period',
+            choices=[period for period, _ in constants.SNAPSHOT_PERIOD_CHOICES],
+            default=constants.SNAPSHOT_PERIOD_DAY
+        )
+
+    def handle(self, *args, **options):
+        created = StockSnapshot.objects.take(
+            options['period'], until=timezone.now())
+        self.stdout.write(self.style.SUCCESS(
+            f'Took {created} {options["period"].lower()} snapshot(s).'))
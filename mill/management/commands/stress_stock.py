@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from mill.models import Customer, Item, Order, Product, Purchase, Stock
+
+
+def run_stress(threads=8, products=4, stock=50, orders_per_thread=40,
+               retry_delay=0.005):
+    """Have ``threads`` clerks sell one unit per order concurrently and
+    report throughput and whether any product was oversold."""
+    customer = Customer.objects.create(
+        given_name='stress', surname='stress', phone_number='0')
+    catalogue = [
+        Product.objects.create(
+            name=f'stress {index}', purchase_price=1, customer_price=1)
+        for index in range(products)
+    ]
+    for product in catalogue:
+        Purchase.objects.create(
+            product=product, purchase_unit_price=1,
+            quantity=stock, purchase_date=timezone.now())
+
+    counters = {'sold': 0, 'out_of_stock': 0, 'retries': 0}
+    lock = threading.Lock()
+
+    def count(name):
+        with lock:
+            counters[name] += 1
+
+    def clerk(index):
+        try:
+            for n in range(orders_per_thread):
+                product = catalogue[(index + n) % len(catalogue)]
+                while True:
+                    try:
+                        with transaction.atomic():
+                            order = Order.objects.create(customer=customer)
+                            Item.objects.add_item(order, product, 1, 1)
+                        count('sold')
+                    except ValidationError:
+                        count('out_of_stock')
+                    except OperationalError:
+                        # SQLite refuses concurrent writers instead of
+                        # queueing them.
+                        count('retries')
+                        time.sleep(retry_delay)
+                        continue
+                    break
+        finally:
+            connection.close()
+
+    workers = [
+        threading.Thread(target=clerk, args=(index,))
+        for index in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    product_ids = [product.id for product in catalogue]
+    sold = dict(
+        Item.objects
+        .filter(product_id__in=product_ids)
+        .values('product_id')
+        .annotate(total=Sum('quantity'))
+        .values_list('product_id', 'total')
+        .order_by()
+    )
+    ledger = dict(
+        Stock.objects
+        .filter(product_id__in=product_ids)
+        .values_list('product_id', 'quantity')
+    )
+    return {
+        **counters,
+        'seconds': elapsed,
+        'orders_per_second': counters['sold'] / elapsed if elapsed else 0,
+        'oversold': {
+            product_id: total - stock
+            for product_id, total in sold.items() if total > stock
+        },
+        'negative_stock': {
+            product_id: quantity
+            for product_id, quantity in ledger.items() if quantity < 0
+        },
+        'drifted': Stock.objects.verify(product_ids),
+        'product_ids': product_ids,
+        'customer_id': customer.id,
+    }
+
+
+def clean_up(result):
+    product_ids = result['product_ids']
+    with transaction.atomic():
+        Item.objects.filter(product_id__in=product_ids).delete()
+        Order.objects.filter(customer_id=result['customer_id']).delete()
+        Purchase.objects.filter(product_id__in=product_ids).delete()
+        Product.objects.filter(id__in=product_ids).delete()
+        Customer.objects.filter(id=result['customer_id']).delete()
+
+
+class Command(BaseCommand):
+    help = 'Sell stock from concurrent threads and check nothing is oversold.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--products', type=int, default=4)
+        parser.add_argument('--stock', type=int, default=50)
+        parser.add_argument('--orders-per-thread', type=int, default=40)
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the generated rows instead of deleting them.')
+
+    def handle(self, *args, **options):
+        result = run_stress(
+            threads=options['threads'],
+            products=options['products'],
+            stock=options['stock'],
+            orders_per_thread=options['orders_per_thread'],
+        )
+        if not options['keep']:
+            clean_up(result)
+
+        self.stdout.write(json.dumps({
+            key: value for key, value in result.items()
+            if key not in ('product_ids', 'customer_id')
+        }, indent=2, default=str))
+        if result['oversold'] or result['negative_stock'] or result['drifted']:
+            raise CommandError('Stock was oversold.')
@@ -1,31 +1,991 @@
-from django.db.models import Manager
-from django.db.models import Sum, Value
-from django.db.models.functions import Coalesce
+import operator
+import threading
+from collections import defaultdict
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from functools import reduce
 
-from mill import models
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import (BigIntegerField, Case, DecimalField,
+                              ExpressionWrapper, F, IntegerField, Manager,
+                              OuterRef, Prefetch, Q, QuerySet, Subquery, When)
+from django.db.models import Max, Sum, Value
+from django.db.models.functions import (Coalesce, Now, TruncDate, TruncDay,
+                                       TruncMonth, TruncWeek)
+from django.db.models.lookups import GreaterThan, GreaterThanOrEqual
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
 
+from mill import constants, events, models
+from mill.cache import invalidate_products
 
-class ProductManager(Manager):
+# Movements made before this moment are covered by every snapshot lookup.
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def _get_stock_movements():
+    """Return ``(queryset, product_field, date_field, sign)`` for every
+    stock movement."""
+    return [
+        (models.Purchase.objects.all(), 'product_id', 'purchase_date', 1),
+        (models.Production.objects.all(), 'product_id', 'production_date', 1),
+        (models.Item.objects.all(), 'product_id', 'created_at', -1),
+        (models.Return.objects.all(), 'item__product_id', 'return_date', 1),
+    ]
+
+
+def _sum_subquery(queryset, ref_field, expression=F('quantity'),
+                  output_field=IntegerField()):
+    """Sum ``expression`` over the ``queryset`` rows related to the outer
+    row through ``ref_field``, defaulting to 0 when there are none."""
+    return Coalesce(
+        Subquery(
+            queryset
+            .filter(**{ref_field: OuterRef('pk')})
+            .order_by()
+            .values(ref_field)
+            .annotate(total=Sum(expression))
+            .values('total'),
+            output_field=output_field
+        ),
+        Value(0)
+    )
+
+
+def _get_status(total_amount, paid_amount):
+    """Return the order status for the ``total_amount`` and
+    ``paid_amount`` expressions: UNPAID until something is paid, PAID once
+    the total is covered and REMAIN in between.
+
+    Built from the amounts rather than the stored columns, so one UPDATE
+    can set the totals and the status together.
+    """
+    return Case(
+        When(GreaterThan(paid_amount, 0)
+             & GreaterThanOrEqual(paid_amount, total_amount),
+             then=Value(constants.ORDER_STATUS_PAID)),
+        When(GreaterThan(paid_amount, 0),
+             then=Value(constants.ORDER_STATUS_REMAIN)),
+        default=Value(constants.ORDER_STATUS_UNPAID),
+    )
+
+
+class _ReservationFailed(Exception):
+    pass
+
+
+class ProductQuerySet(QuerySet):
+    def annotate_quantity_in_stock(self, name='quantity_in_stock', as_of=None):
+        """Annotate the stock computed from the movement history.
+
+        Every relation is summed in its own correlated subquery, so the
+        totals are not multiplied by the rows of the other relations and
+        the annotation can be added to any Product queryset.
+
+        With ``as_of``, only movements dated before that moment count: the
+        latest stock snapshot taken at or before it is used as a starting
+        point and only the movements since that snapshot are summed.
+        """
+        queryset = self
+        quantity = Value(0)
+        movements = _get_stock_movements()
+
+        if as_of is not None:
+            snapshots = models.StockSnapshot.objects\
+                .filter(product=OuterRef('pk'), taken_at__lte=as_of)\
+                .order_by('-taken_at')
+            queryset = queryset.alias(
+                stock_snapshot_taken_at=Coalesce(
+                    Subquery(snapshots.values('taken_at')[:1]),
+                    Value(EPOCH)
+                ),
+                stock_snapshot_quantity=Coalesce(
+                    Subquery(snapshots.values('quantity')[:1]),
+                    Value(0)
+                ),
+            )
+            quantity = F('stock_snapshot_quantity')
+            movements = [
+                (movement_queryset.filter(**{
+                    f'{date_field}__gte': OuterRef('stock_snapshot_taken_at'),
+                    f'{date_field}__lt': as_of,
+                }), product_field, date_field, sign)
+                for movement_queryset, product_field, date_field, sign
+                in movements
+            ]
+
+        for movement_queryset, product_field, _, sign in movements:
+            movement = _sum_subquery(movement_queryset, product_field)
+            quantity = quantity + movement if sign > 0 else quantity - movement
+        return queryset.annotate(**{name: quantity})
+
+
+class ProductManager(Manager.from_queryset(ProductQuerySet)):
     def get_product_with_quantity_in_stock(self):
         return models.Product.objects.annotate(
-            quantity_in_stock=(
-                Coalesce(Sum('purchases__quantity'), Value(0)) +
-                Coalesce(Sum('productions__quantity'), Value(0)) -
-                Coalesce(Sum('items__quantity'), Value(0)) +
-                Coalesce(Sum('items__returns__quantity'), Value(0))
+            quantity_in_stock=Coalesce(F('stock__quantity'), Value(0))
+        )
+
+    def get_stock_report(self, requested):
+        """Compare ``{product_id: requested_quantity}`` with the stock in a
+        single query.
+
+        Return ``{product_id: {'product', 'requested', 'available',
+        'shortfall'}}`` for every requested product that exists.
+        """
+        products = self.get_product_with_quantity_in_stock()\
+            .in_bulk(list(requested))
+        return {
+            product_id: {
+                'product': product,
+                'requested': requested[product_id],
+                'available': product.quantity_in_stock,
+                'shortfall': max(
+                    requested[product_id] - product.quantity_in_stock, 0),
+            }
+            for product_id, product in products.items()
+        }
+
+    def validate_stock_availability(self, requested):
+        """Raise an ``out_of_stock`` ValidationError keyed by product id for
+        every product short of ``requested``; return the stock report."""
+        report = self.get_stock_report({
+            product_id: quantity
+            for product_id, quantity in requested.items() if quantity > 0
+        })
+        errors = {
+            product_id: [self.get_out_of_stock_error(line)]
+            for product_id, line in report.items() if line['shortfall']
+        }
+        if errors:
+            raise ValidationError(errors)
+        return report
+
+    def get_out_of_stock_error(self, line):
+        return ValidationError(
+            _(f"{line['available']} {line['product'].name} left in stock"),
+            code="out_of_stock",
+        )
+
+
+class StockManager(Manager):
+    def adjust(self, deltas):
+        """Apply ``{product_id: delta}`` movements to the stock ledger in a
+        single UPDATE."""
+        deltas = {
+            product_id: delta for product_id, delta in deltas.items() if delta
+        }
+        if not deltas:
+            return
+        with transaction.atomic():
+            updated = self.filter(product_id__in=deltas).update(
+                quantity=F('quantity') + Case(
+                    *[When(product_id=product_id, then=Value(delta))
+                      for product_id, delta in deltas.items()],
+                    default=Value(0)
+                ),
+                updated_at=Now()
             )
+            if updated < len(deltas):
+                missing = set(deltas) - set(
+                    self.filter(product_id__in=deltas)
+                    .values_list('product_id', flat=True)
+                )
+                self.rebuild(product_ids=missing)
+            invalidate_products(deltas)
+            events.publish_on_commit(events.EVENT_STOCK, list(deltas))
+
+    def reserve(self, requested):
+        """Take ``{product_id: quantity}`` off the ledger, or nothing at all.
+
+        The UPDATE only matches rows that still hold enough stock, so two
+        writers can never both take the last units of a product: the row
+        lock of the UPDATE serializes them on that product only. Raise the
+        ``out_of_stock`` ValidationError when any product falls short.
+        """
+        requested = {
+            product_id: quantity
+            for product_id, quantity in requested.items() if quantity > 0
+        }
+        if not requested:
+            return
+        try:
+            with transaction.atomic():
+                updated = self.filter(reduce(operator.or_, [
+                    Q(product_id=product_id, quantity__gte=quantity)
+                    for product_id, quantity in requested.items()
+                ])).update(
+                    quantity=F('quantity') - Case(
+                        *[When(product_id=product_id, then=Value(quantity))
+                          for product_id, quantity in requested.items()],
+                        default=Value(0)
+                    ),
+                    updated_at=Now()
+                )
+                if updated < len(requested):
+                    raise _ReservationFailed
+                invalidate_products(requested)
+                events.publish_on_commit(
+                    events.EVENT_STOCK, list(requested))
+        except _ReservationFailed:
+            models.Product.objects.validate_stock_availability(requested)
+            # The stock came back between the UPDATE and the report.
+            raise ValidationError(_('Stock changed, please retry.'),
+                                  code='out_of_stock')
+
+    def compute_from_history(self, product_ids=None):
+        """Return ``{product_id: quantity}`` summed from the full history."""
+        products = models.Product.objects.all()
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+        return dict(
+            products
+            .annotate_quantity_in_stock()
+            .values_list('id', 'quantity_in_stock')
+            .order_by()
         )
 
+    def rebuild(self, product_ids=None):
+        """Overwrite ledger rows with the quantities computed from history."""
+        stock = self.compute_from_history(product_ids)
+        now = timezone.now()
+        with transaction.atomic():
+            existing = set(self.values_list('product_id', flat=True))
+            self.bulk_create([
+                models.Stock(product_id=product_id, quantity=quantity)
+                for product_id, quantity in stock.items()
+                if product_id not in existing
+            ])
+            self.bulk_update([
+                models.Stock(product_id=product_id, quantity=quantity,
+                             updated_at=now)
+                for product_id, quantity in stock.items()
+                if product_id in existing
+            ], ['quantity', 'updated_at'], batch_size=500)
+            invalidate_products(stock)
+            events.publish_on_commit(events.EVENT_STOCK, list(stock))
+        return stock
 
-class ItemManager(Manager):
-    def add_item(self, order, product, quantity, price):
-        item, created = models.Item.objects.get_or_create(
-            order=order,
-            product=product,
-            defaults={'quantity': quantity, 'price': price}
+    def verify(self, product_ids=None):
+        """Return ``{product_id: (ledger, expected)}`` for drifted rows."""
+        expected = self.compute_from_history(product_ids)
+        ledger = dict(self.values_list('product_id', 'quantity'))
+        return {
+            product_id: (ledger.get(product_id), quantity)
+            for product_id, quantity in expected.items()
+            if ledger.get(product_id) != quantity
+        }
+
+
+COST_PLACES = Decimal('0.0001')
+COST_FIELD = DecimalField(max_digits=18, decimal_places=4)
+
+
+class ProductCostManager(Manager):
+    """Keep the weighted-average cost of every product up to date, one
+    movement at a time, without replaying the history."""
+
+    def receive(self, receipts):
+        """Add ``(product_id, quantity, unit_cost)`` receipts to stock.
+
+        A receipt moves the average cost towards its unit cost in
+        proportion to its quantity; a negative quantity takes a receipt
+        back. ``unit_cost`` None stands for the product's purchase price.
+        """
+        receipts = [receipt for receipt in receipts if receipt[1]]
+        if not receipts:
+            return
+        with transaction.atomic(savepoint=False):
+            costs = self._lock({product_id for product_id, _, _ in receipts})
+            for product_id, quantity, unit_cost in receipts:
+                cost = costs[product_id]
+                if unit_cost is None:
+                    unit_cost = cost.product.purchase_price
+                on_hand = cost.quantity + quantity
+                if on_hand > 0 and cost.quantity > 0:
+                    cost.average_cost = max(
+                        (cost.quantity * cost.average_cost
+                         + quantity * Decimal(unit_cost)) / on_hand,
+                        Decimal(0)
+                    ).quantize(COST_PLACES)
+                elif on_hand > 0:
+                    cost.average_cost = Decimal(unit_cost)
+                cost.quantity = on_hand
+            self._save(costs.values())
+
+    def consume(self, quantities):
+        """Take ``{product_id: quantity}`` out of stock at the average cost
+        and return ``{product_id: average_cost}``."""
+        quantities = {
+            product_id: quantity
+            for product_id, quantity in quantities.items() if quantity
+        }
+        if not quantities:
+            return {}
+        with transaction.atomic(savepoint=False):
+            costs = self._lock(quantities)
+            for product_id, quantity in quantities.items():
+                costs[product_id].quantity -= quantity
+            self._save(costs.values())
+        return {
+            product_id: cost.average_cost
+            for product_id, cost in costs.items()
+        }
+
+    def _lock(self, product_ids):
+        costs = self.select_for_update()\
+            .select_related('product')\
+            .in_bulk(list(product_ids))
+        missing = set(product_ids) - set(costs)
+        if missing:
+            self.bulk_create([
+                models.ProductCost(product_id=product_id)
+                for product_id in missing
+            ], ignore_conflicts=True)
+            costs.update(
+                self.select_for_update()
+                .select_related('product')
+                .in_bulk(list(missing))
+            )
+        return costs
+
+    def _save(self, costs):
+        now = timezone.now()
+        for cost in costs:
+            cost.updated_at = now
+        self.bulk_update(costs, ['quantity', 'average_cost', 'updated_at'])
+
+    def rebuild(self, product_ids=None):
+        """Replay the movement history of every product to recompute the
+        average costs and the unit cost of every item sold.
+
+        Only meant for backfills and repairs: writes keep the costs up to
+        date incrementally.
+        """
+        products = models.Product.objects.all()
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+
+        for product_id, purchase_price in products.values_list(
+                'id', 'purchase_price').iterator():
+            quantity, average_cost = 0, Decimal(0)
+            items = []
+            for _, kind, value, moved, unit_cost in self._get_history(
+                    product_id, purchase_price):
+                if kind == 'item':
+                    value.unit_cost = average_cost
+                    items.append(value)
+                    quantity -= moved
+                    continue
+                if kind == 'return':
+                    unit_cost = value.unit_cost
+                on_hand = quantity + moved
+                if on_hand > 0 and quantity > 0:
+                    average_cost = ((quantity * average_cost
+                                     + moved * Decimal(unit_cost)) / on_hand
+                                    ).quantize(COST_PLACES)
+                elif on_hand > 0:
+                    average_cost = Decimal(unit_cost)
+                quantity = on_hand
+
+            with transaction.atomic():
+                models.Item.objects.bulk_update(
+                    items, ['unit_cost'], batch_size=500)
+                self.update_or_create(product_id=product_id, defaults={
+                    'quantity': quantity, 'average_cost': average_cost})
+
+    @staticmethod
+    def _get_history(product_id, purchase_price):
+        """Return the movements of a product in date order as
+        ``(moved_at, kind, item, quantity, unit_cost)``."""
+        items = {
+            item.id: item for item in models.Item.objects
+            .filter(product_id=product_id)
+            .only('id', 'created_at', 'quantity', 'unit_cost')
+        }
+        history = [
+            (moved_at, 'purchase', None, quantity, unit_cost)
+            for moved_at, quantity, unit_cost in models.Purchase.objects
+            .filter(product_id=product_id)
+            .values_list('purchase_date', 'quantity', 'purchase_unit_price')
+        ] + [
+            (moved_at, 'production', None, quantity, purchase_price)
+            for moved_at, quantity in models.Production.objects
+            .filter(product_id=product_id)
+            .values_list('production_date', 'quantity')
+        ] + [
+            (item.created_at, 'item', item, item.quantity, None)
+            for item in items.values()
+        ] + [
+            (moved_at, 'return', items[item_id], quantity, None)
+            for moved_at, item_id, quantity in models.Return.objects
+            .filter(item__product_id=product_id)
+            .values_list('return_date', 'item_id', 'quantity')
+        ]
+        # Sales go before returns of the same moment.
+        order = {'purchase': 0, 'production': 0, 'item': 1, 'return': 2}
+        return sorted(history, key=lambda movement: (
+            movement[0], order[movement[1]]))
+
+
+class StockSnapshotManager(Manager):
+    def quantity_as_of(self, as_of, product_ids=None):
+        """Return ``{product_id: quantity}`` as it stood at ``as_of``."""
+        products = models.Product.objects.all()
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+        return dict(
+            products
+            .annotate_quantity_in_stock(as_of=as_of)
+            .values_list('id', 'quantity_in_stock')
+            .order_by()
+        )
+
+    def take(self, period, until):
+        """Roll snapshots of ``period`` forward up to the boundary before
+        ``until``, starting from the latest snapshot already taken.
+
+        Only products that moved during a period get a new snapshot row;
+        the others keep being served by their previous snapshot.
+        """
+        trunc = TruncDay if period == constants.SNAPSHOT_PERIOD_DAY \
+            else TruncMonth
+        latest = self.filter(period=period).order_by('-taken_at').first()
+        since = latest.taken_at if latest else EPOCH
+        until = self._truncate(period, until)
+        if until <= since:
+            return 0
+
+        deltas = defaultdict(lambda: defaultdict(int))
+        for queryset, product_field, date_field, sign in \
+                _get_stock_movements():
+            rows = queryset\
+                .filter(**{f'{date_field}__gte': since,
+                           f'{date_field}__lt': until})\
+                .annotate(bucket=trunc(date_field))\
+                .values(product_field, 'bucket')\
+                .annotate(total=Sum('quantity'))\
+                .values_list(product_field, 'bucket', 'total')\
+                .order_by()
+            for product_id, bucket, total in rows:
+                deltas[bucket][product_id] += sign * total
+
+        if latest:
+            quantities = dict(
+                models.Product.objects
+                .annotate_quantity_in_stock(as_of=since)
+                .filter(id__in={
+                    product_id
+                    for bucket in deltas.values() for product_id in bucket
+                })
+                .values_list('id', 'quantity_in_stock')
+                .order_by()
+            )
+        else:
+            quantities = {}
+
+        snapshots = []
+        for bucket in sorted(deltas):
+            taken_at = self._next_boundary(period, bucket)
+            for product_id, delta in deltas[bucket].items():
+                quantities[product_id] = quantities.get(product_id, 0) + delta
+                snapshots.append(models.StockSnapshot(
+                    product_id=product_id,
+                    period=period,
+                    taken_at=taken_at,
+                    quantity=quantities[product_id],
+                ))
+        self.bulk_create(snapshots, batch_size=500, ignore_conflicts=True)
+        return len(snapshots)
+
+    def shift(self, product_id, moved_at, delta):
+        """Apply a movement dated ``moved_at`` to the snapshots taken after
+        it, so late or back-dated writes keep the snapshots exact."""
+        if not delta or moved_at is None:
+            return
+        self.filter(product_id=product_id, taken_at__gt=moved_at)\
+            .update(quantity=F('quantity') + delta)
+
+    def shift_many(self, movements):
+        """Apply ``(product_id, moved_at, delta)`` movements in one UPDATE.
+
+        A snapshot moves by the sum of its product's movements dated before
+        it, so each product contributes one ``taken_at > moved_at`` branch
+        per movement, carrying the sum of the movements up to that one;
+        the latest branch a snapshot matches wins.
+        """
+        movements = [
+            (product_id, moved_at, delta)
+            for product_id, moved_at, delta in movements
+            if delta and moved_at is not None
+        ]
+        # Movements made after the latest snapshot of their product, the
+        # usual case, change nothing.
+        latest = dict(
+            self.filter(product_id__in={movement[0] for movement in movements})
+            .order_by()
+            .values('product_id')
+            .annotate(taken_at=Max('taken_at'))
+            .values_list('product_id', 'taken_at')
+        ) if movements else {}
+        by_product = defaultdict(lambda: defaultdict(int))
+        for product_id, moved_at, delta in movements:
+            if product_id in latest and moved_at < latest[product_id]:
+                by_product[product_id][moved_at] += delta
+        if not by_product:
+            return
+
+        branches = []
+        for product_id, deltas in by_product.items():
+            total = 0
+            for moved_at in sorted(deltas):
+                total += deltas[moved_at]
+                branches.append(When(
+                    product_id=product_id, taken_at__gt=moved_at,
+                    then=Value(total)))
+        # Branches of the same product are tried latest movement first.
+        branches.reverse()
+        self.filter(
+            product_id__in=by_product,
+            taken_at__gt=min(min(deltas) for deltas in by_product.values()),
+        ).update(quantity=F('quantity') + Case(*branches, default=Value(0)))
+
+    @staticmethod
+    def _truncate(period, moment):
+        moment = timezone.localtime(moment).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        if period == constants.SNAPSHOT_PERIOD_MONTH:
+            moment = moment.replace(day=1)
+        return moment
+
+    @staticmethod
+    def _next_boundary(period, bucket):
+        if period == constants.SNAPSHOT_PERIOD_DAY:
+            return bucket + timedelta(days=1)
+        return (bucket + timedelta(days=32)).replace(day=1)
+
+
+# Aging buckets of outstanding order amounts: (name, min days, max days).
+AGING_BUCKETS = [
+    ('aging_0_30', 0, 30),
+    ('aging_31_60', 31, 60),
+    ('aging_61_90', 61, 90),
+    ('aging_over_90', 91, None),
+]
+
+
+class CustomerBalanceQuerySet(QuerySet):
+    def annotate_aging(self, as_of=None):
+        """Annotate the outstanding amount of the customer's orders in each
+        of ``AGING_BUCKETS``, by order age at ``as_of`` (now by default)."""
+        as_of = as_of or timezone.now()
+        outstanding = models.Order.objects\
+            .annotate_amounts()\
+            .filter(remain_amount__gt=0)
+        buckets = {}
+        for name, min_days, max_days in AGING_BUCKETS:
+            orders = outstanding.filter(
+                created_at__lte=as_of - timedelta(days=min_days))
+            if max_days is not None:
+                orders = orders.filter(
+                    created_at__gt=as_of - timedelta(days=max_days + 1))
+            buckets[name] = _sum_subquery(
+                orders, 'customer', F('remain_amount'), BigIntegerField())
+        return self.annotate(**buckets)
+
+
+class CustomerBalanceManager(Manager.from_queryset(CustomerBalanceQuerySet)):
+    def refresh(self, customer_ids=None):
+        """Recompute the balances of ``customer_ids`` (ids or a values
+        queryset; every customer by default) from the stored order totals
+        in one UPDATE."""
+        balances = self.all()
+        if customer_ids is not None:
+            balances = balances.filter(customer_id__in=customer_ids)
+        amount = BigIntegerField()
+        orders = models.Order.objects.all()
+        total_amount = _sum_subquery(
+            orders, 'customer', F('total_amount'), amount)
+        paid_amount = _sum_subquery(
+            orders, 'customer', F('paid_amount'), amount)
+        return balances.update(
+            total_amount=total_amount,
+            paid_amount=paid_amount,
+            balance=total_amount - paid_amount,
+            updated_at=Now(),
+        )
+
+    def rebuild(self):
+        """Create the missing balance rows and recompute all of them."""
+        with transaction.atomic():
+            self.bulk_create([
+                models.CustomerBalance(customer_id=customer_id)
+                for customer_id in models.Customer.objects
+                .filter(balance__isnull=True)
+                .values_list('id', flat=True)
+            ], batch_size=1000)
+            return self.refresh()
+
+
+class OrderQuerySet(QuerySet):
+    def annotate_amounts(self):
+        """Annotate ``remain_amount`` from the stored running totals."""
+        return self.annotate(
+            remain_amount=F('total_amount') - F('paid_amount')
+        )
+
+    def annotate_computed_amounts(self):
+        """Annotate ``computed_total_amount``, ``computed_paid_amount``,
+        ``computed_returned_amount`` and ``computed_status`` from the items,
+        returns and payments.
+
+        The total is the value of the items less the value of their
+        returns; each relation is summed in its own subquery.
+        """
+        return self.annotate(**self._get_computed_amounts(prefix='computed_'))
+
+    def annotate_margin(self):
+        """Annotate ``cost_amount``, the cost of the units sold net of
+        returns, and ``gross_margin`` against the stored total."""
+        cost_amount = _sum_subquery(
+            models.Item.objects.all(), 'order',
+            F('quantity') * F('unit_cost'), COST_FIELD
+        ) - _sum_subquery(
+            models.Return.objects.all(), 'item__order',
+            F('quantity') * F('item__unit_cost'), COST_FIELD
+        )
+        return self.annotate(
+            cost_amount=ExpressionWrapper(cost_amount, output_field=COST_FIELD),
+            gross_margin=ExpressionWrapper(
+                F('total_amount') - F('cost_amount'), output_field=COST_FIELD),
+        )
+
+    def prefetch_items(self):
+        """Prefetch the items with their ``line_amount`` annotated."""
+        return self.prefetch_related(
+            Prefetch('items', queryset=models.Item.objects.annotate_line_amount())
+        )
+
+    def refresh_amounts(self):
+        """Recompute the stored totals and ``status`` of these orders in one
+        UPDATE, then the balances of their customers in another.
+
+        ``updated_at`` moves too, so the change feed sends the new totals.
+        """
+        updated = self.update(**self._get_computed_amounts(),
+                              updated_at=timezone.now())
+        events.publish_on_commit(events.EVENT_ORDER, self.values('pk'))
+        models.CustomerBalance.objects.refresh(
+            self.order_by().values('customer_id'))
+        return updated
+
+    @staticmethod
+    def _get_computed_amounts(prefix=''):
+        amount = BigIntegerField()
+        returned_amount = _sum_subquery(
+            models.Return.objects.all(), 'item__order',
+            F('quantity') * F('item__price'), amount)
+        total_amount = _sum_subquery(
+            models.Item.objects.all(), 'order',
+            F('quantity') * F('price'), amount) - returned_amount
+        paid_amount = _sum_subquery(
+            models.Payment.objects.all(), 'order', F('amount'), amount)
+        return {
+            f'{prefix}total_amount': total_amount,
+            f'{prefix}paid_amount': paid_amount,
+            f'{prefix}returned_amount': returned_amount,
+            f'{prefix}status': _get_status(total_amount, paid_amount),
+        }
+
+
+class PaymentManager(Manager):
+    def post(self, payments):
+        """Insert ``payments`` in one statement and bring the totals and
+        ``status`` of their orders up to date, in the same few queries
+        however many payments and orders there are.
+
+        Raise the ``invalid_order`` ValidationError when an order does not
+        exist.
+        """
+        order_ids = {payment.order_id for payment in payments}
+        customers = dict(
+            models.Order.objects
+            .filter(pk__in=order_ids)
+            .values_list('id', 'customer_id')
+        )
+        missing = order_ids - set(customers)
+        if missing:
+            raise ValidationError(
+                _('Order %(orders)s does not exist.'),
+                code='invalid_order',
+                params={'orders': ', '.join(map(str, sorted(missing)))},
+            )
+
+        with transaction.atomic(savepoint=False):
+            payments = self.bulk_create(payments)
+            models.Order.objects.filter(pk__in=order_ids).refresh_amounts()
+            # bulk_create sends no signals, so queue the rollups here.
+            models.CustomerRollup.objects.refresh_on_commit(
+                [(customers[payment.order_id],
+                  timezone.localdate(payment.created_at))
+                 for payment in payments], models.Payment)
+        return payments
+
+
+class ItemQuerySet(QuerySet):
+    def annotate_line_amount(self):
+        """Annotate ``net_quantity`` and ``line_amount`` net of returns."""
+        return self.annotate(
+            net_quantity=F('quantity') - _sum_subquery(
+                models.Return.objects.all(), 'item'),
+            line_amount=F('net_quantity') * F('price'),
+        )
+
+    def annotate_line_margin(self):
+        """Annotate ``line_amount`` with the ``line_cost`` and the
+        ``line_margin`` of the units kept by the customer."""
+        return self.annotate_line_amount().annotate(
+            line_cost=ExpressionWrapper(
+                F('net_quantity') * F('unit_cost'), output_field=COST_FIELD),
+            line_margin=ExpressionWrapper(
+                F('line_amount') - F('line_cost'), output_field=COST_FIELD),
         )
 
-        if not created:
-            item.update_quantity(item.quantity + quantity)
+
+class ItemManager(Manager.from_queryset(ItemQuerySet)):
+    def add_item(self, order, product, quantity, price):
+        """Add ``quantity`` of ``product`` to the order's line for it,
+        creating the line if there is none yet.
+
+        Reserving the stock locks the product's ledger row first, so
+        concurrent additions of one product queue up and the later ones
+        find the line; the unique ``(order, product)`` constraint refuses a
+        second line should they not.
+        """
+        with transaction.atomic():
+            models.Stock.objects.reserve({product.id: quantity})
+            item = models.Item.objects\
+                .select_for_update()\
+                .filter(order=order, product=product)\
+                .first()
+
+            if item is None:
+                item = models.Item(
+                    order=order,
+                    product=product,
+                    quantity=quantity,
+                    price=price
+                )
+            else:
+                item.quantity += quantity
+            item._stock_reserved = True
+            item.save()
 
         return item
+
+
+def _get_day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+# Rows queued by RollupManager.refresh_on_commit(), per rollup model and
+# source model.
+_pending_rollups = threading.local()
+
+
+class RollupManager(Manager):
+    """Maintain daily rollup rows keyed by ``(key, day)``.
+
+    Subclasses name the ``key`` field and list the movements feeding the
+    rollup: ``(queryset, key_field, date_field, {column: aggregate})``.
+    """
+    key = None
+
+    def get_sources(self):
+        raise NotImplementedError
+
+    def get_metrics(self):
+        return [
+            column for _, _, _, metrics in self.get_sources()
+            for column in metrics
+        ]
+
+    def refresh(self, cells, source_model=None):
+        """Recompute the rows of ``cells``, ``(key_id, day)`` pairs, from
+        the movements of ``source_model`` (all of them by default) and
+        upsert only the columns those movements feed.
+
+        Cells of keys deleted since they were queued, or never committed
+        because the transaction queuing them rolled back, are skipped.
+        """
+        cells = {(key_id, day) for key_id, day in cells if key_id is not None}
+        if cells:
+            existing = set(
+                self.model._meta.get_field(self.key).related_model.objects
+                .filter(pk__in={key_id for key_id, _ in cells})
+                .values_list('pk', flat=True)
+            )
+            cells = {cell for cell in cells if cell[0] in existing}
+        if not cells:
+            return
+        days = {day for _, day in cells}
+        sources = [
+            source for source in self.get_sources()
+            if source_model is None or source[0].model is source_model
+        ]
+        columns = []
+        values = defaultdict(dict)
+        for queryset, key_field, date_field, metrics in sources:
+            columns += metrics
+            for cell in cells:
+                values[cell].update(dict.fromkeys(metrics, 0))
+            self._aggregate(
+                queryset.filter(**{
+                    f'{key_field}__in': {key_id for key_id, _ in cells},
+                    f'{date_field}__gte': _get_day_start(min(days)),
+                    f'{date_field}__lt': _get_day_start(
+                        max(days) + timedelta(days=1)),
+                }),
+                key_field, date_field, metrics, values
+            )
+        self.bulk_create(
+            [self.model(**{f'{self.key}_id': key_id, 'day': day}, **row)
+             for (key_id, day), row in values.items()],
+            update_conflicts=True,
+            unique_fields=[self.key, 'day'],
+            update_fields=columns,
+        )
+
+    def refresh_on_commit(self, cells, source_model):
+        """Queue ``cells`` for a refresh from ``source_model`` once the
+        current transaction commits, so all the writes of a transaction
+        are rolled up together."""
+        pending = _pending_rollups.__dict__.setdefault(
+            'cells', defaultdict(set))
+        pending[(self.model, source_model)].update(cells)
+
+        def flush():
+            for (model, source), queued in list(pending.items()):
+                if model is self.model:
+                    del pending[(model, source)]
+                    self.refresh(queued, source)
+
+        transaction.on_commit(flush)
+
+    def rebuild(self, since=None):
+        """Recompute every row, or the rows of ``since`` (a date) and
+        later, from the movement history."""
+        values = defaultdict(dict)
+        for queryset, key_field, date_field, metrics in self.get_sources():
+            if since is not None:
+                queryset = queryset.filter(
+                    **{f'{date_field}__gte': _get_day_start(since)})
+            self._aggregate(queryset, key_field, date_field, metrics, values)
+
+        rows = self.all() if since is None else self.filter(day__gte=since)
+        with transaction.atomic():
+            rows.delete()
+            self.bulk_create(
+                [self.model(**{f'{self.key}_id': key_id, 'day': day}, **row)
+                 for (key_id, day), row in values.items()
+                 if key_id is not None],
+                batch_size=1000,
+            )
+        return len(values)
+
+    @staticmethod
+    def _aggregate(queryset, key_field, date_field, metrics, values):
+        rows = queryset\
+            .annotate(rollup_day=TruncDate(date_field))\
+            .values(key_field, 'rollup_day')\
+            .annotate(**metrics)\
+            .values_list(key_field, 'rollup_day', *metrics)\
+            .order_by()
+        for key_id, day, *totals in rows:
+            values[(key_id, day)].update(zip(metrics, totals))
+
+    def report(self, period, since=None, until=None, key_id=None):
+        """Sum the daily rows into ``period`` buckets, latest first, as
+        ``total_<column>`` values plus ``net_revenue`` and
+        ``gross_margin``."""
+        rows = self.all()
+        if since is not None:
+            rows = rows.filter(day__gte=since)
+        if until is not None:
+            rows = rows.filter(day__lte=until)
+        if key_id is not None:
+            rows = rows.filter(**{f'{self.key}_id': key_id})
+
+        bucket = {
+            constants.REPORT_PERIOD_DAY: F('day'),
+            constants.REPORT_PERIOD_WEEK: TruncWeek('day'),
+            constants.REPORT_PERIOD_MONTH: TruncMonth('day'),
+        }[period]
+        return rows\
+            .annotate(period=bucket)\
+            .values('period', self.key)\
+            .annotate(**{
+                f'total_{column}': Sum(column) for column in self.get_metrics()
+            })\
+            .annotate(
+                net_revenue=F('total_revenue') - F('total_returned_amount'),
+                gross_margin=ExpressionWrapper(
+                    F('net_revenue') - F('total_cost_of_sales')
+                    + F('total_returned_cost'),
+                    output_field=COST_FIELD),
+            )\
+            .order_by('-period', self.key)
+
+
+def _get_sales_metrics():
+    return {
+        'units_sold': Sum('quantity'),
+        'revenue': Sum(F('quantity') * F('price'),
+                       output_field=BigIntegerField()),
+        'cost_of_sales': Sum(F('quantity') * F('unit_cost'),
+                             output_field=COST_FIELD),
+    }
+
+
+def _get_returns_metrics():
+    return {
+        'units_returned': Sum('quantity'),
+        'returned_amount': Sum(F('quantity') * F('item__price'),
+                               output_field=BigIntegerField()),
+        'returned_cost': Sum(F('quantity') * F('item__unit_cost'),
+                             output_field=COST_FIELD),
+    }
+
+
+class ProductRollupManager(RollupManager):
+    key = 'product'
+
+    def get_sources(self):
+        return [
+            (models.Item.objects.all(), 'product_id', 'created_at',
+             _get_sales_metrics()),
+            (models.Return.objects.all(), 'item__product_id', 'return_date',
+             _get_returns_metrics()),
+            (models.Production.objects.all(), 'product_id', 'production_date',
+             {'units_produced': Sum('quantity')}),
+            (models.Purchase.objects.all(), 'product_id', 'purchase_date', {
+                'units_purchased': Sum('quantity'),
+                'purchase_cost': Sum(F('quantity') * F('purchase_unit_price'),
+                                     output_field=BigIntegerField()),
+            }),
+        ]
+
+
+class CustomerRollupManager(RollupManager):
+    key = 'customer'
+
+    def get_sources(self):
+        return [
+            (models.Item.objects.all(), 'order__customer_id', 'created_at',
+             _get_sales_metrics()),
+            (models.Return.objects.all(), 'item__order__customer_id',
+             'return_date', _get_returns_metrics()),
+            (models.Payment.objects.all(), 'order__customer_id', 'created_at',
+             {'paid_amount': Sum('amount')}),
+        ]
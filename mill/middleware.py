@@ -0,0 +1,97 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.permissions import SAFE_METHODS
+
+from mill import routers
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCollector:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+def get_endpoint(request):
+    """Return ``ViewSet.action`` (or the view name) that served the request."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    view = getattr(match.func, 'cls', None) or getattr(
+        match.func, 'view_class', None)
+    if view is None:
+        return match.view_name
+    actions = getattr(match.func, 'actions', None) or {}
+    action = actions.get(request.method.lower(), request.method.lower())
+    return f'{view.__name__}.{action}'
+
+
+class QueryInstrumentationMiddleware:
+    """Record the SQL query count, database time and total time of every
+    request, tagged by viewset and action.
+
+    The numbers go to the ``X-Endpoint``, ``X-Query-Count`` and
+    ``Server-Timing`` response headers and to the ``mill.middleware`` log:
+    at DEBUG, or at WARNING for requests running more than
+    ``SLOW_REQUEST_QUERIES`` queries or taking more than
+    ``SLOW_REQUEST_MS``.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        collector = QueryCollector()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(collector))
+            response = self.get_response(request)
+        total = time.perf_counter() - start
+
+        endpoint = get_endpoint(request)
+        response['X-Endpoint'] = endpoint
+        response['X-Query-Count'] = str(collector.count)
+        response['Server-Timing'] = (
+            f'db;dur={collector.duration * 1000:.1f}, '
+            f'total;dur={total * 1000:.1f}'
+        )
+        slow = collector.count > settings.SLOW_REQUEST_QUERIES \
+            or total * 1000 > settings.SLOW_REQUEST_MS
+        logger.log(
+            logging.WARNING if slow else logging.DEBUG,
+            '%s %s %s queries=%d db_ms=%.1f total_ms=%.1f',
+            endpoint, request.method, request.path, collector.count,
+            collector.duration * 1000, total * 1000
+        )
+        return response
+
+
+class PrimaryPinMiddleware:
+    """Read from the primary for a few seconds after a successful write, so
+    a user sees their own changes however far the replica lags."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        # DRF copies the user it authenticated onto the Django request.
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and response.status_code < 400 \
+                and user is not None and user.is_authenticated:
+            routers.pin_primary(user)
+        return response
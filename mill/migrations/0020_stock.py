@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_stock(apps, schema_editor):
+    Product = apps.get_model('mill', 'Product')
+    Stock = apps.get_model('mill', 'Stock')
+    movements = [
+        (apps.get_model('mill', 'Purchase'), 'product_id', 1),
+        (apps.get_model('mill', 'Production'), 'product_id', 1),
+        (apps.get_model('mill', 'Item'), 'product_id', -1),
+        (apps.get_model('mill', 'Return'), 'item__product_id', 1),
+    ]
+    stock = {product_id: 0 for product_id in
+             Product.objects.values_list('id', flat=True)}
+    for model, product_field, sign in movements:
+        rows = model.objects\
+            .values(product_field)\
+            .annotate(total=Sum('quantity'))\
+            .values_list(product_field, 'total')\
+            .order_by()
+        for product_id, total in rows:
+            stock[product_id] += sign * total
+    Stock.objects.bulk_create([
+        Stock(product_id=product_id, quantity=quantity)
+        for product_id, quantity in stock.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mill', '0019_alter_order_customer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Stock',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock', serialize=False, to='mill.product')),
+                ('quantity', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(populate_stock, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='CartItem',
+        ),
+        migrations.DeleteModel(
+            name='Cart',
+        ),
+    ]
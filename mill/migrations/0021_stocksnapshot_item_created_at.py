@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:58
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_item_created_at(apps, schema_editor):
+    Item = apps.get_model('mill', 'Item')
+    Order = apps.get_model('mill', 'Order')
+    Item.objects.update(created_at=Subquery(
+        Order.objects.filter(pk=OuterRef('order_id')).values('created_at')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mill', '0020_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_item_created_at,
+                             migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('DAY', 'day'), ('MONTH', 'month')], default='DAY', max_length=5)),
+                ('taken_at', models.DateTimeField()),
+                ('quantity', models.IntegerField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_snapshots', to='mill.product')),
+            ],
+            options={
+                'ordering': ['-taken_at'],
+                'indexes': [models.Index(fields=['product', '-taken_at'], name='mill_stocks_product_70cb41_idx')],
+                'constraints': [models.UniqueConstraint(fields=('product', 'period', 'taken_at'), name='unique_stock_snapshot')],
+            },
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:00
+
+import django.db.models.expressions
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def populate_order_amounts(apps, schema_editor):
+    Order = apps.get_model('mill', 'Order')
+    Item = apps.get_model('mill', 'Item')
+    Return = apps.get_model('mill', 'Return')
+    Payment = apps.get_model('mill', 'Payment')
+
+    def sum_subquery(queryset, ref_field, expression):
+        return Coalesce(Subquery(
+            queryset
+            .filter(**{ref_field: OuterRef('pk')})
+            .order_by()
+            .values(ref_field)
+            .annotate(total=Sum(expression))
+            .values('total'),
+            output_field=models.BigIntegerField()
+        ), Value(0))
+
+    returned_amount = sum_subquery(
+        Return.objects.all(), 'item__order', F('quantity') * F('item__price'))
+    Order.objects.update(
+        total_amount=sum_subquery(
+            Item.objects.all(), 'order', F('quantity') * F('price')
+        ) - returned_amount,
+        paid_amount=sum_subquery(Payment.objects.all(), 'order', F('amount')),
+        returned_amount=returned_amount,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mill', '0021_stocksnapshot_item_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='paid_amount',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='returned_amount',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_amount',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_order_amounts,
+                             migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(django.db.models.expressions.CombinedExpression(models.F('total_amount'), '-', models.F('paid_amount')), name='order_remain_amount_idx'),
+        ),
+    ]
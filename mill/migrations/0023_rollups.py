@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mill', '0022_order_amounts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('units_sold', models.IntegerField(default=0)),
+                ('revenue', models.BigIntegerField(default=0)),
+                ('units_returned', models.IntegerField(default=0)),
+                ('returned_amount', models.BigIntegerField(default=0)),
+                ('paid_amount', models.BigIntegerField(default=0)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='mill.customer')),
+            ],
+            options={
+                'ordering': ['-day'],
+                'constraints': [models.UniqueConstraint(fields=('customer', 'day'), name='unique_customer_rollup')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('units_sold', models.IntegerField(default=0)),
+                ('revenue', models.BigIntegerField(default=0)),
+                ('units_returned', models.IntegerField(default=0)),
+                ('returned_amount', models.BigIntegerField(default=0)),
+                ('units_produced', models.IntegerField(default=0)),
+                ('units_purchased', models.IntegerField(default=0)),
+                ('purchase_cost', models.BigIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='mill.product')),
+            ],
+            options={
+                'ordering': ['-day'],
+                'constraints': [models.UniqueConstraint(fields=('product', 'day'), name='unique_product_rollup')],
+            },
+        ),
+    ]
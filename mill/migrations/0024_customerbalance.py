@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_customer_balances(apps, schema_editor):
+    Customer = apps.get_model('mill', 'Customer')
+    CustomerBalance = apps.get_model('mill', 'CustomerBalance')
+    Order = apps.get_model('mill', 'Order')
+    amounts = {
+        customer_id: (total_amount or 0, paid_amount or 0)
+        for customer_id, total_amount, paid_amount in Order.objects
+        .values('customer_id')
+        .annotate(total=Sum('total_amount'), paid=Sum('paid_amount'))
+        .values_list('customer_id', 'total', 'paid')
+        .order_by()
+    }
+    balances = []
+    for customer_id in Customer.objects.values_list('id', flat=True):
+        total_amount, paid_amount = amounts.get(customer_id, (0, 0))
+        balances.append(CustomerBalance(
+            customer_id=customer_id,
+            total_amount=total_amount,
+            paid_amount=paid_amount,
+            balance=total_amount - paid_amount,
+        ))
+    CustomerBalance.objects.bulk_create(balances, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mill', '0023_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerBalance',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance', serialize=False, to='mill.customer')),
+                ('total_amount', models.BigIntegerField(default=0)),
+                ('paid_amount', models.BigIntegerField(default=0)),
+                ('balance', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['-balance'],
+                'indexes': [models.Index(fields=['-balance'], name='mill_custom_balance_d529f5_idx')],
+            },
+        ),
+        migrations.RunPython(populate_customer_balances,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def populate_costs(apps, schema_editor):
+    """Start every product at its purchase price; rebuild_costs replays
+    the history for exact averages."""
+    Item = apps.get_model('mill', 'Item')
+    Product = apps.get_model('mill', 'Product')
+    ProductCost = apps.get_model('mill', 'ProductCost')
+    Stock = apps.get_model('mill', 'Stock')
+    quantities = dict(Stock.objects.values_list('product_id', 'quantity'))
+    ProductCost.objects.bulk_create([
+        ProductCost(product_id=product_id,
+                    quantity=quantities.get(product_id, 0),
+                    average_cost=purchase_price)
+        for product_id, purchase_price in
+        Product.objects.values_list('id', 'purchase_price')
+    ], batch_size=1000)
+    Item.objects.update(unit_cost=Subquery(
+        Product.objects
+        .filter(pk=OuterRef('product_id'))
+        .values('purchase_price')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mill', '0024_customerbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductCost',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='cost', serialize=False, to='mill.product')),
+                ('quantity', models.IntegerField(default=0)),
+                ('average_cost', models.DecimalField(decimal_places=4, default=0, max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='customerrollup',
+            name='cost_of_sales',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='customerrollup',
+            name='returned_cost',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='unit_cost',
+            field=models.DecimalField(decimal_places=4, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='productrollup',
+            name='cost_of_sales',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='productrollup',
+            name='returned_cost',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=18),
+        ),
+        migrations.RunPython(populate_costs, migrations.RunPython.noop),
+    ]
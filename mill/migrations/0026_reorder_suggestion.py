@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mill', '0025_product_cost'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReorderSuggestion',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='reorder_suggestion', serialize=False, to='mill.product')),
+                ('quantity_in_stock', models.IntegerField(default=0)),
+                ('average_demand_7', models.FloatField(default=0)),
+                ('average_demand_28', models.FloatField(default=0)),
+                ('seasonality', models.FloatField(default=1)),
+                ('forecast_demand', models.FloatField(default=0)),
+                ('days_of_cover', models.FloatField(blank=True, null=True)),
+                ('reorder_quantity', models.PositiveIntegerField(default=0)),
+                ('stockout_risk', models.FloatField(default=0)),
+                ('computed_at', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['-stockout_risk', 'days_of_cover'],
+                'indexes': [models.Index(fields=['-stockout_risk'], name='mill_reorde_stockou_95f77f_idx')],
+            },
+        ),
+    ]
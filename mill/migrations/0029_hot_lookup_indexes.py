@@ -0,0 +1,97 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:44
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def merge_duplicate_items(apps, schema_editor):
+    """Merge the lines of an order selling the same product into its first
+    one, as ItemManager.add_item() would have, before making them unique.
+
+    The returns move to the kept line and the merged lines leave
+    tombstones for the change feed; run ``rebuild_rollups`` afterwards, as
+    their sales now count on the day of the kept line. Lines sold at
+    different prices cannot be merged without changing the order total and
+    stop the migration.
+    """
+    Item = apps.get_model('mill', 'Item')
+    Return = apps.get_model('mill', 'Return')
+    Tombstone = apps.get_model('mill', 'Tombstone')
+
+    duplicated = Item.objects\
+        .values('order_id', 'product_id')\
+        .annotate(count=models.Count('id'))\
+        .filter(count__gt=1)\
+        .values_list('order_id', 'product_id')
+    groups = defaultdict(list)
+    for item in Item.objects\
+            .filter(order_id__in={order_id for order_id, _ in duplicated})\
+            .order_by('id'):
+        groups[item.order_id, item.product_id].append(item)
+
+    now = timezone.now()
+    for (order_id, product_id), items in groups.items():
+        if len(items) < 2:
+            continue
+        if len({item.price for item in items}) > 1:
+            raise RuntimeError(
+                f'Order {order_id} sells product {product_id} at several '
+                f'prices; merge its lines by hand before migrating.')
+        kept, merged = items[0], items[1:]
+        quantity = sum(item.quantity for item in items)
+        kept.unit_cost = sum(
+            Decimal(item.quantity) * item.unit_cost for item in items
+        ) / quantity
+        kept.quantity = quantity
+        kept.updated_at = now
+        kept.save(update_fields=['quantity', 'unit_cost', 'updated_at'])
+        merged_ids = [item.id for item in merged]
+        Return.objects.filter(item_id__in=merged_ids)\
+            .update(item_id=kept.id, updated_at=now)
+        Item.objects.filter(id__in=merged_ids).delete()
+        Tombstone.objects.bulk_create([
+            Tombstone(model='item', object_id=item_id, deleted_at=now)
+            for item_id in merged_ids
+        ])
+
+
+class Migration(migrations.Migration):
+    # The merge must commit before the indexes are built: PostgreSQL
+    # refuses to alter a table with pending deferred trigger events.
+    atomic = False
+
+    dependencies = [
+        ('mill', '0028_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop,
+                             atomic=True),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['product', 'created_at'], name='mill_item_product_7d072f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', 'status', '-id'], name='mill_order_custome_e4f606_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='production',
+            index=models.Index(fields=['product', 'production_date'], name='mill_produc_product_0b64e6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['product', 'purchase_date'], name='mill_purcha_product_fc792e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='return',
+            index=models.Index(fields=['return_date'], name='mill_return_return__ef1259_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='item',
+            constraint=models.UniqueConstraint(fields=('order', 'product'), name='unique_item_product'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mill', '0030_event'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stock',
+            index=models.Index(fields=['updated_at', 'product'], name='mill_stock_updated_babe6a_idx'),
+        ),
+    ]
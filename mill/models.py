@@ -1,16 +1,29 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator
 from django.db import models, transaction
 from django.forms import ValidationError
-from django.utils.translation import gettext_lazy as _
+from django.utils import timezone
 
 from mill import constants
 
 from . import managers
 
 
+class AtomicSaveMixin:
+    """Run ``save()`` and the ``post_save`` ledger handlers in one transaction."""
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            return super().save(*args, **kwargs)
+
+
 class Product(models.Model):
     class Meta:
         ordering = ['name']
+        indexes = [
+            models.Index(fields=['updated_at', 'id'])
+        ]
 
     objects = managers.ProductManager()
     name = models.CharField(max_length=255)
@@ -22,32 +35,100 @@ class Product(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     def _get_quantity_in_stock(self):
-        return Product.objects\
-            .get_product_with_quantity_in_stock()\
-            .filter(id=self.id)\
-            .values('quantity_in_stock')\
-            .first()['quantity_in_stock']
+        return Stock.objects\
+            .filter(product_id=self.id)\
+            .values_list('quantity', flat=True)\
+            .first() or 0
 
     def validate_stock_availability(self, order_quantity):
-        product_stock = self._get_quantity_in_stock()
-        if order_quantity > product_stock:
-            raise ValidationError(
-                [
-                    ValidationError(
-                        _(f"{product_stock} {self.name} left in stock"),
-                        code="out_of_stock",
-                    )
-                ]
-            )
+        try:
+            Product.objects.validate_stock_availability(
+                {self.id: order_quantity})
+        except ValidationError as e:
+            raise ValidationError(e.error_dict[self.id])
         return True
 
     def __str__(self) -> str:
         return self.name
 
 
-class Production(models.Model):
+class Stock(models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at', 'product'])
+        ]
+
+    objects = managers.StockManager()
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stock'
+    )
+    quantity = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f'{self.product_id}: {self.quantity}'
+
+
+class ProductCost(models.Model):
+    """Running weighted-average cost of the units of a product in stock,
+    moved by every purchase, production, sale and return."""
+    objects = managers.ProductCostManager()
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='cost'
+    )
+    quantity = models.IntegerField(default=0)
+    average_cost = models.DecimalField(
+        max_digits=14, decimal_places=4, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f'{self.product_id}: {self.quantity} @ {self.average_cost}'
+
+
+class StockSnapshot(models.Model):
+    class Meta:
+        ordering = ['-taken_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['product', 'period', 'taken_at'],
+                name='unique_stock_snapshot'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['product', '-taken_at'])
+        ]
+
+    objects = managers.StockSnapshotManager()
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='stock_snapshots'
+    )
+    period = models.CharField(
+        max_length=5,
+        choices=constants.SNAPSHOT_PERIOD_CHOICES,
+        default=constants.SNAPSHOT_PERIOD_DAY
+    )
+    # Quantity made of every movement dated strictly before ``taken_at``.
+    taken_at = models.DateTimeField()
+    quantity = models.IntegerField()
+
+    def __str__(self) -> str:
+        return f'{self.taken_at}_{self.product_id}: {self.quantity}'
+
+
+class Production(AtomicSaveMixin, models.Model):
     class Meta:
         ordering = ['-production_date']
+        indexes = [
+            models.Index(fields=['product', 'production_date'])
+        ]
 
     product = models.ForeignKey(
         Product,
@@ -63,9 +144,12 @@ class Production(models.Model):
         return f'{self.production_date}_{self.product.name}'
 
 
-class Purchase(models.Model):
+class Purchase(AtomicSaveMixin, models.Model):
     class Meta:
         ordering = ['-purchase_date']
+        indexes = [
+            models.Index(fields=['product', 'purchase_date'])
+        ]
 
     product = models.ForeignKey(
         Product, on_delete=models.PROTECT,
@@ -85,6 +169,9 @@ class Purchase(models.Model):
 class Customer(models.Model):
     class Meta:
         ordering = ['surname']
+        indexes = [
+            models.Index(fields=['updated_at', 'id'])
+        ]
 
     given_name = models.CharField(max_length=255)
     surname = models.CharField(max_length=255)
@@ -97,10 +184,48 @@ class Customer(models.Model):
         return f'{self.given_name} {self.surname}'
 
 
+class CustomerBalance(models.Model):
+    """What a customer owes across all orders, refreshed together with the
+    order totals."""
+    class Meta:
+        ordering = ['-balance']
+        indexes = [
+            models.Index(fields=['-balance'])
+        ]
+
+    objects = managers.CustomerBalanceManager()
+    customer = models.OneToOneField(
+        Customer,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='balance'
+    )
+    total_amount = models.BigIntegerField(default=0)
+    paid_amount = models.BigIntegerField(default=0)
+    balance = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f'{self.customer_id}: {self.balance}'
+
+
 class Order(models.Model):
     class Meta:
         ordering = ['-id']
-
+        indexes = [
+            models.Index(
+                models.F('total_amount') - models.F('paid_amount'),
+                name='order_remain_amount_idx'
+            ),
+            models.Index(fields=['updated_at', 'id']),
+            models.Index(fields=['customer', 'status', '-id']),
+        ]
+
+    # Running totals kept by OrderQuerySet.refresh_amounts() on writes to
+    # items, returns and payments.
+    AMOUNT_FIELDS = ['total_amount', 'paid_amount', 'returned_amount']
+
+    objects = managers.OrderQuerySet.as_manager()
     customer = models.ForeignKey(
         Customer,
         on_delete=models.PROTECT,
@@ -111,9 +236,22 @@ class Order(models.Model):
         choices=constants.ORDER_STATUS_CHOICES,
         default=constants.ORDER_STATUS_UNPAID
     )
+    total_amount = models.BigIntegerField(default=0, editable=False)
+    paid_amount = models.BigIntegerField(default=0, editable=False)
+    returned_amount = models.BigIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    def save(self, *args, **kwargs):
+        # Never write back running totals that may be stale in memory.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.AMOUNT_FIELDS
+            ]
+        return super().save(*args, **kwargs)
+
     def get_total_amount(self):
         return sum(item.get_net_quantity() * item.price for item in self.items.all())
 
@@ -124,9 +262,21 @@ class Order(models.Model):
         return f"Order {self.pk} - {self.customer.surname} ({self.status})"
 
 
-class Item(models.Model):
+class Item(AtomicSaveMixin, models.Model):
     class Meta:
         ordering = ['-id']
+        # An order has one line per product: ItemManager.add_item() adds to
+        # the quantity of the existing line.
+        constraints = [
+            models.UniqueConstraint(
+                fields=['order', 'product'],
+                name='unique_item_product'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['updated_at', 'id']),
+            models.Index(fields=['product', 'created_at']),
+        ]
 
     product = models.ForeignKey(
         Product,
@@ -141,6 +291,12 @@ class Item(models.Model):
         on_delete=models.PROTECT,
         related_name='items'
     )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Weighted-average cost of the units sold, set by ProductCost when the
+    # line takes them out of stock.
+    unit_cost = models.DecimalField(
+        max_digits=14, decimal_places=4, default=0, editable=False)
 
     def __get_total_returns(self):
         return sum(returned.quantity for returned in self.returns.all())
@@ -150,7 +306,15 @@ class Item(models.Model):
 
     def update_quantity(self, new_quantity):
         with transaction.atomic():
-            self.product.validate_stock_availability(new_quantity)
+            saved_quantity = Item.objects\
+                .select_for_update()\
+                .filter(pk=self.pk)\
+                .values_list('quantity', flat=True)\
+                .first() or 0
+            if new_quantity > saved_quantity:
+                Stock.objects.reserve(
+                    {self.product_id: new_quantity - saved_quantity})
+                self._stock_reserved = True
             self.quantity = new_quantity
             self.save()
 
@@ -158,9 +322,13 @@ class Item(models.Model):
         return self.product.name
 
 
-class Return(models.Model):
+class Return(AtomicSaveMixin, models.Model):
     class Meta:
         ordering = ['-id']
+        indexes = [
+            models.Index(fields=['updated_at', 'id']),
+            models.Index(fields=['return_date']),
+        ]
 
     item = models.ForeignKey(
         Item, on_delete=models.PROTECT, related_name='returns')
@@ -174,7 +342,13 @@ class Return(models.Model):
         return f'Return of {self.quantity} for {self.item}'
 
 
-class Payment(models.Model):
+class Payment(AtomicSaveMixin, models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at', 'id'])
+        ]
+
+    objects = managers.PaymentManager()
     amount = models.PositiveBigIntegerField(validators=[MinValueValidator(1)])
     order = models.ForeignKey(
         Order,
@@ -199,3 +373,168 @@ class Payment(models.Model):
     def get_total_payments(cls, order):
         return cls.objects.filter(order=order)\
             .aggregate(total=models.Sum('amount'))['total'] or 0
+
+
+class ProductRollup(models.Model):
+    """Daily sales, returns, production and purchases of a product,
+    maintained from the writes of those movements."""
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['product', 'day'],
+                name='unique_product_rollup'
+            )
+        ]
+
+    objects = managers.ProductRollupManager()
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='rollups'
+    )
+    day = models.DateField()
+    units_sold = models.IntegerField(default=0)
+    revenue = models.BigIntegerField(default=0)
+    units_returned = models.IntegerField(default=0)
+    returned_amount = models.BigIntegerField(default=0)
+    cost_of_sales = models.DecimalField(
+        max_digits=18, decimal_places=4, default=0)
+    returned_cost = models.DecimalField(
+        max_digits=18, decimal_places=4, default=0)
+    units_produced = models.IntegerField(default=0)
+    units_purchased = models.IntegerField(default=0)
+    purchase_cost = models.BigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f'{self.day}_{self.product_id}'
+
+
+class CustomerRollup(models.Model):
+    """Daily sales, returns and payments of a customer, maintained from
+    the writes of items, returns and payments."""
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['customer', 'day'],
+                name='unique_customer_rollup'
+            )
+        ]
+
+    objects = managers.CustomerRollupManager()
+    customer = models.ForeignKey(
+        Customer,
+        on_delete=models.CASCADE,
+        related_name='rollups'
+    )
+    day = models.DateField()
+    units_sold = models.IntegerField(default=0)
+    revenue = models.BigIntegerField(default=0)
+    units_returned = models.IntegerField(default=0)
+    returned_amount = models.BigIntegerField(default=0)
+    cost_of_sales = models.DecimalField(
+        max_digits=18, decimal_places=4, default=0)
+    returned_cost = models.DecimalField(
+        max_digits=18, decimal_places=4, default=0)
+    paid_amount = models.BigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f'{self.day}_{self.customer_id}'
+
+
+class ReorderSuggestion(models.Model):
+    """Demand forecast and reorder quantity of a product, recomputed from
+    the daily rollups by ``forecast_stock``."""
+    class Meta:
+        ordering = ['-stockout_risk', 'days_of_cover']
+        indexes = [
+            models.Index(fields=['-stockout_risk'])
+        ]
+
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='reorder_suggestion'
+    )
+    quantity_in_stock = models.IntegerField(default=0)
+    # Mean daily net sales over the last 7 and 28 days.
+    average_demand_7 = models.FloatField(default=0)
+    average_demand_28 = models.FloatField(default=0)
+    # Weekday demand of the forecast horizon relative to an average day.
+    seasonality = models.FloatField(default=1)
+    forecast_demand = models.FloatField(default=0)
+    # Days the stock lasts at the forecast rate; null without demand.
+    days_of_cover = models.FloatField(null=True, blank=True)
+    reorder_quantity = models.PositiveIntegerField(default=0)
+    # Probability that demand over the lead time exceeds the stock.
+    stockout_risk = models.FloatField(default=0)
+    computed_at = models.DateTimeField()
+
+    def __str__(self) -> str:
+        return f'{self.product_id}: {self.reorder_quantity}'
+
+
+class Tombstone(models.Model):
+    """Record of a deleted row, so the change feed can tell clients to
+    drop their copy."""
+    class Meta:
+        ordering = ['deleted_at', 'id']
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'])
+        ]
+
+    model = models.CharField(max_length=20)
+    object_id = models.PositiveBigIntegerField()
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self) -> str:
+        return f'{self.model} {self.object_id}'
+
+
+class Event(models.Model):
+    """Committed change published on the live event stream, read by
+    every process serving it."""
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['created_at'])
+        ]
+
+    event = models.CharField(max_length=10)
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self) -> str:
+        return f'{self.event} {self.id}'
+
+
+class IdempotencyKey(models.Model):
+    """Response of a write sent with an ``Idempotency-Key`` header, replayed
+    when the client retries with the same key."""
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'key'],
+                name='unique_idempotency_key'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['created_at'])
+        ]
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='idempotency_keys'
+    )
+    key = models.CharField(max_length=255)
+    # Hash of the method, path and body the key was first sent with.
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    response = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return f'{self.user_id}: {self.key}'
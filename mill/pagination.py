@@ -1,5 +1,76 @@
+from rest_framework.pagination import BasePagination
+from rest_framework.pagination import CursorPagination as BaseCursorPagination
 from rest_framework.pagination import PageNumberPagination as BasePageNumberPagination
 
 
 class PageNumberPagination(BasePageNumberPagination):
     page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class CursorPagination(BaseCursorPagination):
+    """Keyset pagination on the primary key, newest first.
+
+    Pages are fetched with a ``WHERE`` on the key instead of an ``OFFSET``
+    and no ``COUNT(*)`` is run, so deep pages cost the same as the first one.
+
+    The cursor only encodes the first ordering field and falls back to an
+    offset among rows tied on it, which skips or repeats rows when they
+    change between pages. The ordering is therefore always the unique
+    ``-pk``: the model's ``Meta.ordering`` and ``?ordering`` are ignored in
+    cursor mode.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-pk'
+
+    def get_ordering(self, request, queryset, view):
+        # Not the view's OrderingFilter, which may order on a tied column.
+        return (self.ordering,)
+
+
+class SelectablePagination(BasePagination):
+    """Paginate by page number, or by cursor when the request asks for it
+    with ``?pagination=cursor`` or carries a ``cursor``."""
+    default_pagination_class = PageNumberPagination
+    cursor_pagination_class = CursorPagination
+
+    def __init__(self):
+        self.paginator = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        query_params = request.query_params
+        if query_params.get('pagination') == 'cursor' \
+                or self.cursor_pagination_class.cursor_query_param in query_params:
+            self.paginator = self.cursor_pagination_class()
+        elif self.default_pagination_class is not None:
+            self.paginator = self.default_pagination_class()
+        else:
+            return None
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        return self.default_pagination_class().get_paginated_response_schema(
+            schema)
+
+    def get_schema_operation_parameters(self, view):
+        return self.default_pagination_class().get_schema_operation_parameters(
+            view)
+
+
+class OptionalCursorPagination(SelectablePagination):
+    """Leave the list unpaginated unless a cursor page is asked for."""
+    default_pagination_class = None
+
+    def get_paginated_response_schema(self, schema):
+        return self.cursor_pagination_class().get_paginated_response_schema(
+            schema)
+
+    def get_schema_operation_parameters(self, view):
+        return self.cursor_pagination_class().get_schema_operation_parameters(
+            view)
@@ -0,0 +1,54 @@
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA = 'replica'
+# Longest replication lag expected: a user who just wrote reads from the
+# primary for this long.
+PIN_SECONDS = 5
+PIN_KEY = 'mill:replica:pin:{}'
+
+_state = threading.local()
+
+
+def has_replica():
+    return REPLICA in settings.DATABASES
+
+
+def read_from_replica(active):
+    """Route the reads of the current request to the replica, or back to
+    the primary."""
+    _state.active = active
+
+
+def pin_primary(user):
+    """Keep the reads of ``user`` on the primary for ``PIN_SECONDS``."""
+    if has_replica():
+        cache.set(PIN_KEY.format(user.pk), True, PIN_SECONDS)
+
+
+def is_pinned(user):
+    return user.is_authenticated and cache.get(PIN_KEY.format(user.pk), False)
+
+
+class ReplicaRouter:
+    """Send reads to the ``replica`` database while a request opted in with
+    read_from_replica(), and everything else to the primary.
+
+    Without a ``replica`` alias every query goes to ``default``.
+    """
+
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'active', False) and has_replica():
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Also for instances read from the replica.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data.
+        return True
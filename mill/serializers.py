@@ -1,15 +1,19 @@
 from django.db import transaction
-from django.db.models import Sum
 from django.forms import ValidationError
+from django.http import Http404
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 from django.db import models, transaction
 
-from mill.constants import (ORDER_STATUS_CHOICES, ORDER_STATUS_PAID,
-                            ORDER_STATUS_REMAIN, ORDER_STATUS_UNPAID)
-from mill.models import (Customer, Item, Order, Payment, Product, Production,
-                         Purchase, Return)
+from mill import events, export, sync
+from mill.constants import (ORDER_STATUS_CHOICES, REPORT_PERIOD_CHOICES,
+                            REPORT_PERIOD_DAY)
+from mill.models import (Customer, CustomerBalance, CustomerRollup, Item,
+                         Order, Payment, Product, ProductCost, ProductRollup,
+                         Production, Purchase, ReorderSuggestion, Return,
+                         Stock)
 
 
 class ProductSerializer(serializers.ModelSerializer):
@@ -62,6 +66,8 @@ class ItemSerializer(serializers.ModelSerializer):
     line_amount = serializers.SerializerMethodField()
 
     def get_line_amount(self, item: Item):
+        if hasattr(item, 'line_amount'):
+            return item.line_amount
         return item.get_net_quantity() * item.price
 
 
@@ -70,54 +76,62 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         fields = ['id', 'customer', 'status',
                   'items', 'remain_amount', 'total_amount']
+        read_only_fields = ['status']
 
     items = ItemSerializer(many=True, read_only=True)
-    total_amount = serializers.SerializerMethodField()
+    total_amount = serializers.ReadOnlyField()
     remain_amount = serializers.SerializerMethodField()
-    status = serializers.ChoiceField(
-        choices=ORDER_STATUS_CHOICES,
-        default=ORDER_STATUS_UNPAID,
-    )
 
     def get_remain_amount(self, order: Order):
-        return self.get_total_amount(order) - order.get_total_amount_payment()
-
-    def get_total_amount(self, order: Order):
-        return order.get_total_amount()
+        if hasattr(order, 'remain_amount'):
+            return order.remain_amount
+        return order.total_amount - order.paid_amount
 
 
 class PaymentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = ['id', 'amount', 'order', 'status', 'method']
+        read_only_fields = ['order']
 
-    def save(self, **kwargs):
-        with transaction.atomic():
-            order_id = self.context['order_id']
-            order = get_object_or_404(Order, pk=order_id)
+    def create(self, validated_data):
+        try:
+            payment, = Payment.objects.post([
+                Payment(order_id=int(self.context['order_id']),
+                        **validated_data)
+            ])
+        except (ValueError, ValidationError):
+            raise Http404
+        return payment
 
-            order.payments.create(amount=self.validated_data['amount'])
-            total_payment_amount = order.payments\
-                .aggregate(total=Sum('amount'))['total']
 
-            order.status = ORDER_STATUS_PAID if \
-                order.get_total_amount() == total_payment_amount\
-                else ORDER_STATUS_REMAIN
+class BatchPaymentListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        try:
+            return Payment.objects.post([
+                Payment(**payment) for payment in validated_data
+            ])
+        except ValidationError as e:
+            raise serializers.ValidationError({'order': e.messages})
 
-            order.save()
 
-            return super().save(**kwargs)
+class BatchPaymentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Payment
+        fields = ['id', 'amount', 'order', 'status', 'method']
+        list_serializer_class = BatchPaymentListSerializer
+
+    MAX_BATCH_SIZE = 1000
+
+    order = serializers.IntegerField(source='order_id')
 
 
 class UpdateOrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = ['status']
-
-    status = serializers.ChoiceField(
-        choices=ORDER_STATUS_CHOICES,
-        default=ORDER_STATUS_UNPAID
-    )
+        # Follows the totals, see OrderQuerySet.refresh_amounts().
+        read_only_fields = ['status']
 
 
 class UpdateItemSerializer(serializers.ModelSerializer):
@@ -127,11 +141,14 @@ class UpdateItemSerializer(serializers.ModelSerializer):
 
     quantity = serializers.IntegerField(min_value=1)
 
-    def validate_quantity(self, value):
-        item = self.instance
-        product = item.product
-        product.validate_stock_availability(value)
-        return value
+    def update(self, instance, validated_data):
+        try:
+            instance.update_quantity(validated_data['quantity'])
+        except ValidationError as e:
+            raise serializers.ValidationError(
+                {"quantity": e.messages}, code='invalid'
+            )
+        return instance
 
 
 class AddItemSerializer(serializers.ModelSerializer):
@@ -157,6 +174,272 @@ class AddItemSerializer(serializers.ModelSerializer):
             )
         except ValidationError as e:
             raise serializers.ValidationError(
-                {"quantity": list(e)}, code='invalid'
+                {"quantity": e.messages}, code='invalid'
             )
         return item
+
+
+class OrderLineSerializer(serializers.Serializer):
+    product = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class OrderPaymentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Payment
+        fields = ['amount', 'method']
+
+
+class CreateOrderSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Order
+        fields = ['id', 'customer', 'status', 'items', 'payment']
+        read_only_fields = ['status']
+
+    items = OrderLineSerializer(many=True, required=False, write_only=True)
+    payment = OrderPaymentSerializer(required=False, write_only=True)
+
+    def validate(self, attrs):
+        lines = attrs.get('items', [])
+        quantities = {}
+        for line in lines:
+            quantities[line['product']] = \
+                quantities.get(line['product'], 0) + line['quantity']
+
+        report = Product.objects.get_stock_report(quantities)
+
+        errors = []
+        for line in lines:
+            stock = report.get(line['product'])
+            if stock is None:
+                errors.append({'product': [
+                    _(f"Invalid pk \"{line['product']}\" - object does not exist.")
+                ]})
+            elif stock['shortfall']:
+                errors.append({'quantity': list(
+                    Product.objects.get_out_of_stock_error(stock))})
+            else:
+                errors.append({})
+        if any(errors):
+            raise serializers.ValidationError({'items': errors})
+
+        attrs['items'] = [
+            (report[product_id]['product'], quantity)
+            for product_id, quantity in quantities.items()
+        ]
+
+        payment = attrs.get('payment')
+        if payment:
+            is_supplier = attrs['customer'].is_supplier
+            total = sum(
+                quantity * (product.purchase_price if is_supplier
+                            else product.customer_price)
+                for product, quantity in attrs['items']
+            )
+            if payment['amount'] > total:
+                raise serializers.ValidationError({'payment': {'amount': [
+                    _(f'The payment exceeds the order total of {total}.')
+                ]}})
+        return attrs
+
+    def create(self, validated_data):
+        lines = validated_data.pop('items', [])
+        payment = validated_data.pop('payment', None)
+        customer = validated_data['customer']
+
+        items = [
+            Item(
+                product=product,
+                quantity=quantity,
+                price=product.purchase_price
+                if customer.is_supplier
+                else product.customer_price
+            )
+            for product, quantity in lines
+        ]
+        with transaction.atomic():
+            try:
+                Stock.objects.reserve({
+                    item.product_id: item.quantity for item in items
+                })
+            except ValidationError as e:
+                raise serializers.ValidationError({'items': e.messages})
+            order = Order.objects.create(**validated_data)
+            unit_costs = ProductCost.objects.consume({
+                item.product_id: item.quantity for item in items
+            })
+            for item in items:
+                item.order = order
+                item.unit_cost = unit_costs[item.product_id]
+            Item.objects.bulk_create(items)
+            payments = Payment.objects.bulk_create(
+                [Payment(order=order, **payment)] if payment else [])
+            Order.objects.filter(pk=order.pk).refresh_amounts()
+
+            # bulk_create sends no signals, so queue the rollups here.
+            ProductRollup.objects.refresh_on_commit(
+                [(item.product_id, timezone.localdate(item.created_at))
+                 for item in items], Item)
+            CustomerRollup.objects.refresh_on_commit(
+                [(customer.id, timezone.localdate(item.created_at))
+                 for item in items], Item)
+            CustomerRollup.objects.refresh_on_commit(
+                [(customer.id, timezone.localdate(payment.created_at))
+                 for payment in payments], Payment)
+
+        return order
+
+    def to_representation(self, instance):
+        order = Order.objects\
+            .annotate_amounts()\
+            .prefetch_items()\
+            .get(pk=instance.pk)
+        return OrderSerializer(order, context=self.context).data
+
+
+class ExportSerializer(serializers.Serializer):
+    dataset = serializers.ChoiceField(choices=list(export.DATASETS),
+                                      default='orders')
+    output = serializers.ChoiceField(choices=export.FORMAT_CHOICES,
+                                     default=export.FORMAT_CSV)
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+    status = serializers.ChoiceField(choices=ORDER_STATUS_CHOICES,
+                                     required=False)
+    customer = serializers.IntegerField(required=False)
+
+
+class EventStreamSerializer(serializers.Serializer):
+    events = serializers.MultipleChoiceField(
+        choices=events.EVENT_CHOICES, required=False)
+    products = serializers.ListField(
+        child=serializers.IntegerField(), required=False)
+    last_event_id = serializers.CharField(required=False)
+
+
+class ProductionImportSerializer(serializers.Serializer):
+    """Validate one imported production row; the product is checked
+    against a preloaded map instead of a query per row."""
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+    production_date = serializers.DateTimeField()
+
+
+class PurchaseImportSerializer(ProductionImportSerializer):
+    production_date = None
+    purchase_unit_price = serializers.IntegerField(min_value=1)
+    purchase_date = serializers.DateTimeField()
+
+
+def _get_cost_field(**kwargs):
+    return serializers.DecimalField(
+        max_digits=18, decimal_places=2, coerce_to_string=False,
+        read_only=True, **kwargs)
+
+
+class RollupReportParamsSerializer(serializers.Serializer):
+    period = serializers.ChoiceField(choices=REPORT_PERIOD_CHOICES,
+                                     default=REPORT_PERIOD_DAY)
+    since = serializers.DateField(required=False)
+    until = serializers.DateField(required=False)
+
+
+class RollupReportSerializer(serializers.Serializer):
+    period = serializers.DateField()
+    units_sold = serializers.IntegerField(source='total_units_sold')
+    revenue = serializers.IntegerField(source='total_revenue')
+    units_returned = serializers.IntegerField(source='total_units_returned')
+    returned_amount = serializers.IntegerField(source='total_returned_amount')
+    net_revenue = serializers.IntegerField()
+    cost_of_sales = _get_cost_field(source='total_cost_of_sales')
+    returned_cost = _get_cost_field(source='total_returned_cost')
+    gross_margin = _get_cost_field()
+
+
+class ProductRollupReportSerializer(RollupReportSerializer):
+    product = serializers.IntegerField()
+    units_produced = serializers.IntegerField(source='total_units_produced')
+    units_purchased = serializers.IntegerField(source='total_units_purchased')
+    purchase_cost = serializers.IntegerField(source='total_purchase_cost')
+
+
+class CustomerRollupReportSerializer(RollupReportSerializer):
+    customer = serializers.IntegerField()
+    paid_amount = serializers.IntegerField(source='total_paid_amount')
+
+
+class CustomerBalanceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CustomerBalance
+        fields = ['customer', 'given_name', 'surname', 'total_amount',
+                  'paid_amount', 'balance', 'aging_0_30', 'aging_31_60',
+                  'aging_61_90', 'aging_over_90', 'updated_at']
+
+    given_name = serializers.ReadOnlyField(source='customer.given_name')
+    surname = serializers.ReadOnlyField(source='customer.surname')
+    aging_0_30 = serializers.ReadOnlyField()
+    aging_31_60 = serializers.ReadOnlyField()
+    aging_61_90 = serializers.ReadOnlyField()
+    aging_over_90 = serializers.ReadOnlyField()
+
+
+class ReorderSuggestionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ReorderSuggestion
+        fields = ['product', 'product_name', 'quantity_in_stock',
+                  'average_demand_7', 'average_demand_28', 'seasonality',
+                  'forecast_demand', 'days_of_cover', 'reorder_quantity',
+                  'stockout_risk', 'computed_at']
+
+    product_name = serializers.ReadOnlyField(source='product.name')
+
+
+class StatementSerializer(serializers.Serializer):
+    output = serializers.ChoiceField(choices=export.FORMAT_CHOICES,
+                                     default=export.FORMAT_CSV)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+
+
+class SyncSerializer(serializers.Serializer):
+    token = serializers.CharField(required=False)
+    updated_since = serializers.DateTimeField(required=False)
+    page_size = serializers.IntegerField(
+        min_value=1, max_value=sync.MAX_PAGE_SIZE, default=sync.PAGE_SIZE)
+
+    def validate(self, data):
+        if 'token' in data and 'updated_since' in data:
+            raise serializers.ValidationError(
+                'Pass either a token or updated_since, not both.')
+        return data
+
+
+class ItemMarginSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Item
+        fields = ['id', 'product', 'price', 'quantity', 'net_quantity',
+                  'line_amount', 'unit_cost', 'line_cost', 'line_margin']
+
+    net_quantity = serializers.ReadOnlyField()
+    line_amount = serializers.ReadOnlyField()
+    unit_cost = _get_cost_field()
+    line_cost = _get_cost_field()
+    line_margin = _get_cost_field()
+
+
+class OrderMarginSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Order
+        fields = ['id', 'customer', 'created_at', 'total_amount',
+                  'cost_amount', 'gross_margin', 'margin_rate', 'items']
+
+    total_amount = serializers.ReadOnlyField()
+    cost_amount = _get_cost_field()
+    gross_margin = _get_cost_field()
+    margin_rate = serializers.SerializerMethodField()
+    items = ItemMarginSerializer(many=True, source='margin_items')
+
+    def get_margin_rate(self, order):
+        if not order.total_amount:
+            return None
+        return round(float(order.gross_margin) / order.total_amount, 4)
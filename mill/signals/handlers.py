@@ -0,0 +1,388 @@
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
+from django.dispatch import receiver
+from django.utils import timezone
+
+from mill import events, sync
+from mill.cache import invalidate_products
+from mill.models import (Customer, CustomerBalance, CustomerRollup, Item,
+                         Order, Payment, Product, ProductCost, ProductRollup,
+                         Production, Purchase, Return, Stock, StockSnapshot,
+                         Tombstone)
+
+# Direction in which each movement moves the stock of its product, and the
+# field dating the movement.
+STOCK_MOVEMENTS = {
+    Purchase: (1, 'purchase_date'),
+    Production: (1, 'production_date'),
+    Item: (-1, 'created_at'),
+    Return: (1, 'return_date'),
+}
+
+# Change feed label of each synced model, recorded on its tombstones.
+SYNCED_LABELS = {model: label for label, (model, _) in sync.MODELS.items()}
+
+
+def _get_stock_position(instance):
+    _, date_field = STOCK_MOVEMENTS[type(instance)]
+    moved_at = getattr(instance, date_field)
+    if isinstance(instance, Return):
+        product_id = Item.objects\
+            .filter(pk=instance.item_id)\
+            .values_list('product_id', flat=True)\
+            .first()
+        return product_id, instance.quantity, moved_at
+    return instance.product_id, instance.quantity, moved_at
+
+
+def _get_saved_stock_position(sender, pk):
+    _, date_field = STOCK_MOVEMENTS[sender]
+    product_field = 'item__product_id' if sender is Return else 'product_id'
+    return sender.objects\
+        .filter(pk=pk)\
+        .values_list(product_field, 'quantity', date_field)\
+        .first()
+
+
+def _apply_stock_movements(movements, reserved=False):
+    deltas = {}
+    for product_id, delta, moved_at in movements:
+        deltas[product_id] = deltas.get(product_id, 0) + delta
+        StockSnapshot.objects.shift(product_id, moved_at, delta)
+    # Reserved movements were already taken off the ledger by
+    # StockManager.reserve().
+    if not reserved:
+        Stock.objects.adjust(deltas)
+    # Stock.objects.adjust() only expires the products whose quantity
+    # changed; a movement only redated still changes their as_of stock.
+    unchanged = [product_id for product_id, delta in deltas.items()
+                 if not delta]
+    if unchanged:
+        invalidate_products(unchanged)
+
+
+@receiver(post_save, sender=Product)
+def create_product_stock(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        Stock.objects.get_or_create(product=instance)
+
+
+@receiver(post_save, sender=Customer)
+def create_customer_balance(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        CustomerBalance.objects.get_or_create(customer=instance)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    invalidate_products([instance.pk])
+
+
+@receiver(pre_save, sender=Purchase)
+@receiver(pre_save, sender=Production)
+@receiver(pre_save, sender=Item)
+@receiver(pre_save, sender=Return)
+def remember_stock_position(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        instance._saved_stock_position = None
+        return
+    instance._saved_stock_position = _get_saved_stock_position(
+        sender, instance.pk)
+
+
+@receiver(post_save, sender=Purchase)
+@receiver(post_save, sender=Production)
+@receiver(post_save, sender=Item)
+@receiver(post_save, sender=Return)
+def update_stock_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    sign, _ = STOCK_MOVEMENTS[sender]
+    movements = []
+
+    saved_position = getattr(instance, '_saved_stock_position', None)
+    if saved_position is not None:
+        product_id, quantity, moved_at = saved_position
+        movements.append((product_id, -sign * quantity, moved_at))
+
+    product_id, quantity, moved_at = _get_stock_position(instance)
+    movements.append((product_id, sign * quantity, moved_at))
+
+    reserved = getattr(instance, '_stock_reserved', False)
+    instance._saved_stock_position = None
+    instance._stock_reserved = False
+    _apply_stock_movements(movements, reserved=reserved)
+
+
+@receiver(post_delete, sender=Purchase)
+@receiver(post_delete, sender=Production)
+@receiver(post_delete, sender=Item)
+@receiver(post_delete, sender=Return)
+def update_stock_on_delete(sender, instance, **kwargs):
+    sign, _ = STOCK_MOVEMENTS[sender]
+    product_id, quantity, moved_at = _get_stock_position(instance)
+    if product_id is not None:
+        _apply_stock_movements([(product_id, -sign * quantity, moved_at)])
+
+
+def _get_order_id(instance):
+    if isinstance(instance, Return):
+        return Item.objects\
+            .filter(pk=instance.item_id)\
+            .values_list('order_id', flat=True)\
+            .first()
+    return instance.order_id
+
+
+@receiver(pre_save, sender=Item)
+@receiver(pre_save, sender=Payment)
+def remember_order(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        instance._saved_order_id = None
+        return
+    instance._saved_order_id = sender.objects\
+        .filter(pk=instance.pk)\
+        .values_list('order_id', flat=True)\
+        .first()
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_save, sender=Return)
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Item)
+@receiver(post_delete, sender=Return)
+@receiver(post_delete, sender=Payment)
+def update_order_amounts(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    order_ids = {
+        _get_order_id(instance),
+        getattr(instance, '_saved_order_id', None),
+    } - {None}
+    instance._saved_order_id = None
+    Order.objects.filter(pk__in=order_ids).refresh_amounts()
+
+
+@receiver(pre_save, sender=Order)
+def remember_customer(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        instance._saved_customer_id = None
+        return
+    instance._saved_customer_id = Order.objects\
+        .filter(pk=instance.pk)\
+        .values_list('customer_id', flat=True)\
+        .first()
+
+
+@receiver(post_save, sender=Order)
+def publish_order(sender, instance, raw=False, **kwargs):
+    if not raw:
+        events.publish_on_commit(events.EVENT_ORDER, [instance.pk])
+
+
+@receiver(post_save, sender=Order)
+def move_customer_balance(sender, instance, created, raw=False, **kwargs):
+    # New orders carry no amounts yet: their items and payments refresh
+    # the balance through Order.refresh_amounts().
+    saved_customer_id = getattr(instance, '_saved_customer_id', None)
+    instance._saved_customer_id = None
+    if raw or created or saved_customer_id == instance.customer_id:
+        return
+    CustomerBalance.objects.refresh(
+        {instance.customer_id, saved_customer_id} - {None})
+
+
+@receiver(post_delete, sender=Order)
+def update_customer_balance_on_delete(sender, instance, **kwargs):
+    CustomerBalance.objects.refresh([instance.customer_id])
+
+
+def _get_rollup_cells(sender, pk):
+    """Return ``[(rollup manager, (key_id, day))]`` for the saved row."""
+    sources = [
+        (manager, key_field, date_field)
+        for manager in [ProductRollup.objects, CustomerRollup.objects]
+        for queryset, key_field, date_field, _ in manager.get_sources()
+        if queryset.model is sender
+    ]
+    row = sender.objects.filter(pk=pk).values_list(*[
+        field for _, key_field, date_field in sources
+        for field in (key_field, date_field)
+    ]).first()
+    if row is None:
+        return []
+    return [
+        (manager, (row[2 * index], timezone.localdate(row[2 * index + 1])))
+        for index, (manager, _, _) in enumerate(sources)
+    ]
+
+
+def _refresh_rollups(sender, cells):
+    for manager, cell in cells:
+        manager.refresh_on_commit([cell], sender)
+
+
+@receiver(pre_save, sender=Purchase)
+@receiver(pre_save, sender=Production)
+@receiver(pre_save, sender=Item)
+@receiver(pre_save, sender=Return)
+@receiver(pre_save, sender=Payment)
+def remember_rollup_cells(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        instance._saved_rollup_cells = []
+        return
+    instance._saved_rollup_cells = _get_rollup_cells(sender, instance.pk)
+
+
+@receiver(post_save, sender=Purchase)
+@receiver(post_save, sender=Production)
+@receiver(post_save, sender=Item)
+@receiver(post_save, sender=Return)
+@receiver(post_save, sender=Payment)
+def update_rollups_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    cells = getattr(instance, '_saved_rollup_cells', [])
+    instance._saved_rollup_cells = []
+    _refresh_rollups(sender, cells + _get_rollup_cells(sender, instance.pk))
+
+
+@receiver(pre_delete, sender=Purchase)
+@receiver(pre_delete, sender=Production)
+@receiver(pre_delete, sender=Item)
+@receiver(pre_delete, sender=Return)
+@receiver(pre_delete, sender=Payment)
+def update_rollups_on_delete(sender, instance, **kwargs):
+    # The rows are refreshed once the deletion commits.
+    _refresh_rollups(sender, _get_rollup_cells(sender, instance.pk))
+
+
+@receiver(pre_save, sender=Purchase)
+def remember_purchase_cost(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        instance._saved_purchase_cost = None
+        return
+    instance._saved_purchase_cost = Purchase.objects\
+        .filter(pk=instance.pk)\
+        .values_list('product_id', 'quantity', 'purchase_unit_price')\
+        .first()
+
+
+@receiver(post_save, sender=Purchase)
+def update_cost_on_purchase(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    receipts = []
+    saved = getattr(instance, '_saved_purchase_cost', None)
+    instance._saved_purchase_cost = None
+    if saved is not None:
+        product_id, quantity, unit_cost = saved
+        receipts.append((product_id, -quantity, unit_cost))
+    receipts.append((instance.product_id, instance.quantity,
+                     instance.purchase_unit_price))
+    ProductCost.objects.receive(receipts)
+
+
+@receiver(pre_save, sender=Production)
+@receiver(pre_save, sender=Return)
+def remember_cost_position(sender, instance, raw=False, **kwargs):
+    # update_stock_on_save() clears the stock position before the cost
+    # handlers run, so keep a copy.
+    instance._saved_cost_position = getattr(
+        instance, '_saved_stock_position', None)
+
+
+@receiver(post_save, sender=Production)
+def update_cost_on_production(sender, instance, raw=False, **kwargs):
+    # Produced units are costed at the product's purchase price.
+    if raw:
+        return
+    receipts = []
+    saved = getattr(instance, '_saved_cost_position', None)
+    instance._saved_cost_position = None
+    if saved is not None:
+        product_id, quantity, _ = saved
+        receipts.append((product_id, -quantity, None))
+    receipts.append((instance.product_id, instance.quantity, None))
+    ProductCost.objects.receive(receipts)
+
+
+@receiver(pre_save, sender=Item)
+def cost_item(sender, instance, raw=False, **kwargs):
+    """Take the units sold out of stock at the average cost and record it
+    on the line before it is written."""
+    if raw:
+        return
+    saved = getattr(instance, '_saved_stock_position', None)
+    if saved is not None and saved[0] == instance.product_id:
+        added = instance.quantity - saved[1]
+        if added < 0:
+            ProductCost.objects.receive(
+                [(instance.product_id, -added, instance.unit_cost)])
+        elif added > 0:
+            average_cost = ProductCost.objects.consume(
+                {instance.product_id: added})[instance.product_id]
+            instance.unit_cost = (
+                saved[1] * instance.unit_cost + added * average_cost
+            ) / instance.quantity
+        return
+
+    if saved is not None:
+        product_id, quantity, _ = saved
+        ProductCost.objects.receive(
+            [(product_id, quantity, instance.unit_cost)])
+    instance.unit_cost = ProductCost.objects.consume(
+        {instance.product_id: instance.quantity})[instance.product_id]
+
+
+@receiver(post_save, sender=Return)
+def update_cost_on_return(sender, instance, raw=False, **kwargs):
+    # Returned units come back at the cost they were sold at.
+    if raw:
+        return
+    product_id, unit_cost = Item.objects\
+        .filter(pk=instance.item_id)\
+        .values_list('product_id', 'unit_cost')\
+        .first()
+    receipts = []
+    saved = getattr(instance, '_saved_cost_position', None)
+    instance._saved_cost_position = None
+    if saved is not None:
+        receipts.append((saved[0], -saved[1], unit_cost))
+    receipts.append((product_id, instance.quantity, unit_cost))
+    ProductCost.objects.receive(receipts)
+
+
+@receiver(post_delete, sender=Purchase)
+@receiver(post_delete, sender=Production)
+@receiver(post_delete, sender=Item)
+@receiver(post_delete, sender=Return)
+def update_cost_on_delete(sender, instance, **kwargs):
+    if sender is Purchase:
+        receipt = (instance.product_id, -instance.quantity,
+                   instance.purchase_unit_price)
+    elif sender is Production:
+        receipt = (instance.product_id, -instance.quantity, None)
+    elif sender is Item:
+        receipt = (instance.product_id, instance.quantity, instance.unit_cost)
+    else:
+        item = Item.objects\
+            .filter(pk=instance.item_id)\
+            .values_list('product_id', 'unit_cost')\
+            .first()
+        if item is None:
+            return
+        receipt = (item[0], -instance.quantity, item[1])
+    ProductCost.objects.receive([receipt])
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Customer)
+@receiver(post_delete, sender=Order)
+@receiver(post_delete, sender=Item)
+@receiver(post_delete, sender=Payment)
+@receiver(post_delete, sender=Return)
+def leave_tombstone(sender, instance, **kwargs):
+    Tombstone.objects.create(
+        model=SYNCED_LABELS[sender], object_id=instance.pk)
@@ -0,0 +1,170 @@
+import base64
+import heapq
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import exceptions, status
+
+from mill.managers import EPOCH
+from mill.models import (Customer, Item, Order, Payment, Product, Return,
+                         Stock, Tombstone)
+
+PAGE_SIZE = 500
+MAX_PAGE_SIZE = 2000
+# Rows written in the last seconds are held back until the transactions
+# that stamped them have surely committed, so a slow commit dated before a
+# served token is never skipped.
+SETTLE_DELAY = timedelta(seconds=2)
+# Tombstones older than this are pruned; a client that has not caught up
+# for longer must sync again from scratch.
+RETENTION = timedelta(days=90)
+DELETED = 'deleted'
+
+# The synced models by label, in the order their rows are sent when
+# several share a timestamp. A stock row, keyed by its product, is sent
+# whenever the quantity in stock moves and goes with its product.
+MODELS = {
+    'product': (Product, [
+        'id', 'name', 'purchase_price', 'customer_price', 'created_at',
+        'updated_at',
+    ]),
+    'stock': (Stock, ['product_id', 'quantity', 'updated_at']),
+    'customer': (Customer, [
+        'id', 'given_name', 'surname', 'phone_number', 'is_supplier',
+        'created_at', 'updated_at',
+    ]),
+    'order': (Order, [
+        'id', 'customer_id', 'status', 'total_amount', 'paid_amount',
+        'returned_amount', 'created_at', 'updated_at',
+    ]),
+    'item': (Item, [
+        'id', 'order_id', 'product_id', 'price', 'quantity', 'created_at',
+        'updated_at',
+    ]),
+    'payment': (Payment, [
+        'id', 'order_id', 'amount', 'status', 'method', 'created_at',
+        'updated_at',
+    ]),
+    'return': (Return, [
+        'id', 'item_id', 'quantity', 'return_date', 'reason', 'created_at',
+        'updated_at',
+    ]),
+}
+LABELS = [*MODELS, DELETED]
+RANKS = {label: rank for rank, label in enumerate(LABELS)}
+
+
+class SyncTokenExpired(exceptions.APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = 'The sync token is too old; sync again from scratch.'
+    default_code = 'sync_token_expired'
+
+
+def encode_token(position, synced_at):
+    """Encode the ``(updated_at, label, pk)`` feed position to resume from
+    and the moment the client's copy was last complete."""
+    updated_at, label, pk = position
+    value = f'{updated_at.isoformat()}|{label}|{pk}|{synced_at.isoformat()}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_token(token):
+    """Return the position and ``synced_at`` of a sync token."""
+    try:
+        updated_at, label, pk, synced_at = base64.urlsafe_b64decode(
+            token.encode()).decode().split('|')
+        updated_at, pk = parse_datetime(updated_at), int(pk)
+        synced_at = parse_datetime(synced_at)
+    except (ValueError, UnicodeError):
+        raise exceptions.ValidationError({'token': 'Invalid sync token.'})
+    if updated_at is None or synced_at is None or label not in RANKS:
+        raise exceptions.ValidationError({'token': 'Invalid sync token.'})
+    return (updated_at, label, pk), synced_at
+
+
+def _after(queryset, date_field, label, position):
+    """Filter ``queryset`` to the rows sorting after ``position`` in the
+    feed's ``(date, rank, id)`` order."""
+    updated_at, position_label, pk = position
+    rank, position_rank = RANKS[label], RANKS[position_label]
+    if rank < position_rank:
+        return queryset.filter(**{f'{date_field}__gt': updated_at})
+    if rank > position_rank:
+        return queryset.filter(**{f'{date_field}__gte': updated_at})
+    # The redundant lower bound lets the database seek the ``(date, id)``
+    # index instead of scanning it for the OR.
+    return queryset.filter(**{f'{date_field}__gte': updated_at}).filter(
+        Q(**{f'{date_field}__gt': updated_at})
+        | Q(**{date_field: updated_at, 'pk__gt': pk}))
+
+
+def _iter_changes(queryset, date_field, label, fields, position, until,
+                  limit):
+    """Yield ``(date, rank, pk, label, id, data)`` for the next ``limit``
+    rows of one source, ``data`` being None for a deletion."""
+    rows = _after(queryset, date_field, label, position)\
+        .filter(**{f'{date_field}__lt': until})\
+        .order_by(date_field, 'pk')\
+        .values('pk', *fields)[:limit]
+    for row in rows:
+        pk = row.pop('pk')
+        if label == DELETED:
+            yield (row['deleted_at'], RANKS[label], pk, row['model'],
+                   row['object_id'], None)
+        else:
+            yield (row['updated_at'], RANKS[label], pk, label, pk, row)
+
+
+def get_changes(token=None, updated_since=None, page_size=PAGE_SIZE):
+    """Return one page of the rows created, changed or deleted after the
+    ``token`` of the previous page, or since ``updated_since``, or all of
+    them on a first sync.
+
+    Each synced table and the tombstones are read with one keyset query
+    on their ``(updated_at, id)`` index and merged in ``(date, model,
+    id)`` order. The page carries the token to resume from, so a
+    reconnecting client only reads what changed.
+    """
+    now = timezone.now()
+    if token is not None:
+        position, synced_at = decode_token(token)
+    else:
+        position = (updated_since or EPOCH, LABELS[0], 0)
+        # A first sync starts from an empty copy, which nothing can delete.
+        synced_at = updated_since or now
+    # Deletions since ``synced_at`` must still have their tombstones.
+    if synced_at < now - RETENTION:
+        raise SyncTokenExpired()
+
+    sources = [
+        (model.objects.all(), 'updated_at', label, fields)
+        for label, (model, fields) in MODELS.items()
+    ]
+    sources.append((Tombstone.objects.all(), 'deleted_at', DELETED,
+                    ['id', 'model', 'object_id', 'deleted_at']))
+    until = now - SETTLE_DELAY
+    changes = list(heapq.merge(*(
+        _iter_changes(queryset, date_field, label, fields, position, until,
+                      page_size + 1)
+        for queryset, date_field, label, fields in sources
+    ), key=lambda change: change[:3]))
+
+    has_more = len(changes) > page_size
+    changes = changes[:page_size]
+    if has_more:
+        updated_at, rank, pk = changes[-1][:3]
+        next_token = encode_token((updated_at, LABELS[rank], pk), synced_at)
+    else:
+        # The copy is complete up to ``until``: resume from there.
+        next_token = encode_token((until, LABELS[0], 0), until)
+    return {
+        'changes': [
+            {'model': label, 'id': object_id, 'updated_at': updated_at,
+             'deleted': data is None, 'data': data}
+            for updated_at, _, _, label, object_id, data in changes
+        ],
+        'next_token': next_token,
+        'has_more': has_more,
+    }
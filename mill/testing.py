@@ -0,0 +1,75 @@
+import re
+
+from django.db import connections, transaction
+
+from mill import events, managers
+
+
+class QueryBudgetMixin:
+    """Fail a test when an endpoint runs more SQL queries than its budget.
+
+    Budgets are declared per endpoint tag, as reported by
+    ``QueryInstrumentationMiddleware`` in the ``X-Endpoint`` header::
+
+        query_budgets = {'ProductViewSet.list': 2}
+
+    The count defaults to the ``X-Query-Count`` header; pass ``count`` to
+    include work done outside the request, such as on-commit callbacks.
+    """
+    query_budgets = {}
+
+    def setUp(self):
+        super().setUp()
+        # Drop the work queued by earlier tests, whose transactions rolled
+        # back: it would be flushed, and counted, with the first commit.
+        managers._pending_rollups.__dict__.clear()
+        events._pending_events.__dict__.clear()
+
+    def assertWithinQueryBudget(self, response, count=None):
+        endpoint = response['X-Endpoint']
+        if count is None:
+            count = int(response['X-Query-Count'])
+        self.assertIn(endpoint, self.query_budgets,
+                      f'No query budget declared for {endpoint}.')
+        budget = self.query_budgets[endpoint]
+        self.assertLessEqual(
+            count, budget,
+            f'{endpoint} ran {count} queries, over its budget of {budget}.'
+        )
+
+
+class QueryPlanMixin:
+    """Fail a test when a query reads a whole table instead of seeking an
+    index, from the plan the database reports with ``EXPLAIN``::
+
+        self.assertNoFullScan(Item.objects.filter(order=order))
+
+    Test tables are small enough for PostgreSQL to prefer sequential scans
+    anyway, so they are disabled while the plan is taken: one still showing
+    means no index fits the query.
+    """
+    # Table (or alias) read in full, by database vendor.
+    full_scan_patterns = {
+        'sqlite': re.compile(r'\bSCAN (?!CONSTANT ROW)(\w+)'),
+        'postgresql': re.compile(r'\bSeq Scan on (\w+)'),
+    }
+
+    def get_query_plan(self, queryset):
+        """Return the plan of ``queryset`` and the tables it reads in
+        full."""
+        connection = connections[queryset.db]
+        pattern = self.full_scan_patterns.get(connection.vendor)
+        if pattern is None:
+            self.skipTest(f'Query plans are not checked on {connection.vendor}.')
+        with transaction.atomic(using=queryset.db):
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+        return plan, pattern.findall(plan)
+
+    def assertNoFullScan(self, queryset, allowed=()):
+        plan, scans = self.get_query_plan(queryset)
+        scans = [table for table in scans if table not in allowed]
+        self.assertFalse(
+            scans, f'Full scan of {", ".join(scans)}:\n{plan}')
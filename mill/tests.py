@@ -1,3 +1,1504 @@
-from django.test import TestCase
+import asyncio
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+import json
+import threading
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APITestCase, APITransactionTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.models import User
+from mill.constants import SNAPSHOT_PERIOD_DAY
+from mill.export import DATASETS
+from mill.forecasting import refresh_suggestions
+from mill.managers import ProductManager
+from mill import database, events, forecasting, routers, sync
+from mill.management.commands.stress_stock import run_stress
+from mill.models import (Customer, CustomerBalance, CustomerRollup, Event,
+                         Item, Order, Payment, Product, ProductCost,
+                         ProductRollup, Production, Purchase, Return, Stock,
+                         StockSnapshot)
+from mill.sync import _after
+from mill.testing import QueryBudgetMixin, QueryPlanMixin
+
+
+class StockReservationStressTest(TransactionTestCase):
+    """Run against the database of the settings in use.
+
+    SQLite locks the whole database for each writer, so there the threads
+    only queue up: it checks the ledger stays consistent but does not
+    exercise the row locks of Stock.reserve(). Run it with
+    ``DJANGO_SETTINGS_MODULE=bleman.settings.prod DATABASE_PROFILE=postgresql``
+    for those.
+    """
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('Threads cannot share an in-memory database.')
+
+    def test_concurrent_sales_never_oversell(self):
+        result = run_stress(
+            threads=6, products=3, stock=20, orders_per_thread=15)
+
+        self.assertEqual(result['oversold'], {})
+        self.assertEqual(result['negative_stock'], {})
+        self.assertEqual(result['drifted'], {})
+        # 90 orders compete for 60 units: all the stock sells, no more.
+        self.assertEqual(result['sold'], 60)
+        self.assertEqual(result['out_of_stock'], 30)
+        self.assertGreater(result['orders_per_second'], 0)
+
+
+# The replica mirror in tests is another connection, which cannot see the
+# rows of the test's transaction.
+@override_settings(DATABASE_ROUTERS=[])
+class EndpointQueryBudgetTest(QueryBudgetMixin, APITestCase):
+    query_budgets = {
+        'ProductViewSet.list': 2,
+        'ProductViewSet.retrieve': 1,
+        'CustomerViewSet.list': 2,
+        'OrderViewSet.list': 3,
+        'OrderViewSet.retrieve': 2,
+        'OrderViewSet.margin': 2,
+        'ItemViewSet.list': 2,
+        'ItemViewSet.create': 27,
+        'PaymentViewSet.list': 2,
+        'PaymentViewSet.create': 9,
+        'ReturnViewSet.list': 2,
+        'ProductRollupViewSet.list': 2,
+        'CustomerRollupViewSet.list': 2,
+        'ReceivableViewSet.list': 2,
+        'ReceivableViewSet.retrieve': 1,
+        'ReorderSuggestionViewSet.list': 2,
+        'SyncViewSet.list': 8,
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(
+            User.objects.create_superuser('admin', 'admin@bleman.sn', 'x'))
+        self.customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+
+    def seed(self, rows):
+        """Grow every table to ``rows`` rows."""
+        now = timezone.now()
+        count = rows - Product.objects.count()
+        products = Product.objects.bulk_create([
+            Product(name=f'product {index}', purchase_price=10,
+                    customer_price=15)
+            for index in range(count)
+        ])
+        Purchase.objects.bulk_create([
+            Purchase(product=product, purchase_unit_price=10,
+                     quantity=1000, purchase_date=now)
+            for product in products
+        ])
+        ProductCost.objects.bulk_create([
+            ProductCost(product=product, quantity=1000, average_cost=10)
+            for product in products
+        ])
+        orders = Order.objects.bulk_create([
+            Order(customer=self.customer) for _ in range(count)
+        ])
+        items = Item.objects.bulk_create([
+            Item(order=order, product=product, price=15, quantity=3)
+            for order, product in zip(orders, products)
+        ])
+        Return.objects.bulk_create([Return(item=item, quantity=1)
+                                    for item in items])
+        Payment.objects.bulk_create([Payment(order=order, amount=10)
+                                     for order in orders])
+        Stock.objects.rebuild()
+        Order.objects.refresh_amounts()
+        CustomerBalance.objects.rebuild()
+        ProductRollup.objects.rebuild()
+        CustomerRollup.objects.rebuild()
+        refresh_suggestions()
+
+    def get_requests(self):
+        product = Product.objects.first()
+        order = Order.objects.first()
+        item = order.items.first()
+        return [
+            ('get', '/products/', None),
+            ('get', f'/products/{product.id}/', None),
+            ('get', '/customers/', None),
+            ('get', '/orders/', None),
+            ('get', f'/orders/{order.id}/', None),
+            ('get', f'/orders/{order.id}/margin/', None),
+            ('get', f'/orders/{order.id}/items/', None),
+            ('post', f'/orders/{order.id}/items/',
+             {'product': product.id, 'quantity': 1}),
+            ('get', f'/orders/{order.id}/payments/', None),
+            ('post', f'/orders/{order.id}/payments/', {'amount': 10}),
+            ('get', f'/orders/{order.id}/items/{item.id}/returns/', None),
+            ('get', '/analytics/products/?period=MONTH', None),
+            ('get', '/analytics/customers/?period=WEEK', None),
+            ('get', '/receivables/', None),
+            ('get', f'/receivables/{self.customer.id}/', None),
+            ('get', '/reorder-suggestions/', None),
+            ('get', '/sync/', None),
+        ]
+
+    def test_endpoints_stay_within_query_budget(self):
+        for rows in (10, 100, 1000):
+            # Publish the seeded rows now, not with the first write.
+            with self.captureOnCommitCallbacks(execute=True):
+                self.seed(rows)
+            for method, url, data in self.get_requests():
+                with self.subTest(rows=rows, method=method, url=url):
+                    cache.clear()
+                    # The test transaction never commits: run the on-commit
+                    # callbacks (rollups, events, cache versions) every real
+                    # write triggers, and count their queries too.
+                    with CaptureQueriesContext(connection) as queries, \
+                            self.captureOnCommitCallbacks(execute=True):
+                        response = getattr(self.client, method)(url, data)
+                    self.assertLess(response.status_code, 300)
+                    self.assertWithinQueryBudget(response, len(queries))
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class QueryLogTest(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(
+            User.objects.create_superuser('admin', 'admin@bleman.sn', 'x'))
+
+    def test_only_slow_requests_are_logged_above_debug(self):
+        with self.assertNoLogs('mill.middleware', 'INFO'):
+            self.client.get('/products/')
+        with override_settings(SLOW_REQUEST_MS=0), \
+                self.assertLogs('mill.middleware', 'WARNING') as logs:
+            self.client.get('/products/')
+        self.assertIn('ProductViewSet.list GET /products/', logs.output[0])
+
+
+class SqlitePragmaTest(TestCase):
+    @override_settings(SQLITE_PRAGMAS={'cache_size': -1234})
+    def test_pragmas_are_applied_to_new_connections(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only.')
+        database.configure_sqlite(sender=None, connection=connection)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -1234)
+
+
+class ReplicaRoutingTest(APITransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('The replica cannot share an in-memory database.')
+        cache.clear()
+        self.client.force_authenticate(
+            User.objects.create_superuser('admin', 'admin@bleman.sn', 'x'))
+        self.order = Order.objects.create(customer=Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000'))
+
+    def get_query_counts(self, method, url, data=None):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = getattr(self.client, method)(url, data)
+        self.assertLess(response.status_code, 300)
+        return len(primary), len(replica)
+
+    def test_opted_in_reads_go_to_the_replica(self):
+        self.assertEqual(self.get_query_counts('get', '/orders/'), (0, 3))
+        self.assertEqual(
+            self.get_query_counts('get', f'/orders/{self.order.id}/'), (0, 2))
+
+    def test_writes_and_other_reads_stay_on_the_primary(self):
+        url = f'/orders/{self.order.id}/payments/'
+        self.assertEqual(self.get_query_counts('get', url)[1], 0)
+        self.assertEqual(
+            self.get_query_counts('post', url, {'amount': 10})[1], 0)
+
+    def test_reads_after_a_write_stay_on_the_primary(self):
+        self.client.post(f'/orders/{self.order.id}/payments/', {'amount': 10})
+        self.assertEqual(self.get_query_counts('get', '/orders/')[1], 0)
+
+        cache.delete(routers.PIN_KEY.format(User.objects.get().pk))
+        self.assertEqual(self.get_query_counts('get', '/orders/')[0], 0)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class CursorPaginationTest(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(
+            User.objects.create_superuser('admin', 'admin@bleman.sn', 'x'))
+        customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        # Every order totals 0 and every product has the same name.
+        self.orders = [Order.objects.create(customer=customer).id
+                       for _ in range(7)]
+        self.products = [Product.objects.create(
+            name='product', purchase_price=10, customer_price=15).id
+            for _ in range(7)]
+
+    def get_all_pages(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_pages_over_tied_values_cover_every_row_once(self):
+        for url, expected in [
+            ('/orders/?pagination=cursor&page_size=2&ordering=total_amount',
+             self.orders),
+            ('/orders/?pagination=cursor&page_size=2', self.orders),
+            ('/products/?pagination=cursor&page_size=2', self.products),
+        ]:
+            with self.subTest(url):
+                self.assertEqual(self.get_all_pages(url),
+                                 sorted(expected, reverse=True))
+
+    def test_rows_added_between_pages_are_not_repeated(self):
+        response = self.client.get(
+            '/products/?pagination=cursor&page_size=3')
+        first_page = [row['id'] for row in response.data['results']]
+        Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        rest = self.get_all_pages(response.data['next'])
+        self.assertEqual(first_page + rest,
+                         sorted(self.products, reverse=True))
+
+
+class EventStreamTest(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create_superuser('admin', 'admin@bleman.sn', 'x')
+        self.token = str(AccessToken.for_user(user))
+        self.order = Order.objects.create(customer=Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000'))
+
+    def test_a_write_is_logged_for_every_server_process(self):
+        Payment.objects.create(order=self.order, amount=10)
+        event = Event.objects.filter(event='order').last()
+        self.assertEqual(
+            (event.data['id'], event.data['paid_amount'],
+             event.data['status']), (self.order.id, 10, 'PAID'))
+
+    def test_events_written_by_another_process_are_published(self):
+        broker = events.Broker()
+        last = broker._load_history()
+        # Inserted as the API workers do, outside this process's broker.
+        event = Event.objects.create(event='order', data={'id': 1})
+        self.assertEqual(broker._publish_new(last), event.id)
+        self.assertEqual(broker.history[-1], (event.id, 'order', {'id': 1}))
+        self.assertEqual(broker._get_replay(str(last)),
+                         [(event.id, 'order', {'id': 1})])
+
+    def test_a_gap_in_the_ids_is_waited_for(self):
+        broker = events.Broker()
+        last = broker._load_history()
+        skipped, event = [Event.objects.create(event='order', data={})
+                          for _ in range(2)]
+        # As if the first were not committed yet.
+        skipped.delete()
+        self.assertEqual(broker._publish_new(last), last)
+        Event.objects.filter(id=event.id).update(
+            created_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(broker._publish_new(last), event.id)
+
+    async def test_subscriber_receives_an_order_write(self):
+        response = await self.async_client.get(
+            '/events/', {'events': 'order'},
+            headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(response.status_code, 200)
+        stream = aiter(response.streaming_content)
+        try:
+            # The subscription is made once the stream is read.
+            self.assertTrue((await anext(stream)).startswith(b'retry:'))
+            await sync_to_async(Payment.objects.create)(
+                order=self.order, amount=10)
+            message = await asyncio.wait_for(anext(stream), 5)
+        finally:
+            await stream.aclose()
+
+        event_id, event, data = message.decode().strip().split('\n')
+        event_id = int(event_id.removeprefix('id: '))
+        self.assertEqual(event, 'event: order')
+        data = json.loads(data.removeprefix('data: '))
+        self.assertEqual((data['id'], data['paid_amount'], data['status']),
+                         (self.order.id, 10, 'PAID'))
+        self.assertTrue(await Event.objects.filter(
+            id=event_id, event='order').aexists())
+
+
+class ItemAdminStockTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        cls.product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        Purchase.objects.create(product=cls.product, purchase_unit_price=10,
+                                quantity=5, purchase_date=timezone.now())
+        cls.order = Order.objects.create(customer=Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000'))
+        cls.item = Item.objects.add_item(cls.order, cls.product, 2, 15)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def change_item(self, quantity):
+        return self.client.post(f'/admin/mill/item/{self.item.id}/change/', {
+            'product': self.product.id, 'order': self.order.id,
+            'price': 15, 'quantity': quantity,
+        })
+
+    def get_stock(self):
+        return Stock.objects.get(product=self.product).quantity
+
+    def test_change_reserves_the_extra_quantity(self):
+        self.assertEqual(self.change_item(5).status_code, 302)
+        self.assertEqual(self.get_stock(), 0)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.quantity, 5)
+
+    def test_shortfall_is_a_form_error(self):
+        response = self.change_item(6)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('quantity', response.context['adminform'].form.errors)
+        self.assertEqual(self.get_stock(), 3)
+
+    def test_reservation_failing_on_save_is_a_form_error(self):
+        validate = ProductManager.validate_stock_availability
+        calls = []
+
+        def stock_taken_after_the_check(manager, requested):
+            calls.append(requested)
+            if len(calls) == 1:
+                return {}
+            return validate(manager, requested)
+
+        with mock.patch.object(ProductManager, 'validate_stock_availability',
+                               stock_taken_after_the_check):
+            response = self.change_item(6)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('3 product left in stock',
+                      response.context['adminform'].form.errors['quantity'])
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.quantity, self.get_stock()), (2, 3))
+
+    def test_order_inline_adds_to_the_line(self):
+        url = f'/admin/mill/order/{self.order.id}/change/'
+        data = {
+            'customer': self.order.customer_id,
+            'items-TOTAL_FORMS': 1, 'items-INITIAL_FORMS': 0,
+            'items-MIN_NUM_FORMS': 0, 'items-MAX_NUM_FORMS': 1000,
+            'items-0-order': self.order.id, 'items-0-product': self.product.id,
+            'items-0-price': 15, 'items-0-quantity': 4,
+        }
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['inline_admin_formsets'][0]
+                        .formset.errors[0]['quantity'])
+
+        data['items-0-quantity'] = 3
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(self.get_stock(), 0)
+
+
+class ProductCacheTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        cls.product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        cls.purchase = Purchase.objects.create(
+            product=cls.product, purchase_unit_price=10, quantity=5,
+            purchase_date=timezone.now() - timedelta(days=2))
+        cls.url = f'/products/{cls.product.id}/'
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(self.user)
+
+    def write(self, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            for field, value in fields.items():
+                setattr(self.purchase, field, value)
+            self.purchase.save()
+
+    def test_unchanged_response_is_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_read_is_served_from_the_cache(self):
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'MISS')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.data['quantity_in_stock'], 5)
+        self.assertEqual(len(queries), 0)
+
+    def test_write_expires_the_cached_responses(self):
+        for url in [self.url, '/products/']:
+            self.client.get(url)
+        etag = self.client.get(self.url)['ETag']
+
+        self.write(quantity=7)
+        for url in [self.url, '/products/']:
+            with self.subTest(url):
+                self.assertEqual(self.client.get(url)['X-Cache'], 'MISS')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['quantity_in_stock'], 7)
+
+    def test_redated_movement_expires_the_as_of_responses(self):
+        yesterday = (timezone.now() - timedelta(days=1)).isoformat()
+        response = self.client.get(self.url, {'as_of': yesterday})
+        self.assertEqual(response.data['quantity_in_stock'], 5)
+
+        self.write(purchase_date=timezone.now())
+        response = self.client.get(self.url, {'as_of': yesterday})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['quantity_in_stock'], 0)
+
+
+class IdempotencyTest(APITransactionTestCase):
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('Threads cannot share an in-memory database.')
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        self.client.force_authenticate(self.user)
+        self.order = Order.objects.create(customer=Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000'))
+
+    def get_requests(self, amount=10):
+        return [
+            (f'/orders/{self.order.id}/payments/', {'amount': amount}),
+            ('/orders/payments/',
+             [{'order': self.order.id, 'amount': amount}]),
+        ]
+
+    def post(self, url, data, key, client=None):
+        return (client or self.client).post(
+            url, data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_the_first_response(self):
+        for url, data in self.get_requests():
+            with self.subTest(url):
+                Payment.objects.all().delete()
+                first = self.post(url, data, url)
+                retry = self.post(url, data, url)
+                self.assertEqual(first.status_code, 201)
+                self.assertEqual((retry.status_code, retry.data),
+                                 (first.status_code, first.data))
+                self.assertEqual(retry['Idempotent-Replayed'], 'true')
+                self.assertEqual(Payment.objects.count(), 1)
+
+    def test_key_sent_with_another_body_is_refused(self):
+        for (url, data), (_, other) in zip(self.get_requests(),
+                                           self.get_requests(amount=20)):
+            with self.subTest(url):
+                Payment.objects.all().delete()
+                self.assertEqual(self.post(url, data, url).status_code, 201)
+                response = self.post(url, other, url)
+                self.assertEqual(response.status_code, 422)
+                self.assertEqual(
+                    list(Payment.objects.values_list('amount', flat=True)),
+                    [10])
+
+    def test_concurrent_requests_with_one_key_post_once(self):
+        url, data = self.get_requests()[0]
+        responses = []
+        ready = threading.Barrier(2, timeout=5)
+
+        def post():
+            client = type(self.client)()
+            client.force_authenticate(self.user)
+            try:
+                ready.wait()
+                responses.append(self.post(url, data, 'key', client))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=post) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([response.status_code for response in responses],
+                         [201, 201])
+        self.assertEqual(responses[0].data, responses[1].data)
+        self.assertEqual(
+            sorted(response.has_header('Idempotent-Replayed')
+                   for response in responses), [False, True])
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_batch_with_a_missing_order_posts_nothing(self):
+        data = [{'order': self.order.id, 'amount': 10},
+                {'order': self.order.id + 1, 'amount': 10}]
+        response = self.post('/orders/payments/', data, 'key')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Payment.objects.count(), 0)
+
+        # The failure is not stored: the key can post the fixed batch.
+        response = self.post('/orders/payments/', data[:1], 'key')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Payment.objects.count(), 1)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class OrderStatusTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        cls.customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        Purchase.objects.create(product=product, purchase_unit_price=10,
+                                quantity=5, purchase_date=timezone.now())
+        cls.order = Order.objects.create(customer=cls.customer)
+        Item.objects.add_item(cls.order, product, 2, 15)
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def get_status(self):
+        self.order.refresh_from_db()
+        return self.order.status
+
+    def test_status_follows_the_payments(self):
+        self.assertEqual(self.get_status(), 'UNPAID')
+        url = f'/orders/{self.order.id}/payments/'
+        first = self.client.post(url, {'amount': 10}).data['id']
+        self.assertEqual(self.get_status(), 'REMAIN')
+        self.client.post(url, {'amount': 20})
+        self.assertEqual(self.get_status(), 'PAID')
+
+        self.client.delete(f'{url}{first}/')
+        self.assertEqual(self.get_status(), 'REMAIN')
+        Payment.objects.get().delete()
+        self.assertEqual(self.get_status(), 'UNPAID')
+
+    def test_status_cannot_be_written(self):
+        response = self.client.post(
+            '/orders/', {'customer': self.customer.id, 'status': 'PAID'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['status'], 'UNPAID')
+
+        url = f'/orders/{self.order.id}/'
+        for method in ['put', 'patch']:
+            with self.subTest(method):
+                response = getattr(self.client, method)(
+                    url, {'status': 'PAID'})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(self.get_status(), 'UNPAID')
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class CreateOrderTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        cls.customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        cls.flour, cls.bran = [
+            Product.objects.create(name=name, purchase_price=10,
+                                   customer_price=15)
+            for name in ['flour', 'bran']
+        ]
+        for product, quantity in [(cls.flour, 5), (cls.bran, 2)]:
+            Purchase.objects.create(
+                product=product, purchase_unit_price=10, quantity=quantity,
+                purchase_date=timezone.now())
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def create_order(self, lines, payment=None):
+        data = {'customer': self.customer.id, 'items': [
+            {'product': product.id, 'quantity': quantity}
+            for product, quantity in lines
+        ]}
+        if payment is not None:
+            data['payment'] = {'amount': payment}
+        return self.client.post('/orders/', data, format='json')
+
+    def get_stock(self):
+        return dict(Stock.objects.values_list('product__name', 'quantity'))
+
+    def test_lines_of_the_same_product_are_merged(self):
+        response = self.create_order(
+            [(self.flour, 2), (self.bran, 1), (self.flour, 1)], payment=20)
+
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get()
+        self.assertEqual(
+            sorted(order.items.values_list('product__name', 'quantity')),
+            [('bran', 1), ('flour', 3)])
+        self.assertEqual(
+            (order.total_amount, order.paid_amount, order.status),
+            (60, 20, 'REMAIN'))
+        self.assertEqual(self.get_stock(), {'flour': 2, 'bran': 1})
+
+    def test_every_line_short_of_stock_gets_its_error(self):
+        response = self.create_order(
+            [(self.flour, 5), (self.bran, 1), (self.bran, 2)])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['items'], [
+            {}, {'quantity': ['2 bran left in stock']},
+            {'quantity': ['2 bran left in stock']},
+        ])
+        self.assertFalse(Order.objects.exists())
+
+    def test_the_order_is_rolled_back_when_a_line_fails(self):
+        get_stock_report = Product.objects.get_stock_report
+
+        def sell_out(quantities):
+            report = get_stock_report(quantities)
+            # Another order takes the last bran after the check.
+            Stock.objects.filter(product=self.bran).update(quantity=0)
+            return report
+
+        with mock.patch.object(Product.objects, 'get_stock_report',
+                               sell_out):
+            response = self.create_order(
+                [(self.flour, 1), (self.bran, 1)], payment=30)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('items', response.data)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Payment.objects.exists())
+        self.assertEqual(self.get_stock(), {'flour': 5, 'bran': 0})
+
+    def test_the_payment_cannot_exceed_the_total(self):
+        response = self.create_order([(self.flour, 2)], payment=31)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('amount', response.data['payment'])
+        self.assertFalse(Order.objects.exists())
+
+        response = self.create_order([(self.flour, 2)], payment=30)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Order.objects.get().status, 'PAID')
+
+
+class QueryPlanTest(QueryPlanMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        cls.product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        cls.order = Order.objects.create(customer=cls.customer)
+        cls.item, = Item.objects.bulk_create([Item(
+            order=cls.order, product=cls.product, price=15, quantity=1)])
+
+    def get_querysets(self):
+        now = timezone.now()
+        return {
+            'add_item': Item.objects.filter(
+                order=self.order, product=self.product),
+            'order_items': Item.objects.filter(order=self.order)
+            .annotate_line_amount(),
+            'item_returns': Return.objects.filter(item=self.item),
+            'order_payments': Payment.objects.filter(order=self.order),
+            'customer_orders': Order.objects.filter(
+                customer=self.customer, status='UNPAID').order_by('-id'),
+            'order_amounts': Order.objects.filter(pk=self.order.pk)
+            .annotate_computed_amounts(),
+            'stock_as_of': Product.objects.filter(pk=self.product.pk)
+            .annotate_quantity_in_stock(as_of=now),
+            'purchases_since': Purchase.objects.filter(
+                product=self.product, purchase_date__gte=now),
+            'productions_since': Production.objects.filter(
+                product=self.product, production_date__gte=now),
+            'items_since': Item.objects.filter(
+                product=self.product, created_at__gte=now),
+            'returns_since': Return.objects.filter(return_date__gte=now)
+            .order_by(),
+            'sync_orders': _after(Order.objects.all(), 'updated_at', 'order',
+                                  (now, 'order', 0)).order_by('updated_at', 'pk'),
+        }
+
+    def test_hot_lookups_seek_an_index(self):
+        for name, queryset in self.get_querysets().items():
+            with self.subTest(name):
+                self.assertNoFullScan(queryset)
+
+
+class StockAnnotationTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        cls.product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        cls.yesterday = timezone.now() - timedelta(days=1)
+        for days, quantity in [(2, 5), (0, 3)]:
+            Purchase.objects.create(
+                product=cls.product, purchase_unit_price=10,
+                quantity=quantity,
+                purchase_date=timezone.now() - timedelta(days=days))
+        for _ in range(2):
+            Production.objects.create(product=cls.product, quantity=2,
+                                      production_date=timezone.now())
+        customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        for quantity in [3, 2]:
+            item = Item.objects.add_item(
+                Order.objects.create(customer=customer), cls.product,
+                quantity, 15)
+        for _ in range(2):
+            Return.objects.create(item=item, quantity=1)
+
+    def test_every_movement_counts_once(self):
+        # 8 purchased + 4 produced - 5 sold + 2 returned, however many rows
+        # of each relation there are.
+        with self.assertNumQueries(1):
+            product = Product.objects\
+                .annotate_quantity_in_stock()\
+                .annotate(purchase_count=Count('purchases'))\
+                .get()
+        self.assertEqual((product.quantity_in_stock, product.purchase_count),
+                         (9, 2))
+
+    def test_as_of_counts_the_movements_before(self):
+        self.client.force_authenticate(self.user)
+        url = f'/products/{self.product.id}/'
+        for as_of, expected in [(self.yesterday, 5),
+                                (timezone.now() + timedelta(minutes=1), 9)]:
+            with self.subTest(as_of=as_of):
+                response = self.client.get(url, {'as_of': as_of.isoformat()})
+                self.assertEqual(response.data['quantity_in_stock'], expected)
+
+
+class StockReportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.flour, cls.bran, cls.salt = [
+            Product.objects.create(name=name, purchase_price=10,
+                                   customer_price=15)
+            for name in ['flour', 'bran', 'salt']
+        ]
+        for product, quantity in [(cls.flour, 5), (cls.bran, 2)]:
+            Purchase.objects.create(
+                product=product, purchase_unit_price=10, quantity=quantity,
+                purchase_date=timezone.now())
+
+    def test_report_reads_every_product_in_one_query(self):
+        missing = self.salt.id + 1
+        with self.assertNumQueries(1):
+            report = Product.objects.get_stock_report({
+                self.flour.id: 3, self.bran.id: 3, self.salt.id: 1,
+                missing: 1})
+        self.assertEqual(
+            {product_id: (line['available'], line['shortfall'])
+             for product_id, line in report.items()},
+            {self.flour.id: (5, 0), self.bran.id: (2, 1),
+             self.salt.id: (0, 1)})
+
+    def test_every_short_product_gets_its_out_of_stock_error(self):
+        with self.assertNumQueries(1), \
+                self.assertRaises(ValidationError) as raised:
+            Product.objects.validate_stock_availability({
+                self.flour.id: 5, self.bran.id: 3, self.salt.id: 1})
+        errors = raised.exception.error_dict
+        self.assertEqual(set(errors), {self.bran.id, self.salt.id})
+        self.assertEqual(
+            [(error.code, error.message) for error in errors[self.bran.id]],
+            [('out_of_stock', '2 bran left in stock')])
+
+        # The single-product check keeps its own error.
+        with self.assertRaises(ValidationError) as raised:
+            self.bran.validate_stock_availability(3)
+        self.assertEqual(raised.exception.messages, ['2 bran left in stock'])
+        self.assertTrue(self.flour.validate_stock_availability(5))
+
+
+class StockLedgerTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.flour, cls.bran = [
+            Product.objects.create(name=name, purchase_price=10,
+                                   customer_price=15)
+            for name in ['flour', 'bran']
+        ]
+        Purchase.objects.create(product=cls.flour, purchase_unit_price=10,
+                                quantity=10, purchase_date=timezone.now())
+        Production.objects.create(product=cls.bran, quantity=4,
+                                  production_date=timezone.now())
+        order = Order.objects.create(customer=Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000'))
+        item = Item.objects.add_item(order, cls.flour, 3, 15)
+        Return.objects.create(item=item, quantity=1)
+
+    def get_ledger(self):
+        return dict(Stock.objects.values_list('product_id', 'quantity'))
+
+    def test_rebuild_matches_the_annotated_quantity(self):
+        annotated = dict(Product.objects.annotate_quantity_in_stock()
+                         .values_list('id', 'quantity_in_stock'))
+        self.assertEqual(annotated, {self.flour.id: 8, self.bran.id: 4})
+        Stock.objects.update(quantity=0)
+
+        Stock.objects.rebuild()
+        self.assertEqual(self.get_ledger(), annotated)
+
+    def test_verify_reports_the_drifted_rows(self):
+        self.assertEqual(Stock.objects.verify(), {})
+        Stock.objects.filter(product=self.flour).update(quantity=7)
+        Stock.objects.filter(product=self.bran).delete()
+
+        self.assertEqual(Stock.objects.verify(), {
+            self.flour.id: (7, 8), self.bran.id: (None, 4)})
+        Stock.objects.rebuild()
+        self.assertEqual(Stock.objects.verify(), {})
+
+
+class StockSnapshotTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        # Noon on 1 and 3 January.
+        cls.day = timezone.make_aware(datetime(2024, 1, 1, 12))
+        for days, quantity in [(0, 10), (2, 5)]:
+            Purchase.objects.create(
+                product=cls.product, purchase_unit_price=10,
+                quantity=quantity,
+                purchase_date=cls.day + timedelta(days=days))
+
+    def get_quantity(self, as_of):
+        return StockSnapshot.objects.quantity_as_of(
+            as_of, [self.product.id])[self.product.id]
+
+    def test_take_rolls_forward_the_days_with_movements(self):
+        created = StockSnapshot.objects.take(
+            SNAPSHOT_PERIOD_DAY, self.day + timedelta(days=4))
+
+        self.assertEqual(created, 2)
+        self.assertEqual(
+            list(StockSnapshot.objects.order_by('taken_at')
+                 .values_list('taken_at', 'quantity')),
+            [(self.day + timedelta(hours=12), 10),
+             (self.day + timedelta(days=2, hours=12), 15)])
+        # Nothing moved since: rolling on adds no row.
+        self.assertEqual(StockSnapshot.objects.take(
+            SNAPSHOT_PERIOD_DAY, self.day + timedelta(days=6)), 0)
+
+    def test_quantity_as_of_starts_from_the_snapshot_before(self):
+        StockSnapshot.objects.take(
+            SNAPSHOT_PERIOD_DAY, self.day + timedelta(days=4))
+        for hours, quantity in [(-12, 0), (0, 0), (1, 10), (36, 10),
+                                (60, 15)]:
+            with self.subTest(hours=hours):
+                self.assertEqual(
+                    self.get_quantity(self.day + timedelta(hours=hours)),
+                    quantity)
+
+    def test_back_dated_movement_shifts_the_later_snapshots(self):
+        StockSnapshot.objects.take(
+            SNAPSHOT_PERIOD_DAY, self.day + timedelta(days=4))
+        Production.objects.create(
+            product=self.product, quantity=3,
+            production_date=self.day + timedelta(days=1))
+
+        self.assertEqual(
+            list(StockSnapshot.objects.order_by('taken_at')
+                 .values_list('quantity', flat=True)), [10, 18])
+        self.assertEqual(self.get_quantity(self.day + timedelta(hours=18)),
+                         10)
+        self.assertEqual(self.get_quantity(self.day + timedelta(days=3)), 18)
+
+
+class OrderAmountsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        cls.product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        Purchase.objects.create(product=cls.product, purchase_unit_price=10,
+                                quantity=10, purchase_date=timezone.now())
+        cls.order = Order.objects.create(customer=cls.customer)
+
+    def assertAmounts(self, order, total, paid, returned):
+        """Check the stored totals, and that they match the history."""
+        stored = Order.objects.annotate_computed_amounts().get(pk=order.pk)
+        self.assertEqual(
+            (stored.total_amount, stored.paid_amount, stored.returned_amount),
+            (total, paid, returned))
+        self.assertEqual(
+            (stored.computed_total_amount, stored.computed_paid_amount,
+             stored.computed_returned_amount),
+            (total, paid, returned))
+
+    def test_item_writes_refresh_the_total(self):
+        item = Item.objects.add_item(self.order, self.product, 2, 15)
+        self.assertAmounts(self.order, 30, 0, 0)
+        item.update_quantity(3)
+        self.assertAmounts(self.order, 45, 0, 0)
+        item.delete()
+        self.assertAmounts(self.order, 0, 0, 0)
+
+    def test_return_writes_refresh_the_total(self):
+        item = Item.objects.add_item(self.order, self.product, 3, 15)
+        returned = Return.objects.create(item=item, quantity=1)
+        self.assertAmounts(self.order, 30, 0, 15)
+        returned.quantity = 2
+        returned.save()
+        self.assertAmounts(self.order, 15, 0, 30)
+        returned.delete()
+        self.assertAmounts(self.order, 45, 0, 0)
+
+    def test_payment_writes_refresh_the_paid_amount(self):
+        other = Order.objects.create(customer=self.customer)
+        payment = Payment.objects.create(order=self.order, amount=20)
+        self.assertAmounts(self.order, 0, 20, 0)
+        payment.amount = 30
+        payment.save()
+        self.assertAmounts(self.order, 0, 30, 0)
+
+        payment.order = other
+        payment.save()
+        self.assertAmounts(self.order, 0, 0, 0)
+        self.assertAmounts(other, 0, 30, 0)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+@override_settings(DATABASE_ROUTERS=[])
+class OrderSerializerAmountsTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        flour, bran = [
+            Product.objects.create(name=name, purchase_price=10,
+                                   customer_price=15)
+            for name in ['flour', 'bran']
+        ]
+        for product in [flour, bran]:
+            Purchase.objects.create(
+                product=product, purchase_unit_price=10, quantity=10,
+                purchase_date=timezone.now())
+        cls.orders = [Order.objects.create(customer=customer)
+                      for _ in range(2)]
+        # 3 flour and 2 bran, 1 flour returned: 60, of which 20 paid.
+        item = Item.objects.add_item(cls.orders[0], flour, 3, 15)
+        Item.objects.add_item(cls.orders[0], bran, 2, 15)
+        Return.objects.create(item=item, quantity=1)
+        for amount in [5, 15]:
+            Payment.objects.create(order=cls.orders[0], amount=amount)
+        # 15, all paid.
+        Item.objects.add_item(cls.orders[1], bran, 1, 15)
+        Payment.objects.create(order=cls.orders[1], amount=15)
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def get_amounts(self, data):
+        return (data['id'], data['total_amount'], data['remain_amount'])
+
+    def test_detail_reads_the_amounts_in_one_query(self):
+        order = self.orders[0]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/orders/{order.id}/')
+        # The order with its amounts, then its items.
+        self.assertEqual(
+            len([query for query in queries
+                 if 'FROM "mill_order"' in query['sql']]), 1)
+        self.assertEqual(self.get_amounts(response.data), (order.id, 60, 40))
+
+    def test_list_filters_and_orders_on_the_remaining_amount(self):
+        response = self.client.get('/orders/', {'ordering': '-remain_amount'})
+        self.assertEqual(
+            [self.get_amounts(order) for order in response.data['results']],
+            [(self.orders[0].id, 60, 40), (self.orders[1].id, 15, 0)])
+
+        response = self.client.get('/orders/', {'min_remain_amount': 1})
+        self.assertEqual([order['id'] for order in response.data['results']],
+                         [self.orders[0].id])
+
+
+class ExportTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        cls.customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        other = Customer.objects.create(
+            given_name='Modou', surname='Fall', phone_number='770000001')
+        cls.product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        Purchase.objects.create(product=cls.product, purchase_unit_price=10,
+                                quantity=10, purchase_date=timezone.now())
+        cls.order = Order.objects.create(customer=cls.customer)
+        cls.item = Item.objects.add_item(cls.order, cls.product, 3, 15)
+        Return.objects.create(item=cls.item, quantity=1)
+        cls.payment = Payment.objects.create(order=cls.order, amount=20)
+        Order.objects.create(customer=other)
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def get_export(self, url, params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def get_jsonl(self, url, params):
+        return [json.loads(line) for line in self.get_export(
+            url, {**params, 'output': 'jsonl'}).splitlines()]
+
+    def test_orders_csv(self):
+        lines = self.get_export(
+            '/orders/export/', {'customer': self.customer.id}).splitlines()
+        self.assertEqual(lines[0], ','.join(DATASETS['orders'][1]))
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith(f'{self.order.id},'))
+        self.assertTrue(lines[1].endswith(',Awa Diop,REMAIN,30,20,15,10'))
+
+    def test_items_and_payments_jsonl(self):
+        item, = self.get_jsonl('/orders/export/', {
+            'dataset': 'items', 'customer': self.customer.id})
+        self.assertEqual(
+            {key: item[key] for key in [
+                'id', 'order_id', 'product_name', 'quantity',
+                'returned_quantity', 'net_quantity', 'line_amount']},
+            {'id': self.item.id, 'order_id': self.order.id,
+             'product_name': 'product', 'quantity': 3,
+             'returned_quantity': 1, 'net_quantity': 2, 'line_amount': 30})
+
+        payment, = self.get_jsonl('/orders/export/', {'dataset': 'payments'})
+        self.assertEqual(
+            (payment['id'], payment['customer_name'], payment['amount']),
+            (self.payment.id, 'Awa Diop', 20))
+
+    def test_filters(self):
+        for params, count in [({'status': 'UNPAID'}, 1),
+                              ({'status': 'PAID'}, 0),
+                              ({'created_after': timezone.now()}, 0),
+                              ({}, 2)]:
+            with self.subTest(params):
+                self.assertEqual(
+                    len(self.get_jsonl('/orders/export/', params)), count)
+
+    def test_statement_running_balance(self):
+        rows = self.get_jsonl(
+            f'/receivables/{self.customer.id}/statement/', {})
+        self.assertEqual(
+            [(row['entry'], row['debit'], row['credit'], row['balance'])
+             for row in rows],
+            [('opening_balance', 0, 0, 0), ('order', 30, 0, 30),
+             ('payment', 0, 20, 10)])
+
+
+class ImportTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        cls.product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def upload(self, name, content, **data):
+        upload = SimpleUploadedFile(name, content.encode())
+        return self.client.post('/purchases/import/',
+                                {'file': upload, **data}, format='multipart')
+
+    def get_stock(self):
+        return Stock.objects.get(product=self.product).quantity
+
+    def test_request_without_a_valid_file_is_refused(self):
+        response = self.client.post('/purchases/import/', {},
+                                    format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('file', response.data)
+
+        response = self.upload('rows.csv', '', input='xml')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('input', response.data)
+
+    def test_bad_rows_are_reported_and_the_others_imported(self):
+        product = self.product.id
+        response = self.upload('rows.csv', '\n'.join([
+            'product,purchase_unit_price,quantity,purchase_date',
+            f'{product},10,5,2024-01-01T00:00:00Z',
+            f'{product},10,0,2024-01-01T00:00:00Z',
+            f'{product + 1},10,5,2024-01-01T00:00:00Z',
+            f'{product},12,2,2024-01-02T00:00:00Z',
+        ]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['imported'], response.data['failed']),
+                         (2, 2))
+        self.assertEqual(
+            [(error['line'], list(error['errors']))
+             for error in response.data['errors']],
+            [(3, ['quantity']), (4, ['product'])])
+        self.assertEqual(
+            sorted(Purchase.objects.values_list('quantity', flat=True)),
+            [2, 5])
+        self.assertEqual(self.get_stock(), 7)
+
+    def test_a_purchase_at_price_zero_is_refused(self):
+        response = self.upload('rows.csv', '\n'.join([
+            'product,purchase_unit_price,quantity,purchase_date',
+            f'{self.product.id},0,5,2024-01-01T00:00:00Z',
+        ]))
+
+        self.assertEqual((response.data['imported'], response.data['failed']),
+                         (0, 1))
+        self.assertEqual(list(response.data['errors'][0]['errors']),
+                         ['purchase_unit_price'])
+        self.assertFalse(Purchase.objects.exists())
+
+    def test_jsonl_lines_that_do_not_parse_are_reported(self):
+        response = self.upload('rows.jsonl', '\n'.join([
+            json.dumps({'product': self.product.id, 'quantity': 3,
+                        'purchase_unit_price': 10,
+                        'purchase_date': '2024-01-01T00:00:00Z'}),
+            '{"product": ',
+            '[1, 2]',
+        ]))
+
+        self.assertEqual((response.data['imported'], response.data['failed']),
+                         (1, 2))
+        self.assertEqual([error['line'] for error in response.data['errors']],
+                         [2, 3])
+        self.assertEqual(self.get_stock(), 3)
+
+
+class RollupOnCommitTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        cls.product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        Purchase.objects.create(product=cls.product, purchase_unit_price=10,
+                                quantity=10, purchase_date=timezone.now())
+        cls.order = Order.objects.create(customer=cls.customer)
+
+    def get_rows(self, model, *fields):
+        return list(model.objects.values_list(*fields))
+
+    def test_writes_are_rolled_up_once_committed(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            item = Item.objects.add_item(self.order, self.product, 2, 15)
+            item.update_quantity(3)
+            Payment.objects.create(order=self.order, amount=20)
+            self.assertEqual(self.get_rows(CustomerRollup, 'revenue'), [])
+
+        with CaptureQueriesContext(connection) as queries:
+            for callback in callbacks:
+                callback()
+        # One refresh per rollup and source model, however many writes.
+        self.assertEqual(
+            len([query for query in queries
+                 if 'INSERT INTO "mill_customerrollup"' in query['sql']]), 2)
+
+        today = timezone.localdate()
+        self.assertEqual(
+            self.get_rows(ProductRollup, 'day', 'units_sold', 'revenue',
+                          'units_purchased'),
+            [(today, 3, 45, 10)])
+        self.assertEqual(
+            self.get_rows(CustomerRollup, 'day', 'units_sold', 'revenue',
+                          'paid_amount'),
+            [(today, 3, 45, 20)])
+
+        # The same rows as rebuilt from the history.
+        rows = self.get_rows(CustomerRollup, 'revenue', 'paid_amount')
+        CustomerRollup.objects.rebuild()
+        self.assertEqual(
+            self.get_rows(CustomerRollup, 'revenue', 'paid_amount'), rows)
+
+    def test_rolled_back_writes_are_not_rolled_up(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    customer = Customer.objects.create(
+                        given_name='Modou', surname='Fall',
+                        phone_number='770000001')
+                    order = Order.objects.create(customer=customer)
+                    Payment.objects.create(order=order, amount=20)
+                    raise DatabaseError
+            except DatabaseError:
+                pass
+            Payment.objects.create(order=self.order, amount=5)
+
+        self.assertEqual(
+            self.get_rows(CustomerRollup, 'customer', 'paid_amount'),
+            [(self.customer.id, 5)])
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class ReceivableAgingTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        cls.customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        cls.as_of = timezone.make_aware(datetime(2024, 6, 1, 12))
+        # (age in days, total, paid); the paid-up order ages nowhere.
+        for days, total, paid in [(0, 100, 40), (30, 10, 0), (31, 20, 0),
+                                  (60, 30, 0), (61, 40, 0), (90, 50, 0),
+                                  (91, 60, 0), (400, 70, 0), (45, 80, 80)]:
+            order = Order.objects.create(customer=cls.customer)
+            Order.objects.filter(pk=order.pk).update(
+                created_at=cls.as_of - timedelta(days=days),
+                total_amount=total, paid_amount=paid)
+        CustomerBalance.objects.refresh()
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def test_outstanding_amounts_are_aged_by_order(self):
+        response = self.client.get('/receivables/',
+                                   {'as_of': self.as_of.isoformat()})
+        row, = response.data['results']
+        self.assertEqual(
+            {key: row[key] for key in [
+                'balance', 'aging_0_30', 'aging_31_60', 'aging_61_90',
+                'aging_over_90']},
+            {'balance': 340, 'aging_0_30': 70, 'aging_31_60': 50,
+             'aging_61_90': 90, 'aging_over_90': 130})
+
+    def test_buckets_move_with_as_of(self):
+        balance = CustomerBalance.objects.annotate_aging(
+            as_of=self.as_of + timedelta(days=31)).get()
+        self.assertEqual(
+            (balance.aging_0_30, balance.aging_31_60, balance.aging_61_90,
+             balance.aging_over_90),
+            (0, 60, 30, 250))
+        # Orders created after as_of are not owed yet.
+        balance = CustomerBalance.objects.annotate_aging(
+            as_of=self.as_of - timedelta(days=1)).get()
+        self.assertEqual(balance.aging_0_30, 30)
+
+
+class ProductCostTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=30)
+        cls.order = Order.objects.create(customer=Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000'))
+
+    def receive(self, quantity, unit_cost):
+        return Purchase.objects.create(
+            product=self.product, purchase_unit_price=unit_cost,
+            quantity=quantity, purchase_date=timezone.now())
+
+    def get_cost(self):
+        cost = ProductCost.objects.get(product=self.product)
+        return cost.quantity, cost.average_cost
+
+    def test_receipts_move_the_average_by_their_quantity(self):
+        self.receive(10, 10)
+        self.assertEqual(self.get_cost(), (10, Decimal(10)))
+        purchase = self.receive(30, 30)
+        self.assertEqual(self.get_cost(), (40, Decimal(25)))
+        # Production comes in at the product's purchase price.
+        Production.objects.create(product=self.product, quantity=10,
+                                  production_date=timezone.now())
+        self.assertEqual(self.get_cost(), (50, Decimal(22)))
+
+        purchase.delete()
+        self.assertEqual(self.get_cost(), (20, Decimal(10)))
+
+    def test_sales_and_returns_move_units_at_the_average(self):
+        self.receive(10, 10)
+        self.receive(10, 20)
+        item = Item.objects.add_item(self.order, self.product, 4, 30)
+        self.assertEqual(item.unit_cost, Decimal(15))
+        self.assertEqual(self.get_cost(), (16, Decimal(15)))
+
+        # Sold units do not move the average; later receipts do.
+        self.receive(4, 35)
+        self.assertEqual(self.get_cost(), (20, Decimal(19)))
+        item.update_quantity(6)
+        item.refresh_from_db()
+        self.assertEqual(item.unit_cost, Decimal(
+            (4 * 15 + 2 * 19) / 6).quantize(item.unit_cost))
+        self.assertEqual(self.get_cost(), (18, Decimal(19)))
+
+        Return.objects.create(item=item, quantity=6)
+        self.assertEqual(self.get_cost()[0], 24)
+        self.assertEqual(self.get_cost()[1].quantize(Decimal('0.01')),
+                         Decimal('18.33'))
+
+    def test_rebuild_matches_the_incremental_costs(self):
+        self.receive(10, 10)
+        self.receive(10, 20)
+        Item.objects.add_item(self.order, self.product, 4, 30)
+        self.receive(4, 35)
+        costs = self.get_cost()
+        unit_costs = list(Item.objects.values_list('unit_cost', flat=True))
+
+        ProductCost.objects.rebuild()
+        self.assertEqual(self.get_cost(), costs)
+        self.assertEqual(
+            list(Item.objects.values_list('unit_cost', flat=True)),
+            unit_costs)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class ReorderSuggestionTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        cls.flour, cls.bran = [
+            Product.objects.create(name=name, purchase_price=10,
+                                   customer_price=15)
+            for name in ['flour', 'bran']
+        ]
+        for product in [cls.flour, cls.bran]:
+            Purchase.objects.create(
+                product=product, purchase_unit_price=10, quantity=10,
+                purchase_date=timezone.now())
+        # Flour sells 2 a day, every day; bran does not sell.
+        today = timezone.localdate()
+        ProductRollup.objects.bulk_create([
+            ProductRollup(product=cls.flour,
+                          day=today - timedelta(days=days), units_sold=2)
+            for days in range(1, forecasting.WINDOW_DAYS + 1)
+        ])
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def test_products_are_ranked_by_stockout_risk(self):
+        call_command('forecast_stock', stdout=StringIO())
+
+        response = self.client.get('/reorder-suggestions/')
+        self.assertEqual(response.status_code, 200)
+        flour, bran = response.data['results']
+        # 14 days to cover, 10 in stock and 7 days of lead time at 2 a day.
+        self.assertEqual(
+            (flour['product'], flour['forecast_demand'],
+             flour['days_of_cover'], flour['reorder_quantity'],
+             flour['stockout_risk']),
+            (self.flour.id, 28, 5, 18, 1))
+        self.assertEqual(
+            (bran['product'], bran['days_of_cover'],
+             bran['reorder_quantity'], bran['stockout_risk']),
+            (self.bran.id, None, 0, 0))
+
+        response = self.client.get('/reorder-suggestions/',
+                                   {'min_risk': 0.5})
+        self.assertEqual([row['product'] for row in response.data['results']],
+                         [self.flour.id])
+
+    def test_a_window_too_short_is_refused(self):
+        with self.assertRaises(CommandError):
+            call_command('forecast_stock', window=7, stdout=StringIO())
+
+
+class SyncTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@bleman.sn', 'x')
+        cls.customer = Customer.objects.create(
+            given_name='Awa', surname='Diop', phone_number='770000000')
+        cls.order = Order.objects.create(customer=cls.customer)
+        cls.payments = [Payment.objects.create(order=cls.order, amount=amount)
+                        for amount in [10, 20, 30]]
+        # Every row shares one timestamp, so the pages split ties.
+        written_at = timezone.now() - timedelta(minutes=5)
+        for model in [Customer, Order, Payment]:
+            model.objects.update(updated_at=written_at)
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def sync_all(self, token=None, page_size=2):
+        """Return the changes of every page from ``token`` and the token
+        of the last one."""
+        changes = []
+        while True:
+            params = {'page_size': page_size}
+            if token is not None:
+                params['token'] = token
+            response = self.client.get('/sync/', params)
+            self.assertEqual(response.status_code, 200)
+            changes += [(change['model'], change['id'], change['deleted'])
+                        for change in response.data['changes']]
+            token = response.data['next_token']
+            if not response.data['has_more']:
+                return changes, token
+
+    def test_pages_send_every_row_once(self):
+        changes, _ = self.sync_all()
+        self.assertEqual(changes, [
+            ('customer', self.customer.id, False),
+            ('order', self.order.id, False),
+        ] + [('payment', payment.id, False) for payment in self.payments])
+
+    def test_resumed_sync_sends_changes_and_deletions(self):
+        _, token = self.sync_all()
+        deleted = self.payments[0].id
+        self.payments[0].delete()
+
+        # Past the settle delay holding back the latest writes.
+        later = timezone.now() + timedelta(minutes=1)
+        with mock.patch.object(sync.timezone, 'now', return_value=later):
+            changes, token = self.sync_all(token)
+            self.assertEqual(changes, [
+                ('order', self.order.id, False),
+                ('payment', deleted, True),
+            ])
+            # Nothing new since.
+            self.assertEqual(self.sync_all(token)[0], [])
+
+    def test_a_stock_change_is_sent_with_the_quantity(self):
+        product = Product.objects.create(
+            name='product', purchase_price=10, customer_price=15)
+        Purchase.objects.create(product=product, purchase_unit_price=10,
+                                quantity=5, purchase_date=timezone.now())
+        _, token = self.sync_all()
+
+        Item.objects.add_item(self.order, product, 2, 15)
+        # Past the settle delay holding back the latest writes.
+        later = timezone.now() + timedelta(minutes=1)
+        with mock.patch.object(sync.timezone, 'now', return_value=later):
+            response = self.client.get('/sync/', {'token': token})
+        stock, = [change for change in response.data['changes']
+                  if change['model'] == 'stock']
+        self.assertEqual((stock['id'], stock['data']['quantity']),
+                         (product.id, 3))
+
+    def test_token_older_than_the_tombstones_is_refused(self):
+        synced_at = timezone.now() - sync.RETENTION - timedelta(days=1)
+        token = sync.encode_token((synced_at, 'product', 0), synced_at)
+        response = self.client.get('/sync/', {'token': token})
+        self.assertEqual(response.status_code, 410)
@@ -9,6 +9,16 @@ router.register('customers', views.CustomerViewSet, basename='customers')
 router.register('purchases', views.PurchaseViewSet, basename='purchases')
 router.register('productions', views.ProductionViewSet, basename='productions')
 router.register('orders', views.OrderViewSet, basename='orders')
+router.register('analytics/products', views.ProductRollupViewSet,
+                basename='analytics-products')
+router.register('receivables', views.ReceivableViewSet,
+                basename='receivables')
+router.register('analytics/customers', views.CustomerRollupViewSet,
+                basename='analytics-customers')
+router.register('reorder-suggestions', views.ReorderSuggestionViewSet,
+                basename='reorder-suggestions')
+router.register('sync', views.SyncViewSet, basename='sync')
+router.register('events', views.EventViewSet, basename='events')
 
 order_router = routers.NestedDefaultRouter(
     router, 'orders', lookup='order')
@@ -1,28 +1,86 @@
+from django.db.models import Prefetch
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from rest_framework import mixins, permissions, viewsets
+from rest_framework import (filters, mixins, permissions, serializers,
+                            viewsets)
+from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from mill.models import (Customer, Item, Order, Payment, Product, Production,
-                         Purchase, Return)
-from mill.pagination import PageNumberPagination
-from mill.serializers import (AddItemSerializer, CustomerSerializer,
-                              ItemSerializer, OrderSerializer,
-                              PaymentSerializer, ProductionSerializer,
-                              ProductSerializer, PurchaseSerializer,
-                              ReturnSerializer, UpdateItemSerializer,
-                              UpdateOrderSerializer)
-
-
-class ProductViewSet(viewsets.ModelViewSet):
-    pagination_class = PageNumberPagination
+from mill import events, export, importer, routers, sync
+from mill.idempotency import idempotent
+from mill.cache import CachedProductResponseMixin, get_stats
+from mill.models import (Customer, CustomerBalance, CustomerRollup, Item,
+                         Order, Payment, Product, ProductRollup, Production,
+                         Purchase, ReorderSuggestion, Return)
+from mill.pagination import (OptionalCursorPagination, PageNumberPagination,
+                             SelectablePagination)
+from mill.serializers import (AddItemSerializer, BatchPaymentSerializer,
+                              CreateOrderSerializer,
+                              CustomerBalanceSerializer,
+                              CustomerRollupReportSerializer,
+                              CustomerSerializer, EventStreamSerializer,
+                              ExportSerializer,
+                              ItemSerializer, OrderMarginSerializer,
+                              OrderSerializer, PaymentSerializer,
+                              ProductionSerializer,
+                              ProductRollupReportSerializer, ProductSerializer,
+                              PurchaseSerializer,
+                              ReorderSuggestionSerializer, ReturnSerializer,
+                              RollupReportParamsSerializer,
+                              StatementSerializer, SyncSerializer,
+                              UpdateItemSerializer, UpdateOrderSerializer)
+
+
+class ReplicaReadMixin:
+    """Serve the safe requests of ``replica_actions`` from the read replica,
+    unless the user wrote in the last ``routers.PIN_SECONDS``.
+
+    Streamed responses are read after the view returns, from the primary.
+    """
+    replica_actions = {'list', 'retrieve'}
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        routers.read_from_replica(
+            request.method in permissions.SAFE_METHODS
+            and self.action in self.replica_actions
+            and not routers.is_pinned(request.user)
+        )
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            routers.read_from_replica(False)
+
+
+# Not read from the replica: a lagging read could be cached under the
+# version token a write has just replaced.
+class ProductViewSet(CachedProductResponseMixin, viewsets.ModelViewSet):
+    pagination_class = SelectablePagination
     permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
     queryset = Product.objects\
         .get_product_with_quantity_in_stock()\
-        .prefetch_related('productions', 'purchases', 'items__returns')\
         .all()
 
     serializer_class = ProductSerializer
 
+    def get_queryset(self):
+        as_of = self.request.query_params.get('as_of')
+        if as_of is None:
+            return super().get_queryset()
+
+        try:
+            as_of = serializers.DateTimeField().run_validation(as_of)
+        except serializers.ValidationError as e:
+            raise serializers.ValidationError({'as_of': e.detail})
+        return Product.objects.annotate_quantity_in_stock(as_of=as_of)
+
+    @action(detail=False, url_path='cache-stats')
+    def cache_stats(self, request):
+        return Response(get_stats())
+
     def destroy(self, request, *args, **kwargs):
         production_queryset = Production.objects.filter(
             product_id=self.kwargs['pk'])
@@ -36,7 +94,7 @@ class ProductViewSet(viewsets.ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
-class CustomerViewSet(viewsets.ModelViewSet):
+class CustomerViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     pagination_class = PageNumberPagination
     permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
     queryset = Customer.objects.all()
@@ -56,18 +114,81 @@ class ProductionViewSet(viewsets.ModelViewSet):
     serializer_class = ProductionSerializer
 
 
-class OrderViewSet(viewsets.ModelViewSet):
-    pagination_class = PageNumberPagination
+class OrderViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
+    pagination_class = SelectablePagination
+    replica_actions = {'list', 'retrieve', 'margin'}
     permission_classes = [permissions.IsAuthenticated]
+    filter_backends = [filters.OrderingFilter]
+    ordering_fields = ['id', 'created_at', 'total_amount', 'remain_amount']
 
     def get_queryset(self):
-        return Order.objects.prefetch_related('items__returns', 'payments').all()
+        queryset = Order.objects\
+            .annotate_amounts()\
+            .prefetch_items()
+
+        for param, lookup in [('min_remain_amount', 'remain_amount__gte'),
+                              ('max_remain_amount', 'remain_amount__lte')]:
+            value = self.request.query_params.get(param)
+            if value is not None:
+                try:
+                    queryset = queryset.filter(**{lookup: int(value)})
+                except ValueError:
+                    raise serializers.ValidationError(
+                        {param: 'A valid integer is required.'})
+
+        return queryset.all()
 
     def get_serializer_class(self):
+        if self.action == 'create':
+            return CreateOrderSerializer
         if self.action == 'update':
             return UpdateOrderSerializer
         return OrderSerializer
 
+    @action(detail=True)
+    def margin(self, request, pk=None):
+        """Gross margin of the order and of each of its lines, from the
+        unit costs recorded when the items were sold."""
+        order = get_object_or_404(
+            Order.objects
+            .annotate_margin()
+            .prefetch_related(Prefetch(
+                'items',
+                queryset=Item.objects.annotate_line_margin(),
+                to_attr='margin_items',
+            )),
+            pk=pk
+        )
+        return Response(OrderMarginSerializer(order).data)
+
+    @action(detail=False, methods=['post'], url_path='payments')
+    @idempotent
+    def post_payments(self, request):
+        """Post payments to many orders at once, all or none."""
+        serializer = BatchPaymentSerializer(
+            data=request.data, many=True, allow_empty=False,
+            max_length=BatchPaymentSerializer.MAX_BATCH_SIZE)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=201)
+
+    @action(detail=False)
+    def export(self, request):
+        """Stream orders, items or payments as CSV or JSON lines."""
+        serializer = ExportSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = dict(serializer.validated_data)
+        dataset, output = params.pop('dataset'), params.pop('output')
+
+        columns, rows = export.get_rows(dataset, **params)
+        response = StreamingHttpResponse(
+            export.iter_export(output, columns, rows),
+            content_type=export.CONTENT_TYPES[output],
+        )
+        response['Content-Disposition'] = \
+            f'attachment; filename="{dataset}.{output}"'
+        return response
+
     def destroy(self, request, *args, **kwargs):
         if Item.objects.filter(order_id=self.kwargs['pk']).count() > 0:
             return Response({'error': 'Order cannot be deleted.'}, status=400)
@@ -76,6 +197,7 @@ class OrderViewSet(viewsets.ModelViewSet):
 
 class ItemViewSet(viewsets.ModelViewSet):
     http_method_names = ['get', 'post', 'patch', 'delete']
+    pagination_class = OptionalCursorPagination
     permission_classes = [permissions.IsAuthenticated]
 
     def list(self, request, *args, **kwargs):
@@ -88,7 +210,7 @@ class ItemViewSet(viewsets.ModelViewSet):
         return Item.objects\
             .filter(order_id=order_id)\
             .select_related('product')\
-            .prefetch_related('returns')\
+            .annotate_line_amount()\
             .all()
 
     def get_serializer_context(self):
@@ -122,14 +244,38 @@ class ReturnViewSet(viewsets.ModelViewSet):
             .all()
 
 
-class PurchaseViewSet(viewsets.ModelViewSet):
+class BulkImportMixin:
+    """Add ``POST import/`` taking a CSV or JSON-lines ``file`` upload of
+    ``import_kind`` rows."""
+    import_kind = None
+
+    @action(detail=False, methods=['post'], url_path='import')
+    def bulk_import(self, request):
+        upload = request.FILES.get('file')
+        if upload is None:
+            raise serializers.ValidationError(
+                {'file': ['No file was submitted.']})
+        input_format = request.data.get(
+            'input', importer.get_format(upload.name))
+        if input_format not in importer.FORMAT_CHOICES:
+            raise serializers.ValidationError(
+                {'input': [f'"{input_format}" is not a valid choice.']})
+
+        report = importer.Import(self.import_kind).run(
+            importer.iter_records(upload.file, input_format))
+        return Response(report)
+
+
+class PurchaseViewSet(BulkImportMixin, viewsets.ModelViewSet):
+    import_kind = 'purchases'
     pagination_class = PageNumberPagination
     serializer_class = PurchaseSerializer
     queryset = Purchase.objects.all()
     permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
 
 
-class ProductionViewSet(viewsets.ModelViewSet):
+class ProductionViewSet(BulkImportMixin, viewsets.ModelViewSet):
+    import_kind = 'productions'
     pagination_class = PageNumberPagination
     serializer_class = ProductionSerializer
     queryset = Production.objects.all()
@@ -137,7 +283,7 @@ class ProductionViewSet(viewsets.ModelViewSet):
 
 
 class PaymentViewSet(viewsets.ModelViewSet):
-    pagination_class = PageNumberPagination
+    pagination_class = SelectablePagination
     serializer_class = PaymentSerializer
     queryset = Payment.objects.all()
 
@@ -147,3 +293,152 @@ class PaymentViewSet(viewsets.ModelViewSet):
         context = super().get_serializer_context()
         context['order_id'] = self.kwargs.get('order_pk')
         return context
+
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
+
+
+class RollupReportViewSet(ReplicaReadMixin, mixins.ListModelMixin,
+                          viewsets.GenericViewSet):
+    """Sales per ``period`` bucket, summed from the daily rollup rows.
+
+    Filter with ``period`` (DAY, WEEK or MONTH), ``since``, ``until`` and
+    the id of the product or customer.
+    """
+    pagination_class = PageNumberPagination
+    permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
+    model = None
+
+    def get_queryset(self):
+        params = RollupReportParamsSerializer(data=self.request.query_params)
+        params.is_valid(raise_exception=True)
+        manager = self.model.objects
+
+        key_id = self.request.query_params.get(manager.key)
+        if key_id is not None:
+            try:
+                key_id = int(key_id)
+            except ValueError:
+                raise serializers.ValidationError(
+                    {manager.key: ['A valid integer is required.']})
+        return manager.report(key_id=key_id, **params.validated_data)
+
+
+class ProductRollupViewSet(RollupReportViewSet):
+    model = ProductRollup
+    serializer_class = ProductRollupReportSerializer
+
+
+class CustomerRollupViewSet(RollupReportViewSet):
+    model = CustomerRollup
+    serializer_class = CustomerRollupReportSerializer
+
+
+class ReceivableViewSet(ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
+    """Customer balances with the outstanding amounts aged in 0-30, 31-60,
+    61-90 and over 90 day buckets, largest balance first."""
+    pagination_class = PageNumberPagination
+    permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
+    serializer_class = CustomerBalanceSerializer
+
+    def get_queryset(self):
+        as_of = self.request.query_params.get('as_of')
+        if as_of is not None:
+            try:
+                as_of = serializers.DateTimeField().run_validation(as_of)
+            except serializers.ValidationError as e:
+                raise serializers.ValidationError({'as_of': e.detail})
+        queryset = CustomerBalance.objects\
+            .select_related('customer')\
+            .annotate_aging(as_of=as_of)
+
+        min_balance = self.request.query_params.get('min_balance')
+        if min_balance is not None:
+            try:
+                queryset = queryset.filter(balance__gte=int(min_balance))
+            except ValueError:
+                raise serializers.ValidationError(
+                    {'min_balance': 'A valid integer is required.'})
+        return queryset.all()
+
+    @action(detail=True)
+    def statement(self, request, pk=None):
+        """Stream the customer's orders and payments with the running
+        balance, as CSV or JSON lines."""
+        get_object_or_404(Customer, pk=pk)
+        params = StatementSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        output = params.validated_data.pop('output')
+
+        columns, rows = export.get_statement_rows(pk, **params.validated_data)
+        response = StreamingHttpResponse(
+            export.iter_export(output, columns, rows),
+            content_type=export.CONTENT_TYPES[output],
+        )
+        response['Content-Disposition'] = \
+            f'attachment; filename="statement-{pk}.{output}"'
+        return response
+
+
+class ReorderSuggestionViewSet(ReplicaReadMixin,
+                               viewsets.ReadOnlyModelViewSet):
+    """Products ranked by the risk of running out of stock before a
+    reorder arrives, from the last ``forecast_stock`` run."""
+    pagination_class = PageNumberPagination
+    permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
+    serializer_class = ReorderSuggestionSerializer
+
+    def get_queryset(self):
+        queryset = ReorderSuggestion.objects.select_related('product')
+        min_risk = self.request.query_params.get('min_risk')
+        if min_risk is not None:
+            try:
+                queryset = queryset.filter(stockout_risk__gte=float(min_risk))
+            except ValueError:
+                raise serializers.ValidationError(
+                    {'min_risk': 'A valid number is required.'})
+        return queryset.all()
+
+
+class SyncViewSet(viewsets.ViewSet):
+    """Change feed for offline clients: the products, stock levels,
+    customers, orders, items, payments and returns created, changed or
+    deleted since the ``token`` of the last page, oldest first."""
+    permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
+
+    def list(self, request):
+        params = SyncSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        return Response(sync.get_changes(**params.validated_data))
+
+
+class EventViewSet(viewsets.ViewSet):
+    """Server-sent events pushing stock levels and order totals and status
+    as they change, replaying the events missed since ``Last-Event-ID``
+    on reconnect."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        if not isinstance(request._request, ASGIRequest):
+            return Response(
+                {'detail': 'Live events are served by the ASGI events '
+                           'process.'},
+                status=501)
+        params = EventStreamSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        last_event_id = request.headers.get(
+            'Last-Event-ID', params.validated_data.get('last_event_id'))
+        products = params.validated_data.get('products')
+
+        response = StreamingHttpResponse(
+            events.stream(
+                last_event_id=last_event_id,
+                events=params.validated_data.get('events'),
+                product_ids=set(products) if products else None,
+            ),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response